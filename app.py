@@ -1,5 +1,21 @@
-import json, os, logging
-from flask import Flask, render_template_string, request, jsonify
+import json, os, re, io, csv, logging, time, threading, contextvars, atexit, unicodedata, zipfile, gc, heapq, gzip
+_IMPORT_STARTED = time.perf_counter()
+import hashlib
+from collections import deque, OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from contextlib import contextmanager
+from itertools import repeat, islice
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from math import gcd
+from difflib import SequenceMatcher
+from urllib.parse import quote
+from xml.sax.saxutils import escape as xml_escape
+from html import escape as html_escape
+from logging.handlers import RotatingFileHandler
+from flask import Flask, Response, request, jsonify, g, has_request_context
+from werkzeug.exceptions import RequestEntityTooLarge
+import click
 
 # .env ファイルから設定を読み込む
 def load_env(path='.env'):
@@ -19,20 +35,299 @@ logging.basicConfig(level=logging.INFO)
 # In-memory data store (簡易版なのでファイルベースのJSON)
 DATA_FILE = 'schedule_data.json'
 
+# 保存形式: json（既定・人が読める）/ compact（文字列表＋列指向の省サイズ形式）
+DATA_FORMAT = os.environ.get('DATA_FORMAT', 'json')
+COMPACT_DATA_FILE = os.environ.get('COMPACT_DATA_FILE', 'schedule_data.compact')
+
+# 編集操作の追記ログ。fsync は JOURNAL_FSYNC_INTERVAL 秒ごとにまとめて行う（0 なら毎回）
+JOURNAL_FILE = os.environ.get('JOURNAL_FILE', 'schedule_data.journal')
+JOURNAL_FSYNC_INTERVAL = float(os.environ.get('JOURNAL_FSYNC_INTERVAL', 0.005))
+# スナップショットの書き出し間隔（秒）と、間隔を待たずに書き出す journal の行数
+COMPACT_INTERVAL = float(os.environ.get('COMPACT_INTERVAL', 60))
+COMPACT_MAX_ENTRIES = int(os.environ.get('COMPACT_MAX_ENTRIES', 500))
+
+# 変更通知（SSE）: 心拍の間隔・1接続の最長時間（秒、過ぎたらクライアントが再接続）・イベントに差分を含める上限バイト数
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 20))
+SSE_MAX_AGE = float(os.environ.get('SSE_MAX_AGE', 300))
+SSE_MAX_OPS_BYTES = int(os.environ.get('SSE_MAX_OPS_BYTES', 4096))
+# 同時に開いておくストリームの上限。1本がスレッドを1つ占有するので、既定では gunicorn のスレッドの半分までにして
+# 残りを通常のリクエストに残す。超えた接続には 503 と Retry-After（SSE_BUSY_RETRY 秒）を返す
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', int(os.environ.get('GUNICORN_THREADS', 100)) // 2))
+SSE_BUSY_RETRY = int(os.environ.get('SSE_BUSY_RETRY', 30))
+
+# バックアップの書き出し先・間隔（秒、0 なら定期バックアップしない）・残す個数
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL = float(os.environ.get('BACKUP_INTERVAL', 3600))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 48))
+
+# リクエスト本文の上限（バイト）。超えたら読まずに 413。CSV の一括取り込みだけは IMPORT_MAX_BYTES まで
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', 4 * 1024 * 1024))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 32 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+
+# iCalendar フィードの繰り返し開始日（未設定なら今年度の4月1日）
+ICS_START_DATE = os.environ.get('ICS_START_DATE', '')
+
+# 習い事一覧の列（Sheets 同期・CSV 入出力で共通）
+LESSON_COLUMNS = [
+    ('id', 'ID'), ('name', '習い事'), ('school', '教室'), ('who', '対象'), ('day', '曜日'),
+    ('start', '開始'), ('end', '終了'), ('repeat', '繰り返し'), ('fee', '月謝'), ('status', '状態'), ('url', 'URL'), ('memo', '備考'),
+]
+DAYS = ['月', '火', '水', '木', '金', '土', '日']
+
 # Google Sheets 連携設定（.env または環境変数で指定、未設定ならSheets同期はスキップ）
 GOOGLE_SHEETS_ID = os.environ.get('GOOGLE_SHEETS_ID', '')
 GOOGLE_SHEETS_CREDENTIALS = os.environ.get('GOOGLE_SHEETS_CREDENTIALS', 'credentials.json')
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+# トレース出力先（未設定ならトレースは記録しない）
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', 5 * 1024 * 1024))
+TRACE_BACKUP_COUNT = int(os.environ.get('TRACE_BACKUP_COUNT', 3))
+
+# =========== Request Timing ===========
+# 1リクエスト内の処理時間を区間ごとに集計し、Server-Timing ヘッダーと構造化ログに出力する
+timing_logger = logging.getLogger('timing')
+
+def record_timing(name, ms):
+    if not has_request_context():
+        return
+    timings = g.setdefault('timings', {})
+    timings[name] = timings.get(name, 0.0) + ms
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, (time.perf_counter() - start) * 1000)
+
+# =========== Startup ===========
+# 起動の各段階（import・文書の読み込み・テンプレートのコンパイルなど）の所要時間を1行の JSON で出力する
+startup_logger = logging.getLogger('startup')
+
+def log_startup(phase, ms, **fields):
+    startup_logger.info(json.dumps(dict(phase=phase, ms=round(ms, 1), pid=os.getpid(), **fields), ensure_ascii=False))
+
+@contextmanager
+def startup_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        log_startup(phase, (time.perf_counter() - start) * 1000)
+
+# =========== Tracing ===========
+# 軽量なスパン記録。OTLP-JSON 形式で1スパン1行としてローテーションファイルに書き出す
+trace_logger = logging.getLogger('trace')
+trace_logger.propagate = False
+if TRACE_FILE:
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.addHandler(RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT, encoding='utf-8'))
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+def current_span():
+    return _current_span.get()
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _export_span(s):
+    if not TRACE_FILE:
+        return
+    record = dict(s)
+    record['attributes'] = [{'key': k, 'value': _otlp_value(v)} for k, v in s['attributes'].items()]
+    trace_logger.info(json.dumps({'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'family-schedule-planner'}}]},
+        'scopeSpans': [{'scope': {'name': 'app'}, 'spans': [record]}],
+    }]}, ensure_ascii=False))
+
+def start_span(name, parent=None, **attributes):
+    """スパンを開始して現在のスパンに設定する。parent 省略時は現在のスパンの子になる。"""
+    if parent is None:
+        parent = _current_span.get()
+    s = {
+        'traceId': parent['traceId'] if parent else os.urandom(16).hex(),
+        'spanId': os.urandom(8).hex(),
+        'parentSpanId': parent['spanId'] if parent else '',
+        'name': name,
+        'startTimeUnixNano': str(time.time_ns()),
+        'attributes': attributes,
+        'status': {'code': 1},
+    }
+    return s, _current_span.set(s)
+
+def end_span(s, token, error=None):
+    _current_span.reset(token)
+    s['endTimeUnixNano'] = str(time.time_ns())
+    if error is not None:
+        s['status'] = {'code': 2, 'message': str(error)}
+    _export_span(s)
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    s, token = start_span(name, parent, **attributes)
+    try:
+        yield s
+    except Exception as e:
+        end_span(s, token, e)
+        raise
+    end_span(s, token)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.request_span = start_span('http.request', **{'http.method': request.method, 'http.target': request.path})
+
+@app.teardown_request
+def end_request_span(error=None):
+    request_span = g.pop('request_span', None)
+    if request_span:
+        end_span(*request_span, error=error)
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get('timings', {})
+    total = (time.perf_counter() - g.get('request_start', time.perf_counter())) * 1000
+    metrics = ['%s;dur=%.2f' % (name, ms) for name, ms in timings.items()]
+    metrics.append('total;dur=%.2f' % total)
+    response.headers['Server-Timing'] = ', '.join(metrics)
+    if 'request_span' in g:
+        g.request_span[0]['attributes']['http.status_code'] = response.status_code
+    timing_logger.info(json.dumps({
+        'event': 'request',
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'total_ms': round(total, 2),
+        'timings': {name: round(ms, 2) for name, ms in timings.items()},
+    }, ensure_ascii=False))
+    return response
+
+# =========== Background Threads ===========
+_threads_lock = threading.Lock()
+_thread_pids = {}
+
+def ensure_thread(name, target):
+    """バックグラウンドスレッドをプロセスごとに1本だけ起動する。
+
+    gunicorn の fork 後は親のスレッドが存在しないので、プロセスが変わっていれば起動し直す。
+    """
+    with _threads_lock:
+        if _thread_pids.get(name) == os.getpid():
+            return
+        _thread_pids[name] = os.getpid()
+    threading.Thread(target=target, name=name, daemon=True).start()
+
+# =========== Compact Storage Format ===========
+# 文字列は1つの文字列表にまとめて番号で参照し、習い事はフィールドごとの列として持つ。
+# 全セルが文字列の列は番号の配列、それ以外は {"mixed": [番号 or [値]]}。
+# キーを持たない習い事は absent に行番号として記録する。
+COMPACT_MAGIC = b'FSPC1\n'
+
+def encode_compact(data):
+    strings, index = [], {}
+
+    def cell(value):
+        if isinstance(value, str):
+            i = index.get(value)
+            if i is None:
+                i = index[value] = len(strings)
+                strings.append(value)
+            return i
+        return [value]
+
+    lessons = data.get('lessons', [])
+    fields = []
+    for lesson in lessons:
+        for k in lesson:
+            if k not in fields:
+                fields.append(k)
+    columns, absent = [], {}
+    for f in fields:
+        rows = [i for i, lesson in enumerate(lessons) if f not in lesson]
+        if rows:
+            absent[f] = rows
+        values = [lesson.get(f) for lesson in lessons]
+        if all(isinstance(v, str) for i, v in enumerate(values) if f in lessons[i]):
+            filler = next(cell(v) for i, v in enumerate(values) if f in lessons[i])
+            columns.append([cell(v) if f in lessons[i] else filler for i, v in enumerate(values)])
+        else:
+            columns.append({'mixed': [cell(v) if f in lessons[i] else None for i, v in enumerate(values)]})
+
+    patterns = {}
+    for key, pat in data.get('patterns', {}).items():
+        if isinstance(pat, dict) and isinstance(pat.get('ids'), list):
+            rest = {k: v for k, v in pat.items() if k != 'ids'}
+            patterns[key] = [rest, [cell(i) for i in pat['ids']], list(pat).index('ids')]
+        else:
+            patterns[key] = [pat]
+
+    doc = {
+        'keys': list(data),
+        'lessons': {'n': len(lessons), 'fields': fields, 'columns': columns, 'absent': absent},
+        'patterns': patterns,
+        'rest': {k: v for k, v in data.items() if k not in ('lessons', 'patterns')},
+        'strings': strings,
+    }
+    return COMPACT_MAGIC + json.dumps(doc, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def decode_compact(raw):
+    if not raw.startswith(COMPACT_MAGIC):
+        raise ValueError('not a compact schedule document')
+    doc = json.loads(raw[len(COMPACT_MAGIC):].decode('utf-8'))
+    strings = doc['strings']
+    lookup = strings.__getitem__
+
+    def value(c):
+        return lookup(c) if c.__class__ is int else None if c is None else c[0]
+
+    data = {}
+    for key in doc['keys']:
+        if key == 'lessons':
+            fields = doc['lessons']['fields']
+            if not fields:
+                data[key] = [{} for _ in range(doc['lessons']['n'])]
+                continue
+            cols = [list(map(lookup, col)) if isinstance(col, list) else list(map(value, col['mixed']))
+                    for col in doc['lessons']['columns']]
+            lessons = list(map(dict, map(zip, repeat(fields), zip(*cols))))
+            for f, rows in doc['lessons']['absent'].items():
+                for i in rows:
+                    del lessons[i][f]
+            data[key] = lessons
+        elif key == 'patterns':
+            patterns = {}
+            for pat_key, entry in doc['patterns'].items():
+                if len(entry) == 1:
+                    patterns[pat_key] = entry[0]
+                    continue
+                rest, ids, pos = entry
+                items = list(rest.items())
+                items.insert(pos, ('ids', list(map(value, ids))))
+                patterns[pat_key] = dict(items)
+            data[key] = patterns
+        else:
+            data[key] = doc['rest'][key]
+    return data
+
+def default_data():
     return {
         'family': {
-            'papa': {'name': 'パパ', 'info': '会社員'},
-            'mama': {'name': 'ママ', 'info': '平日勤務'},
-            'sister': {'name': '第一子', 'birthday': '2023-04-10', 'info': '保育園'},
-            'brother': {'name': '第二子', 'birthday': '2025-06-15', 'info': ''},
+            'members': [
+                {'id': 1, 'name': 'パパ', 'role': 'parent', 'icon': '👨', 'birthday': '', 'info': '会社員'},
+                {'id': 2, 'name': 'ママ', 'role': 'parent', 'icon': '👩', 'birthday': '', 'info': '平日勤務'},
+                {'id': 3, 'name': '第一子', 'role': 'child', 'icon': '👧', 'birthday': '2023-04-10', 'info': '保育園'},
+                {'id': 4, 'name': '第二子', 'role': 'child', 'icon': '👶', 'birthday': '2025-06-15', 'info': ''},
+            ],
+            'next_id': 5,
         },
         'conditions': {
             'budget': '',
@@ -42,11 +337,11 @@ def load_data():
             'weekend_available': '',
         },
         'lessons': [
-            {'id': 'A1', 'name': '幼児教室', 'school': '', 'address': '', 'who': 'お姉ちゃん', 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
-            {'id': 'A2', 'name': '幼児教室', 'school': '', 'address': '', 'who': '弟くん', 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
-            {'id': 'B1', 'name': 'スイミング', 'school': '', 'address': '', 'who': 'お姉ちゃん', 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
-            {'id': 'B2', 'name': 'スイミング（ベビー）', 'school': '', 'address': '', 'who': '弟くん', 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '検討中', 'memo': '1歳〜が多い'},
-            {'id': 'C1', 'name': 'ピアノ', 'school': '', 'address': '', 'who': 'お姉ちゃん', 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '検討中', 'memo': '3歳〜が目安'},
+            {'id': 'A1', 'name': '幼児教室', 'school': '', 'address': '', 'who': '第一子', 'members': [3], 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
+            {'id': 'A2', 'name': '幼児教室', 'school': '', 'address': '', 'who': '第二子', 'members': [4], 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
+            {'id': 'B1', 'name': 'スイミング', 'school': '', 'address': '', 'who': '第一子', 'members': [3], 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '継続確定', 'memo': ''},
+            {'id': 'B2', 'name': 'スイミング（ベビー）', 'school': '', 'address': '', 'who': '第二子', 'members': [4], 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '検討中', 'memo': '1歳〜が多い'},
+            {'id': 'C1', 'name': 'ピアノ', 'school': '', 'address': '', 'who': '第一子', 'members': [3], 'day': '', 'start': '', 'end': '', 'fee': '', 'status': '検討中', 'memo': '3歳〜が目安'},
         ],
         'patterns': {
             'A': {'name': 'パターンA', 'ids': [], 'memo': ''},
@@ -55,44 +350,2670 @@ def load_data():
         }
     }
 
+def snapshot_path():
+    return COMPACT_DATA_FILE if DATA_FORMAT == 'compact' else DATA_FILE
+
+def read_snapshot():
+    if DATA_FORMAT == 'compact' and os.path.exists(COMPACT_DATA_FILE):
+        with span('store.load', format='compact'):
+            with timed('store_read'):
+                with open(COMPACT_DATA_FILE, 'rb') as f:
+                    raw = f.read()
+            with timed('json_decode'):
+                return decode_compact(raw)
+    # compact 形式でもファイルがまだ無ければ既存の JSON から読み込む（次回保存時に移行される）
+    if os.path.exists(DATA_FILE):
+        with span('store.load'):
+            with timed('store_read'):
+                with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                    raw = f.read()
+            with timed('json_decode'):
+                return json.loads(raw)
+    return default_data()
+
+def write_snapshot(data):
+    """スナップショットを一時ファイルに書いてから置き換える（書き込み途中で落ちても壊れない）。"""
+    with span('store.snapshot', format=DATA_FORMAT, lessons=len(data.get('lessons', []))):
+        if DATA_FORMAT == 'compact':
+            raw = encode_compact(data)
+        else:
+            raw = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+        path = snapshot_path()
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+# =========== Edit Operations ===========
+# 保存された文書と直前の文書の差分を編集操作の列に変換する。
+# 操作は journal に1行ずつ追記され、起動時にスナップショットへ順に適用して復元する。
+#   set / unset        : family・conditions などトップレベルのキー
+#   lesson_set / lesson_unset / lesson_insert / lesson_delete : 習い事の変更・追加・削除
+#   renumber           : ID の付け替え（パターンの参照もまとめて置き換え）
+#   pattern_toggle     : パターンへの採用・解除
+#   pattern_set / pattern_put / pattern_delete : パターン名・メモ・構成の変更
+def diff_ops(old, new):
+    ops = []
+    renumber = {'op': 'renumber', 'ids': [], 'map': {}}
+    old_lessons, new_lessons = old.get('lessons'), new.get('lessons')
+    lesson_ops = []
+    if isinstance(old_lessons, list) and isinstance(new_lessons, list):
+        _diff_lessons(old_lessons, new_lessons, lesson_ops, renumber)
+    old_patterns, new_patterns = old.get('patterns'), new.get('patterns')
+    pattern_ops = []
+    if isinstance(old_patterns, dict) and isinstance(new_patterns, dict):
+        if renumber['map']:
+            old_patterns = _renumber_patterns(old_patterns, renumber['map'])
+        _diff_patterns(old_patterns, new_patterns, pattern_ops)
+    if renumber['ids']:
+        ops.append(renumber)
+    ops.extend(lesson_ops)
+    ops.extend(pattern_ops)
+    for key in old:
+        if key not in new and key != 'revision':
+            ops.append({'op': 'unset', 'key': key})
+    for key, value in new.items():
+        if key == 'revision':
+            continue
+        if key == 'lessons' and isinstance(old_lessons, list) and isinstance(value, list):
+            continue
+        if key == 'patterns' and isinstance(old.get('patterns'), dict) and isinstance(value, dict):
+            continue
+        if key not in old or old[key] != value:
+            ops.append({'op': 'set', 'key': key, 'value': value})
+    return ops
+
+# これより大きな差分は SequenceMatcher を使わず位置で対応付ける
+DIFF_MATCH_LIMIT = 2000
+
+def _same(a, b):
+    return a is b or a == b
+
+def _diff_lessons(old, new, ops, renumber):
+    # 先頭・末尾の一致部分を除き、長さが同じなら位置ごと、違えば SequenceMatcher で対応付ける
+    n = min(len(old), len(new))
+    lo = 0
+    while lo < n and _same(old[lo], new[lo]):
+        lo += 1
+    hi_old, hi_new = len(old), len(new)
+    while hi_old > lo and hi_new > lo and _same(old[hi_old - 1], new[hi_new - 1]):
+        hi_old -= 1
+        hi_new -= 1
+    if hi_old - lo == hi_new - lo:
+        blocks = [('replace', lo, hi_old, lo, hi_new)]
+    elif hi_old == lo or hi_new == lo or max(hi_old, hi_new) - lo > DIFF_MATCH_LIMIT:
+        # 片側が空、または大きすぎて SequenceMatcher が重い場合は位置で対応付け、余りを末尾で追加・削除する
+        common = min(hi_old, hi_new)
+        blocks = [('replace', lo, common, lo, common), ('tail', common, hi_old, common, hi_new)]
+    else:
+        key = lambda lesson: json.dumps(lesson, sort_keys=True, ensure_ascii=False)
+        matcher = SequenceMatcher(None, [key(l) for l in old[lo:hi_old]], [key(l) for l in new[lo:hi_new]], autojunk=False)
+        blocks = [(tag, i1 + lo, i2 + lo, j1 + lo, j2 + lo) for tag, i1, i2, j1, j2 in matcher.get_opcodes()]
+    # 後ろのブロックから処理すれば、各操作の index は変更前の位置のままで正しい
+    for tag, i1, i2, j1, j2 in reversed(blocks):
+        if tag == 'equal':
+            continue
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            for k in range(i2 - i1):
+                _diff_lesson(i1 + k, old[i1 + k], new[j1 + k], ops, renumber)
+            continue
+        if i2 > i1:
+            ops.append({'op': 'lesson_delete', 'index': i1, 'count': i2 - i1})
+        if j2 > j1:
+            ops.append({'op': 'lesson_insert', 'index': i1, 'lessons': new[j1:j2]})
+
+def _diff_lesson(index, a, b, ops, renumber):
+    if _same(a, b):
+        return
+    if not (isinstance(a, dict) and isinstance(b, dict)):
+        ops.append({'op': 'lesson_delete', 'index': index, 'count': 1})
+        ops.append({'op': 'lesson_insert', 'index': index, 'lessons': [b]})
+        return
+    for field in a:
+        if field not in b:
+            ops.append({'op': 'lesson_unset', 'index': index, 'field': field})
+    for field, value in b.items():
+        if field in a and a[field] == value:
+            continue
+        if field == 'id' and a.get('id') and isinstance(value, str):
+            renumber['ids'].append([index, value])
+            renumber['map'][a['id']] = value
+        else:
+            ops.append({'op': 'lesson_set', 'index': index, 'field': field, 'value': value})
+
+def _renumber_patterns(patterns, id_map):
+    renamed = {}
+    for key, pat in patterns.items():
+        if isinstance(pat, dict) and isinstance(pat.get('ids'), list):
+            pat = dict(pat, ids=[id_map.get(i, i) for i in pat['ids']])
+        renamed[key] = pat
+    return renamed
+
+def _diff_patterns(old, new, ops):
+    for key in old:
+        if key not in new:
+            ops.append({'op': 'pattern_delete', 'key': key})
+    for key, pat in new.items():
+        before = old.get(key)
+        if _same(before, pat):
+            continue
+        if not (isinstance(before, dict) and isinstance(pat, dict) and list(before) == list(pat)
+                and isinstance(before.get('ids'), list) and isinstance(pat.get('ids'), list)):
+            ops.append({'op': 'pattern_put', 'key': key, 'value': pat})
+            continue
+        for field, value in pat.items():
+            if field != 'ids' and before[field] != value:
+                ops.append({'op': 'pattern_set', 'key': key, 'field': field, 'value': value})
+        old_ids, new_ids = before['ids'], pat['ids']
+        if old_ids == new_ids:
+            continue
+        old_set, new_set = set(old_ids), set(new_ids)
+        removed = [i for i in dict.fromkeys(old_ids) if i not in new_set]
+        added = [i for i in new_ids if i not in old_set]
+        if [i for i in old_ids if i in new_set] + added == new_ids:
+            ops.extend({'op': 'pattern_toggle', 'key': key, 'id': i, 'on': False} for i in removed)
+            ops.extend({'op': 'pattern_toggle', 'key': key, 'id': i, 'on': True} for i in added)
+        else:
+            ops.append({'op': 'pattern_set', 'key': key, 'field': 'ids', 'value': new_ids})
+
+def apply_ops(data, ops):
+    """編集操作を文書にその場で適用する（journal の再生用）。"""
+    for op in ops:
+        kind = op['op']
+        if kind == 'set':
+            data[op['key']] = op['value']
+        elif kind == 'unset':
+            data.pop(op['key'], None)
+        elif kind == 'lesson_set':
+            data['lessons'][op['index']][op['field']] = op['value']
+        elif kind == 'lesson_unset':
+            data['lessons'][op['index']].pop(op['field'], None)
+        elif kind == 'lesson_insert':
+            data['lessons'][op['index']:op['index']] = op['lessons']
+        elif kind == 'lesson_delete':
+            del data['lessons'][op['index']:op['index'] + op['count']]
+        elif kind == 'renumber':
+            for index, new_id in op['ids']:
+                data['lessons'][index]['id'] = new_id
+            data['patterns'] = _renumber_patterns(data['patterns'], op['map'])
+        elif kind == 'pattern_toggle':
+            pat = data['patterns'][op['key']]
+            if op['on']:
+                pat['ids'].append(op['id'])
+            else:
+                pat['ids'] = [i for i in pat['ids'] if i != op['id']]
+        elif kind == 'pattern_set':
+            data['patterns'][op['key']][op['field']] = op['value']
+        elif kind == 'pattern_put':
+            data['patterns'][op['key']] = op['value']
+        elif kind == 'pattern_delete':
+            data['patterns'].pop(op['key'], None)
+        else:
+            raise ValueError('unknown journal op: %s' % kind)
+    return data
+
+# 他の端末の編集の上に載せ直しても意味が変わらない操作（習い事の位置を動かさないもの）
+REBASE_SAFE_OPS = ('set', 'unset', 'lesson_set', 'lesson_unset', 'pattern_toggle', 'pattern_set', 'pattern_put', 'pattern_delete')
+
+def rebase_safe(ops):
+    return all(op.get('op') in REBASE_SAFE_OPS and not (op['op'] in ('set', 'unset') and op.get('key') in ('lessons', 'patterns'))
+               for op in ops)
+
+def drop_redundant_toggles(data, ops):
+    """他の端末が先に同じ採用・解除をしていた pattern_toggle を取り除く。"""
+    result = []
+    for op in ops:
+        if op['op'] == 'pattern_toggle':
+            ids = data.get('patterns', {}).get(op['key'], {}).get('ids', [])
+            if (op['id'] in ids) == bool(op['on']):
+                continue
+        result.append(op)
+    return result
+
+# =========== Store ===========
+# 文書はメモリ上に1つだけ持ち、保存のたびに revision を1つ進める。
+# 保持している文書は読み取り専用として扱い、変更は新しい文書を commit して差し替える。
+# 永続化は「スナップショット＋追記専用の journal」。journal の fsync は短い間隔でまとめて行い、
+# バックグラウンドの compactor が定期的にスナップショットを書き出して journal を切り詰める。
+class Store:
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self._lock = threading.RLock()
+        self._sync_cond = threading.Condition()
+        self._data = None
+        self._revision = 0
+        self._journal = None
+        self._tail = []  # スナップショット以降の (revision, journal の行)
+        self._written_rev = 0
+        self._synced_rev = 0
+        self._listeners = []
+        self._compact_wanted = threading.Event()
+        # スナップショットの書き出しと journal の切り詰めは1つずつ行う（定期・終了時・明示の compact が重ならない）
+        self._compact_lock = threading.Lock()
+        self._snapshot_rev = 0
+        self._pid = None  # 文書を開いたプロセス
+
+    def subscribe(self, listener):
+        """commit のたびに listener(revision, ops, data) を呼ぶ。"""
+        self._listeners.append(listener)
+
+    @property
+    def revision(self):
+        self.read()
+        return self._revision
+
+    def read(self):
+        # fork で引き継いだ文書は親が読み込んだ時点のもの。子ではディスク（スナップショット＋journal）から開き直す
+        if self._data is None or self._pid != os.getpid():
+            with self._lock:
+                if self._data is None or self._pid != os.getpid():
+                    self._open()
+        return self._data
+
+    def _open(self):
+        with span('store.open') as s:
+            data = read_snapshot()
+            snapshot_rev = data.get('revision', 0)
+            revision, tail = snapshot_rev, []
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # 書き込み途中で落ちた最終行は捨てる
+                            logging.warning('Ignoring torn journal entry after revision %d', revision)
+                            break
+                        if entry['rev'] <= snapshot_rev:
+                            continue
+                        apply_ops(data, entry['ops'])
+                        revision = entry['rev']
+                        tail.append((revision, line if line.endswith('\n') else line + '\n'))
+            data['revision'] = revision
+            # 旧形式の家族は読み込み時に直す（同じ revision のまま、次のスナップショットで保存される）
+            if migrate_family(data):
+                logging.info('Migrated family to numbered members')
+            s['attributes'].update(revision=revision, replayed=len(tail))
+            self._revision = self._written_rev = self._synced_rev = revision
+            self._snapshot_rev = snapshot_rev
+            self._tail = tail
+            self._rewrite_journal()
+            self._data = data
+            self._pid = os.getpid()
+        logging.info('Store opened at revision %d (%d journal entries replayed)', revision, len(tail))
+
+    def _rewrite_journal(self):
+        # 末尾の壊れた行を取り除き、スナップショット以降の行だけを残して開き直す
+        if self._journal:
+            self._journal.close()
+        tmp = self.journal_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(line for _, line in self._tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def commit(self, data, ops=None):
+        """新しい文書を保存して revision を返す。変更がなければ revision は進まない。"""
+        with self._lock:
+            revision = self._commit_locked(data, ops)
+        self._wait_durable(revision)
+        return revision
+
+    def commit_ops(self, ops, base, check=None):
+        """base の文書に対する編集操作を現在の文書に適用して commit する。
+
+        base より後に他の編集があれば、双方が位置を動かさない操作のときだけ載せ直す。
+        載せ直せなければ None を返す。check(data, current) が例外を投げたら commit しない。
+        """
+        with self._lock:
+            current = self.read()
+            rebased = base != self._revision
+            if rebased:
+                intervening = self._ops_since_locked(base)
+                if intervening is None or not all(rebase_safe(batch) for batch in intervening + [ops]):
+                    return None
+                ops = drop_redundant_toggles(current, ops)
+            data = dict(current)
+            data['lessons'] = [dict(l) for l in current.get('lessons', [])]
+            data['patterns'] = {k: dict(v, ids=list(v.get('ids', []))) if isinstance(v, dict) else v
+                                for k, v in current.get('patterns', {}).items()}
+            apply_ops(data, ops)
+            if check:
+                check(data, current)
+            revision = self._commit_locked(data, ops)
+        self._wait_durable(revision)
+        return revision, rebased
+
+    def _ops_since_locked(self, revision):
+        # スナップショットで journal を切り詰めた後は辿れない
+        if revision == self._revision:
+            return []
+        tail = [(rev, line) for rev, line in self._tail if rev > revision]
+        if not tail or tail[0][0] != revision + 1:
+            return None
+        return [json.loads(line)['ops'] for _, line in tail]
+
+    @contextmanager
+    def transaction(self):
+        """現在の文書の作業用コピーを渡し、ブロックを抜けたら commit する。
+
+        習い事の dict は共有されているので、変更するときは lessons[i] = dict(lessons[i], ...) のように置き換える。
+        """
+        with self._lock:
+            current = self.read()
+            data = dict(current)
+            data['lessons'] = list(current.get('lessons', []))
+            data['patterns'] = {k: dict(v, ids=list(v.get('ids', []))) if isinstance(v, dict) else v
+                                for k, v in current.get('patterns', {}).items()}
+            yield data
+            revision = self._commit_locked(data)
+        self._wait_durable(revision)
+
+    def _commit_locked(self, data, ops=None):
+        current = self.read()
+        if ops is None:
+            with timed('diff'):
+                ops = diff_ops(current, data)
+        if not ops:
+            data['revision'] = self._revision
+            return self._revision
+        revision = self._revision + 1
+        data['revision'] = revision
+        with span('store.journal_append', revision=revision, ops=len(ops)), timed('store_write'):
+            line = json.dumps({'rev': revision, 'ts': round(time.time(), 3), 'ops': ops},
+                              ensure_ascii=False, separators=(',', ':')) + '\n'
+            self._journal.write(line)
+            self._journal.flush()
+        self._tail.append((revision, line))
+        self._revision = self._written_rev = revision
+        self._data = data
+        ensure_thread('store-compactor', self._compactor)
+        if len(self._tail) >= COMPACT_MAX_ENTRIES:
+            self._compact_wanted.set()
+        for listener in self._listeners:
+            try:
+                listener(revision, ops, data)
+            except Exception:
+                logging.exception('Store listener failed')
+        return revision
+
+    def _wait_durable(self, revision):
+        # fsync はバックグラウンドでまとめて行い、自分の書き込みがディスクに届くまで待つ
+        if JOURNAL_FSYNC_INTERVAL <= 0:
+            with self._lock:
+                os.fsync(self._journal.fileno())
+                self._mark_synced(self._written_rev)
+            return
+        with timed('store_fsync'), self._sync_cond:
+            ensure_thread('journal-fsync', self._fsync_worker)
+            self._sync_cond.notify_all()
+            while self._synced_rev < revision:
+                self._sync_cond.wait()
+
+    def _mark_synced(self, revision):
+        with self._sync_cond:
+            self._synced_rev = max(self._synced_rev, revision)
+            self._sync_cond.notify_all()
+
+    def _fsync_worker(self):
+        while True:
+            with self._sync_cond:
+                while self._synced_rev >= self._written_rev:
+                    self._sync_cond.wait()
+            time.sleep(JOURNAL_FSYNC_INTERVAL)
+            with self._lock:
+                target = self._written_rev
+                fd = os.dup(self._journal.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._mark_synced(target)
+
+    def compact(self):
+        """スナップショットを書き出し、それより古い journal の行を捨てる。"""
+        with self._compact_lock:
+            with self._lock:
+                if self._data is None or not self._tail:
+                    return
+                data, revision = self.read(), self._revision
+            # 先に走った compact がこれより新しいスナップショットを書いていれば、古い内容で上書きしない
+            if revision <= self._snapshot_rev:
+                return
+            # 文書は読み取り専用なのでロックの外で書き出せる（commit は止めない）
+            write_snapshot(data)
+            with self._lock:
+                self._snapshot_rev = revision
+                self._tail = [(rev, line) for rev, line in self._tail if rev > revision]
+                self._rewrite_journal()
+                self._mark_synced(self._written_rev)
+        logging.info('Store compacted at revision %d', revision)
+
+    def close(self):
+        """終了時のスナップショット。文書を開いたプロセスでだけ書き出す（fork 元の古い文書で上書きしない）。"""
+        if self._data is not None and self._pid == os.getpid():
+            self.compact()
+
+    def _compactor(self):
+        while True:
+            self._compact_wanted.wait(COMPACT_INTERVAL)
+            self._compact_wanted.clear()
+            try:
+                self.compact()
+            except Exception:
+                logging.exception('Store compaction failed')
+
+store = Store(JOURNAL_FILE)
+atexit.register(store.close)
+
+def load_data():
+    with timed('store_read'):
+        return store.read()
+
 def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    with span('store.save', lessons=len(data.get('lessons', []))):
+        return store.commit(data)
+
+# =========== Backups ===========
+# 文書を定期的に gzip で圧縮して BACKUP_DIR に書き出す（SHA-256 を sha256sum 形式の .sha256 に添える）。
+# 保持している文書は読み取り専用なので、その参照をそのまま書き出せばロックを取らずに一貫した内容になる。
+# 戻すときは `flask --app app restore [ファイル名]`（サーバーを止めてから）。
+_BACKUP_NAME_RE = re.compile(r'^schedule-\d{8}T\d{6}Z-r(\d+)\.json\.gz$')
+
+def list_backups():
+    """バックアップのファイル名を古い順に返す。"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    return sorted(name for name in os.listdir(BACKUP_DIR) if _BACKUP_NAME_RE.match(name))
+
+def _write_file(path, raw):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(raw)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def write_backup(data):
+    """文書を圧縮・チェックサムつきで書き出し、古いものを BACKUP_KEEP 個まで減らす。ファイル名を返す。"""
+    revision = data.get('revision', 0)
+    with span('store.backup', revision=revision):
+        packed = gzip.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), mtime=0)
+        name = 'schedule-%s-r%d.json.gz' % (datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'), revision)
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        path = os.path.join(BACKUP_DIR, name)
+        _write_file(path, packed)
+        _write_file(path + '.sha256', ('%s  %s\n' % (hashlib.sha256(packed).hexdigest(), name)).encode('ascii'))
+        for old in list_backups()[:-max(BACKUP_KEEP, 1)]:
+            for suffix in ('', '.sha256'):
+                try:
+                    os.remove(os.path.join(BACKUP_DIR, old + suffix))
+                except FileNotFoundError:
+                    pass
+    logging.info('Backup written: %s (%d bytes)', name, len(packed))
+    return name
+
+def read_backup(name):
+    """チェックサムを確かめてからバックアップを読み込む。壊れていれば ValueError。"""
+    path = os.path.join(BACKUP_DIR, os.path.basename(name))
+    with open(path, 'rb') as f:
+        packed = f.read()
+    try:
+        with open(path + '.sha256', 'r', encoding='ascii') as f:
+            expected = f.read().split()[0]
+    except (OSError, IndexError):
+        raise ValueError('%s のチェックサムがありません' % name)
+    if hashlib.sha256(packed).hexdigest() != expected:
+        raise ValueError('%s のチェックサムが一致しません' % name)
+    data = json.loads(gzip.decompress(packed).decode('utf-8'))
+    if not isinstance(data, dict) or not isinstance(data.get('lessons'), list) or not isinstance(data.get('patterns'), dict):
+        raise ValueError('%s は予定データではありません' % name)
+    return data
+
+def _backup_worker():
+    names = list_backups()
+    last = int(_BACKUP_NAME_RE.match(names[-1]).group(1)) if names else None
+    while True:
+        data = store.read()
+        if data.get('revision', 0) != last:
+            try:
+                write_backup(data)
+                last = data.get('revision', 0)
+            except Exception:
+                logging.exception('Backup failed')
+        time.sleep(BACKUP_INTERVAL)
+
+def start_backups(revision, ops, data):
+    # 最初の保存で起動する（gunicorn の master では起動しないので、ワーカーが持つ最新の文書を書き出せる）
+    ensure_thread('store-backup', _backup_worker)
+
+if BACKUP_DIR and BACKUP_INTERVAL > 0:
+    store.subscribe(start_backups)
+
+@app.cli.command('backup')
+def backup_command():
+    """現在の文書をすぐにバックアップする。"""
+    click.echo(write_backup(store.read()))
+
+@app.cli.command('restore')
+@click.argument('name', required=False)
+@click.option('--list', 'show', is_flag=True, help='バックアップの一覧を表示する')
+def restore_command(name, show):
+    """バックアップ（省略時は最新）から文書を戻す。戻す前の内容もバックアップしておく。"""
+    names = list_backups()
+    if not names:
+        raise click.ClickException('%s にバックアップがありません' % BACKUP_DIR)
+    if show:
+        click.echo('\n'.join(names))
+        return
+    name = name or names[-1]
+    try:
+        data = read_backup(name)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+    migrate_family(data)
+    click.echo('現在の内容を %s に退避しました' % write_backup(store.read()))
+    revision = store.commit(data)
+    store.compact()
+    click.echo('%s を revision %d として復元しました' % (os.path.basename(name), revision))
+
+# Sheets のシート名。パターンは1つ1シート（PATTERN_SHEET_PREFIX＋キー）で、消えたパターンのシートは同期時に削除する
+LESSON_SHEET = '習い事候補'
+SUMMARY_SHEET = 'パターン比較'
+PATTERN_SHEET_PREFIX = 'パターン_'
+
+def sheets_tables(data):
+    """同期するシートを (シート名, 行の配列) の順に返す。"""
+    header = [title for _, title in LESSON_COLUMNS]
+    lessons = data.get('lessons', [])
+    by_id = lessons_by_id(data)
+    tables = [(LESSON_SHEET, [header] + [[lesson.get(field, '') for field, _ in LESSON_COLUMNS] for lesson in lessons])]
+    summary = [['キー', 'パターン', '件数', '月謝合計'] + DAYS + ['時間の重なり']]
+    for key, pat in data.get('patterns', {}).items():
+        stats = pattern_stats.get(data, key)
+        name = pat.get('name') or key
+        summary.append([key, name, stats['count'], stats['fee']] + [stats['days'][d] for d in DAYS] + [len(stats['conflicts'])])
+        rows = [['パターン', name], ['メモ', pat.get('memo', '')], ['件数', stats['count']], ['月謝合計', stats['fee']], [],
+                ['曜日'] + DAYS, ['件数'] + [stats['days'][d] for d in DAYS], [], header]
+        rows.extend([by_id[i].get(field, '') for field, _ in LESSON_COLUMNS]
+                    for i in dict.fromkeys(pat.get('ids', [])) if i in by_id)
+        tables.append((PATTERN_SHEET_PREFIX + key, rows))
+    tables.insert(1, (SUMMARY_SHEET, summary))
+    return tables
+
+def _sheet_cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': '' if value is None else str(value)}}
+
+def sheets_batch_requests(tables, existing):
+    """全シートの書き換えを spreadsheets.batchUpdate の requests 1つにまとめる。
+
+    existing は {シート名: sheetId}。無いシートは sheetId をこちらで決めて追加し、同じ requests の中で書き込む。
+    """
+    requests, next_id = [], max(existing.values(), default=0) + 1
+    for title, rows in tables:
+        grid = {'rowCount': max(len(rows), 1), 'columnCount': max(max(len(row) for row in rows), 1)}
+        sheet_id = existing.get(title)
+        if sheet_id is None:
+            sheet_id, next_id = next_id, next_id + 1
+            requests.append({'addSheet': {'properties': {'sheetId': sheet_id, 'title': title, 'gridProperties': grid}}})
+        else:
+            # 行数・列数を合わせてから値を消す（前回より短くなった分が残らない）
+            requests.append({'updateSheetProperties': {'properties': {'sheetId': sheet_id, 'gridProperties': grid},
+                                                       'fields': 'gridProperties(rowCount,columnCount)'}})
+            requests.append({'updateCells': {'range': {'sheetId': sheet_id}, 'fields': 'userEnteredValue'}})
+        requests.append({'updateCells': {'start': {'sheetId': sheet_id, 'rowIndex': 0, 'columnIndex': 0},
+                                         'rows': [{'values': [_sheet_cell(v) for v in row]} for row in rows],
+                                         'fields': 'userEnteredValue'}})
+    synced = {title for title, _ in tables}
+    for title, sheet_id in existing.items():
+        if title.startswith(PATTERN_SHEET_PREFIX) and title not in synced:
+            requests.append({'deleteSheet': {'sheetId': sheet_id}})
+    return requests
+
+@lru_cache(maxsize=1)
+def sheets_spreadsheet():
+    # 認証済みのクライアントを使い回し、同期のたびにトークンを取り直さない
+    import gspread
+    gc = gspread.service_account(filename=GOOGLE_SHEETS_CREDENTIALS)
+    return gc.open_by_key(GOOGLE_SHEETS_ID)
 
 def sync_to_sheets(data):
-    """習い事候補一覧をGoogle Sheetsに同期する。未設定時やエラー時はスキップ。"""
+    """習い事候補・パターンごとのシート・パターン比較を Google Sheets に同期する。未設定時やエラー時はスキップ。
+
+    シートの一覧を1回読み、全シートの書き換えを batchUpdate 1回で送るので、シートが増えても往復回数は変わらない。
+    """
     if not GOOGLE_SHEETS_ID:
         return
     try:
-        import gspread
-        gc = gspread.service_account(filename=GOOGLE_SHEETS_CREDENTIALS)
-        sh = gc.open_by_key(GOOGLE_SHEETS_ID)
-        try:
-            ws = sh.worksheet('習い事候補')
-        except gspread.exceptions.WorksheetNotFound:
-            ws = sh.add_worksheet(title='習い事候補', rows=100, cols=11)
-        headers = ['ID', '習い事', '教室', '対象', '曜日', '開始', '終了', '月謝', '状態', 'URL', '備考']
-        rows = [headers]
-        for lesson in data.get('lessons', []):
-            rows.append([
-                lesson.get('id', ''),
-                lesson.get('name', ''),
-                lesson.get('school', ''),
-                lesson.get('who', ''),
-                lesson.get('day', ''),
-                lesson.get('start', ''),
-                lesson.get('end', ''),
-                lesson.get('fee', ''),
-                lesson.get('status', ''),
-                lesson.get('url', ''),
-                lesson.get('memo', ''),
-            ])
-        ws.clear()
-        ws.update(rows, 'A1')
-        logging.info('Google Sheets synced (%d lessons)', len(rows) - 1)
+        with span('gspread.open'):
+            sh = sheets_spreadsheet()
+            metadata = sh.fetch_sheet_metadata({'fields': 'sheets.properties(sheetId,title)'})
+        existing = {s['properties']['title']: s['properties']['sheetId'] for s in metadata.get('sheets', [])}
+        tables = sheets_tables(data)
+        requests = sheets_batch_requests(tables, existing)
+        with span('gspread.batch_update', sheets=len(tables), requests=len(requests)):
+            sh.batch_update({'requests': requests})
+        logging.info('Google Sheets synced (%d lessons, %d patterns)', len(data.get('lessons', [])), len(tables) - 2)
     except Exception as e:
+        sheets_spreadsheet.cache_clear()
         logging.warning('Google Sheets sync failed: %s', e)
 
+# =========== Background Sheets Sync ===========
+# リクエストは同期をキューに積むだけにし、バックグラウンドのワーカーが最新の内容だけを送る。
+# 積んだ時点のスパンを引き継ぐので、1回の編集を Sheets 反映までひとつのトレースで追える。
+_sync_cond = threading.Condition()
+_sync_pending = None
+
+def enqueue_sync(data):
+    global _sync_pending
+    if not GOOGLE_SHEETS_ID:
+        return
+    with timed('sync_enqueue'), span('sync.enqueue') as s:
+        with _sync_cond:
+            _sync_pending = (data, s)
+            _sync_cond.notify()
+    ensure_thread('sheets-sync', _sync_worker)
+
+def _sync_worker():
+    global _sync_pending
+    while True:
+        with _sync_cond:
+            while _sync_pending is None:
+                _sync_cond.wait()
+            data, parent = _sync_pending
+            _sync_pending = None
+        start = time.perf_counter()
+        with span('sheets.sync', parent=parent, lessons=len(data.get('lessons', []))):
+            sync_to_sheets(data)
+        timing_logger.info(json.dumps({'event': 'sync', 'sync_ms': round((time.perf_counter() - start) * 1000, 2)}))
+
+# =========== Change Events (SSE) ===========
+# 直近のイベントを共有のリングバッファに持ち、購読者は Condition で待つだけにする。
+# 購読者ごとのキューを持たないので、待機中の接続はスレッド1本分のコストしかかからない。
+class EventHub:
+    def __init__(self, size=256):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=size)
+        self._revision = 0
+        self._streams = 0
+
+    def open_stream(self):
+        """ストリームの枠を1つ確保する。上限に達していれば False。"""
+        with self._cond:
+            if self._streams >= SSE_MAX_STREAMS:
+                return False
+            self._streams += 1
+            return True
+
+    def close_stream(self):
+        with self._cond:
+            self._streams -= 1
+
+    def publish(self, event):
+        with self._cond:
+            self._events.append(event)
+            self._revision = event['revision']
+            self._cond.notify_all()
+
+    def wait(self, after, timeout):
+        """revision が after より新しいイベントを返す。タイムアウトなら空リスト。"""
+        with self._cond:
+            if self._revision <= after:
+                self._cond.wait(timeout)
+            if self._revision <= after:
+                return []
+            events = [e for e in self._events if e['revision'] > after]
+            if not events or events[0]['revision'] != after + 1:
+                # バッファから溢れた分がある場合は最新の revision だけ知らせて全体を取り直してもらう
+                return [{'revision': self._revision, 'resync': True}]
+            return events
+
+hub = EventHub()
+
+def publish_change(revision, ops, data):
+    event = {'revision': revision, 'base': revision - 1}
+    if has_request_context():
+        event['client'] = request.headers.get('X-Client-Id', '')
+    encoded = json.dumps(ops, ensure_ascii=False, separators=(',', ':'))
+    if len(encoded.encode('utf-8')) <= SSE_MAX_OPS_BYTES:
+        event['ops'] = ops
+    hub.publish(event)
+
+store.subscribe(publish_change)
+
+# =========== Family ===========
+# 家族は family.members に何人でも並べ、番号（id）は next_id から振って削除しても使い回さない。
+# 習い事は members に対象の番号を持ち（複数人も可）、who は CSV・ID・表示用にその呼び名を「＋」でつないだもの。
+# 人 → 習い事の位置の索引は revision ごとに作り、人物別の絞り込みや集計は呼び名の部分一致ではなく索引で引く。
+WHO_SEPARATOR = '＋'
+_WHO_SPLIT_RE = re.compile(r'\s*[＋+、,]\s*')
+LEGACY_MEMBERS = (('papa', 'parent', '👨'), ('mama', 'parent', '👩'), ('sister', 'child', '👧'), ('brother', 'child', '👶'))
+# 旧データの既定の呼び名（お姉ちゃん・弟くん）は family の呼び名と違っていても、この字で姉・弟に割り当てる
+_LEGACY_WHO_HINTS = (('sister', '姉'), ('brother', '弟'))
+# 人の番号ごとの色（線・背景・文字）。1〜4 は旧形式のパパ・ママ・姉・弟の色
+MEMBER_COLORS = (('#5b8def', '#e8f2fb', '#2f5fb3'), ('#e86a92', '#fdf0f3', '#b8436a'), ('#ff9a5c', '#fff3eb', '#c05a20'),
+                 ('#4ecdc4', '#e6faf8', '#2a9d8f'), ('#9b7bd4', '#f3eefb', '#6b4ba3'), ('#e0a82e', '#fdf6e3', '#9a6f10'))
+
+def family_members(data):
+    family = data.get('family')
+    return (family.get('members') or []) if isinstance(family, dict) else []
+
+def split_who(who):
+    return [name for name in _WHO_SPLIT_RE.split(who or '') if name]
+
+def member_colors(number):
+    return MEMBER_COLORS[(number - 1) % len(MEMBER_COLORS)]
+
+def migrate_family(data):
+    """旧形式（family.papa/mama/sister/brother と、who の呼び名だけの習い事）を人の番号で参照する形に直す。"""
+    family = data.get('family')
+    if not isinstance(family, dict) or 'members' in family:
+        return False
+    members, legacy = [], {}
+    for number, (key, role, icon) in enumerate(LEGACY_MEMBERS, 1):
+        if isinstance(family.get(key), dict):
+            member = {'id': number, 'name': '', 'role': role, 'icon': icon, 'birthday': '', 'info': ''}
+            member.update((k, v) for k, v in family[key].items() if k != 'id')
+            members.append(member)
+            legacy[key] = number
+    data['family'] = {'members': members, 'next_id': len(LEGACY_MEMBERS) + 1}
+    index = PersonIndex(data)
+    for lesson in data.get('lessons', []):
+        if 'members' in lesson:
+            continue
+        ids = set()
+        for name in split_who(lesson.get('who')):
+            number = index.by_name.get(name)
+            if number is None:
+                number = next((legacy.get(key) for key, hint in _LEGACY_WHO_HINTS if hint in name), None)
+            if number is not None:
+                ids.add(number)
+        lesson['members'] = index.ordered(ids)
+        if ids:
+            lesson['who'] = index.join_names(lesson['members'])
+    return True
+
+class PersonIndex:
+    def __init__(self, data):
+        self.members = family_members(data)
+        self.by_id = {m['id']: m for m in self.members}
+        self._order = {m['id']: i for i, m in enumerate(self.members)}
+        self.by_name = {}
+        for m in self.members:
+            self.by_name.setdefault(m.get('name') or '', m['id'])
+        self.lessons = {m['id']: [] for m in self.members}
+        self.unassigned = []
+        for position, lesson in enumerate(data.get('lessons', [])):
+            ids = self.member_ids(lesson)
+            for number in ids:
+                self.lessons[number].append(position)
+            if not ids:
+                self.unassigned.append(position)
+
+    def ordered(self, ids):
+        return sorted((i for i in ids if i in self.by_id), key=self._order.get)
+
+    def join_names(self, ids):
+        return WHO_SEPARATOR.join(self.by_id[i].get('name') or '' for i in ids)
+
+    def resolve_who(self, who):
+        """「姉＋弟」のような呼び名の並びを人の番号（家族の並び順）にする。知らない呼び名は捨てる。"""
+        return self.ordered({self.by_name[name] for name in split_who(who) if name in self.by_name})
+
+    def member_ids(self, lesson):
+        """習い事の対象の番号。members の無い習い事（古い画面・手書きの文書）は who の呼び名から引く。"""
+        ids = lesson.get('members')
+        if not isinstance(ids, list):
+            return self.resolve_who(lesson.get('who'))
+        return [i for i in ids if i in self.by_id]
+
+    def names(self, lesson):
+        return [self.by_id[i].get('name') or '' for i in self.member_ids(lesson)]
+
+    def resolve(self, person):
+        """呼び名か番号（文字列でも可）から人の番号を返す。見つからなければ None。"""
+        if person in self.by_name:
+            return self.by_name[person]
+        if str(person).isdigit() and int(person) in self.by_id:
+            return int(person)
+        return None
+
+    def display_name(self, person):
+        """呼び名か番号を呼び名にそろえる（知らない人ならそのまま）。"""
+        number = self.resolve(person)
+        return (self.by_id[number].get('name') or person) if number is not None else person
+
+    def positions(self, person):
+        """person の習い事の位置の集合。知らない人なら空。"""
+        number = self.resolve(person)
+        return frozenset(self.lessons[number]) if number is not None else frozenset()
+
+def person_index(data):
+    return index_cache.get('person_index', lambda: PersonIndex(data), data)
+
+# =========== Lesson CSV Import ===========
+# CSV を1行ずつ読みながら検証・正規化し、有効な行だけを1回の transaction で ID ごとに追加・更新する
+IMPORT_MAX_ERRORS = 1000
+
+def normalize_time(raw):
+    """'9:00' / '900' / '９時' などを 'HH:MM' にそろえる（画面の parseTimeInput と同じ解釈）。"""
+    raw = unicodedata.normalize('NFKC', raw or '').strip()
+    digits = re.sub(r'[^0-9]', '', raw)
+    if not digits:
+        if raw:
+            raise ValueError('時刻を読み取れません: %s' % raw)
+        return ''
+    if len(digits) <= 2:
+        h, m = int(digits), 0
+    elif len(digits) == 3:
+        h, m = int(digits[0]), int(digits[1:])
+    else:
+        h, m = int(digits[:-2]), int(digits[-2:])
+    if h > 23 or m > 59:
+        raise ValueError('時刻が範囲外です: %s' % raw)
+    return '%02d:%02d' % (h, m)
+
+def normalize_fee(raw):
+    s = unicodedata.normalize('NFKC', raw or '').strip()
+    s = s.replace(',', '').replace('円', '').replace('¥', '').replace('￥', '').strip()
+    if not s:
+        return ''
+    if not s.isdigit():
+        raise ValueError('月謝は数字で入力してください: %s' % raw)
+    return str(int(s))
+
+def normalize_day(raw):
+    s = unicodedata.normalize('NFKC', raw or '').strip()
+    if not s:
+        return ''
+    if s[0] in DAYS and s[1:] in ('', '曜', '曜日'):
+        return s[0]
+    raise ValueError('曜日は月〜日で入力してください: %s' % raw)
+
+def normalize_repeat(raw):
+    s = unicodedata.normalize('NFKC', raw or '').strip()
+    parse_recurrence(s, '')
+    return s
+
+LESSON_NORMALIZERS = {'day': normalize_day, 'start': normalize_time, 'end': normalize_time, 'fee': normalize_fee,
+                      'repeat': normalize_repeat}
+
+def parse_lesson_csv(lines):
+    """CSV の行を読み、(行番号, 習い事の項目 dict, エラー一覧) を順に返す。"""
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    by_header = {h: f for f, h in LESSON_COLUMNS}
+    columns = [by_header.get((h or '').strip().lstrip('\ufeff')) for h in (header or [])]
+    if not any(columns):
+        raise ValueError('CSV のヘッダーが認識できません（%s）' % ', '.join(h for _, h in LESSON_COLUMNS))
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        fields, errors = {}, []
+        for field, cell in zip(columns, row):
+            if field is None:
+                continue
+            normalize = LESSON_NORMALIZERS.get(field)
+            try:
+                fields[field] = normalize(cell) if normalize else cell.strip()
+            except ValueError as e:
+                errors.append(str(e))
+        if fields.get('start') and fields.get('end') and fields['end'] <= fields['start']:
+            errors.append('終了時刻は開始時刻より後にしてください')
+        yield reader.line_num, fields, errors
+
+def import_lessons(lines):
+    rows, errors, error_count = [], [], 0
+    with span('lessons.import.parse'), timed('import_parse'):
+        for line, fields, row_errors in parse_lesson_csv(lines):
+            if row_errors:
+                error_count += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({'row': line, 'errors': row_errors})
+            else:
+                rows.append(fields)
+    inserted = updated = 0
+    with span('lessons.import.apply', rows=len(rows)), store.transaction() as data:
+        lessons = data['lessons']
+        index = {lesson.get('id'): i for i, lesson in enumerate(lessons) if lesson.get('id')}
+        people = PersonIndex(data)
+        for fields in rows:
+            # 対象は呼び名で書かれているので人の番号に直す（家族にいない呼び名は who の文字のまま残す）
+            if 'who' in fields:
+                fields['members'] = people.resolve_who(fields['who'])
+                if fields['members']:
+                    fields['who'] = people.join_names(fields['members'])
+            if not fields.get('id'):
+                # ID が空の行は新しい習い事として ID を払い出す（空の ID のまま追加すると行どうしが区別できない）
+                fields['id'] = lesson_ids.allocate(fields.get('who', ''), fields.get('name', ''))[0]
+            i = index.get(fields['id'])
+            if i is None:
+                lesson = {field: '' for field, _ in LESSON_COLUMNS}
+                lesson.update(address='', status='検討中')
+                lesson.update(fields)
+                index[lesson['id']] = len(lessons)
+                lessons.append(lesson)
+                inserted += 1
+            else:
+                lessons[i] = dict(lessons[i], **fields)
+                updated += 1
+    return {'ok': True, 'revision': data['revision'], 'inserted': inserted, 'updated': updated,
+            'error_count': error_count, 'errors': errors}
+
+# =========== Lesson Export ===========
+# 文書から1行ずつ取り出してチャンク単位で返す。カタログの大きさに関わらずメモリ使用量は一定。
+EXPORT_CHUNK_ROWS = 500
+DAY_ORDER = {d: i for i, d in enumerate(DAYS)}
+
+def natural_key(value):
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.findall(r'\d+|\D+', str(value))]
+
+EXPORT_SORT_KEYS = {
+    'fee': lambda lesson: int(lesson.get('fee') or 0) if str(lesson.get('fee') or '').isdigit() else 0,
+    'day': lambda lesson: DAY_ORDER.get(lesson.get('day'), 99),
+    'id': lambda lesson: natural_key(lesson.get('id', '')),
+}
+
+def iter_export_lessons(data, who='', pattern='', sort='', descending=False):
+    lessons = data.get('lessons', [])
+    selected = None
+    if pattern:
+        selected = set(data.get('patterns', {}).get(pattern, {}).get('ids', []))
+    order = range(len(lessons))
+    if sort:
+        key = EXPORT_SORT_KEYS.get(sort, lambda lesson: str(lesson.get(sort, '')))
+        order = sorted(order, key=lambda i: key(lessons[i]), reverse=descending)
+    allowed = person_index(data).positions(who) if who else None
+    for i in order:
+        if allowed is not None and i not in allowed:
+            continue
+        lesson = lessons[i]
+        if selected is not None and lesson.get('id') not in selected:
+            continue
+        yield [lesson.get(field, '') for field, _ in LESSON_COLUMNS]
+
+def stream_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    buf.write('\ufeff')
+    writer.writerow([header for _, header in LESSON_COLUMNS])
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_CHUNK_ROWS == 0:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode('utf-8')
+
+class _ChunkSink:
+    """zipfile の書き込み先。書かれたバイト列を溜めておき、drain() で取り出す（seek 不可のストリーム扱い）。"""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+XLSX_PARTS = [
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/workbook.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+     'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+     '<sheets><sheet name="習い事候補" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+     '</Relationships>'),
+]
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        text = str(value if value is not None else '')
+        if text.isdigit() and len(text) < 15:
+            cells.append('<c><v>%s</v></c>' % text)
+        else:
+            cells.append('<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % xml_escape(_XML_ILLEGAL.sub('', text)))
+    return '<row>%s</row>' % ''.join(cells)
+
+def stream_xlsx(rows):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, content in XLSX_PARTS:
+            zf.writestr(name, content)
+        yield sink.drain()
+        with zf.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                         '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                         + _xlsx_row([header for _, header in LESSON_COLUMNS])).encode('utf-8'))
+            for i, row in enumerate(rows, 1):
+                sheet.write(_xlsx_row(row).encode('utf-8'))
+                if i % EXPORT_CHUNK_ROWS == 0:
+                    yield sink.drain()
+            sheet.write(b'</sheetData></worksheet>')
+    yield sink.drain()
+
+# =========== Revision Cache ===========
+class RevisionCache:
+    """文書の revision ごとに計算結果を持つ LRU キャッシュ。revision が変わったら丸ごと捨てる。"""
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._revision = None
+        self._entries = OrderedDict()
+
+    def get(self, key, compute, data=None):
+        # 保存前の文書など、store の現在の文書以外から計算する場合はキャッシュしない
+        if data is not None and data is not store.read():
+            return compute()
+        revision = store.revision
+        with self._lock:
+            if self._revision != revision:
+                self._revision = revision
+                self._entries = OrderedDict()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                record_timing('cache_hit', 0)
+                return self._entries[key]
+        value = compute()
+        with self._lock:
+            if self._revision == revision:
+                self._entries[key] = value
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+# =========== iCalendar Feeds ===========
+ICS_WEEKDAYS = dict(zip(DAYS, ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']))
+ICS_TIMEZONE = [
+    'BEGIN:VTIMEZONE', 'TZID:Asia/Tokyo',
+    'BEGIN:STANDARD', 'DTSTART:19700101T000000', 'TZOFFSETFROM:+0900', 'TZOFFSETTO:+0900', 'TZNAME:JST', 'END:STANDARD',
+    'END:VTIMEZONE',
+]
+CONFIRMED_STATUSES = ('継続確定', '新規確定')
+ics_cache = RevisionCache()
+
+def _ics_start_date(text):
+    """ICS_START_DATE を起動時に1回だけ読む。YYYY-MM-DD でなければ警告して既定の日付を使う。"""
+    if not text:
+        return None
+    try:
+        return date.fromisoformat(text.strip())
+    except ValueError:
+        logging.warning('Ignoring ICS_START_DATE=%r (expected YYYY-MM-DD)', text)
+        return None
+
+ICS_START = _ics_start_date(ICS_START_DATE)
+
+def feed_start_date():
+    if ICS_START:
+        return ICS_START
+    today = date.today()
+    return date(today.year if today.month >= 4 else today.year - 1, 4, 1)
+
+def _ics_text(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _ics_fold(line):
+    # 1行75オクテットまで。続きは行頭に空白を付けて折り返す
+    raw = line.encode('utf-8')
+    if len(raw) <= 75:
+        return line
+    parts, current = [], ''
+    for ch in line:
+        limit = 75 if not parts else 74
+        if len((current + ch).encode('utf-8')) > limit:
+            parts.append(current)
+            current = ''
+        current += ch
+    parts.append(current)
+    return '\r\n '.join(parts)
+
+def lesson_events(lesson, start, uid_suffix, skipped=()):
+    """習い事1件を毎週繰り返す VEVENT の行に変換する。休業日 skipped は EXDATE にする。曜日・時刻が未設定なら何も返さない。"""
+    rule = lesson_rule(lesson)
+    first = next(rule.iter_dates(start), None)
+    begin, end = time_to_min(lesson.get('start')), time_to_min(lesson.get('end'))
+    if first is None or begin < 0 or end < 0:
+        return []
+    day = first.strftime('%Y%m%d')
+    begin, end = '%02d%02d00' % divmod(begin, 60), '%02d%02d00' % divmod(end, 60)
+    description = '\n'.join(filter(None, [
+        '対象: %s' % lesson['who'] if lesson.get('who') else '',
+        '月謝: %s円' % lesson['fee'] if lesson.get('fee') else '',
+        lesson.get('memo', ''),
+    ]))
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:%s-%s@family-schedule-planner' % (lesson.get('id') or 'lesson', uid_suffix),
+        'DTSTAMP:%s' % datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'),
+        'DTSTART;TZID=Asia/Tokyo:%sT%s' % (day, begin),
+        'DTEND;TZID=Asia/Tokyo:%sT%s' % (day, end),
+    ] + ics_rrule(rule) + ['EXDATE;TZID=Asia/Tokyo:%sT%s' % (d.strftime('%Y%m%d'), begin) for d in skipped] + [
+        'SUMMARY:%s' % _ics_text(' '.join(filter(None, [lesson.get('name', ''), lesson.get('who', '')]))),
+    ]
+    location = lesson.get('school') or lesson.get('address')
+    if location:
+        lines.append('LOCATION:%s' % _ics_text(location))
+    if description:
+        lines.append('DESCRIPTION:%s' % _ics_text(description))
+    if lesson.get('url'):
+        lines.append('URL:%s' % lesson['url'])
+    lines.append('END:VEVENT')
+    return lines
+
+def ics_rrule(rule):
+    """繰り返し規則を RRULE の行にする（体験・単発は繰り返さない）。"""
+    if rule.kind == 'once':
+        return []
+    byday = ICS_WEEKDAYS[DAYS[rule.weekday]]
+    if rule.kind == 'nth':
+        parts = ['FREQ=MONTHLY', 'BYDAY=%s' % ','.join('%d%s' % (n, byday) for n in sorted(rule.nths))]
+    else:
+        parts = ['FREQ=WEEKLY'] + (['INTERVAL=%d' % rule.interval] if rule.interval > 1 else []) + ['BYDAY=%s' % byday]
+    if rule.end:
+        # 終了日の終わり（日本時間 23:59:59）を UTC で
+        parts.append('UNTIL=%sT145959Z' % rule.end.strftime('%Y%m%d'))
+    return ['RRULE:' + ';'.join(parts)]
+
+def build_ics(data, pattern=None, who=''):
+    lessons = data.get('lessons', [])
+    if who:
+        people = person_index(data)
+        number = people.resolve(who)
+        lessons = [lessons[i] for i in people.lessons.get(number, [])]
+        who = people.display_name(who)
+    if pattern is not None:
+        pat = data.get('patterns', {}).get(pattern, {})
+        ids = set(pat.get('ids', []))
+        lessons = [l for l in lessons if l.get('id') in ids]
+        calname = pat.get('name') or 'パターン' + pattern
+    else:
+        lessons = [l for l in lessons if l.get('status') in CONFIRMED_STATUSES]
+        calname = '確定'
+    if who:
+        calname = '%s %s' % (calname, who)
+    start = feed_start_date()
+    calendar = occurrence_calendar(data)
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//family-schedule-planner//JA', 'CALSCALE:GREGORIAN',
+             'X-WR-CALNAME:%s' % _ics_text('習い事 ' + calname), 'X-WR-TIMEZONE:Asia/Tokyo'] + ICS_TIMEZONE
+    for lesson in lessons:
+        rule = lesson_rule(lesson)
+        skipped = sorted(d for d in calendar.closed_dates(lesson) if d >= start and rule.contains(d))
+        lines.extend(lesson_events(lesson, start, pattern or 'confirmed', skipped))
+    lines.append('END:VCALENDAR')
+    body = ('\r\n'.join(_ics_fold(line) for line in lines) + '\r\n').encode('utf-8')
+    return '"%s"' % hashlib.sha1(body).hexdigest(), body
+
+def ics_response(pattern=None, who=''):
+    if pattern is not None and pattern not in load_data().get('patterns', {}):
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    etag, body = ics_cache.get((pattern, who), lambda: build_ics(load_data(), pattern, who))
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    # If-None-Match はカンマ区切りの一覧なので、部分一致ではなくタグごとに比べる（弱い比較）
+    if request.if_none_match.contains_weak(etag.strip('"')):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='text/calendar; charset=utf-8', headers=headers)
+
+# =========== Travel Feasibility ===========
+# 教室間の移動時間（文書の travel_times: [{"from", "to", "minutes"}]）を添字付きの表に変換し、
+# パターン内で同じ日に続く2件の間に移動が間に合うかを1組あたり O(1) で判定する。
+index_cache = RevisionCache(maxsize=64)
+
+def parse_minutes(text):
+    """'車15分' / '1時間' / '1時間30分' を分に変換する。数字がなければ None。"""
+    s = unicodedata.normalize('NFKC', str(text or ''))
+    hours = re.search(r'(\d+(?:\.\d+)?)\s*時間', s)
+    mins = re.search(r'(\d+)\s*分', s)
+    if hours or mins:
+        return int(float(hours.group(1)) * 60 if hours else 0) + (int(mins.group(1)) if mins else 0)
+    digits = re.search(r'\d+', s)
+    return int(digits.group()) if digits else None
+
+def time_to_min(t):
+    """'HH:MM' を 0 時からの分に変換する。未設定や '朝:半' のように読めない時刻は -1。"""
+    if not t or ':' not in t:
+        return -1
+    h, _, m = t.partition(':')
+    try:
+        return int(h) * 60 + int(m or 0)
+    except ValueError:
+        return -1
+
+class TravelMatrix:
+    def __init__(self, entries):
+        entries = [e for e in entries or [] if e.get('from') and e.get('to') and parse_minutes(e.get('minutes')) is not None]
+        schools = sorted({e['from'] for e in entries} | {e['to'] for e in entries})
+        self.index = {school: i for i, school in enumerate(schools)}
+        self.n = n = len(schools)
+        self.minutes = [None] * (n * n)
+        for e in entries:
+            self.minutes[self.index[e['from']] * n + self.index[e['to']]] = parse_minutes(e['minutes'])
+        # 逆方向が未入力なら同じ時間とみなす
+        for e in entries:
+            i, j = self.index[e['from']], self.index[e['to']]
+            if self.minutes[j * n + i] is None:
+                self.minutes[j * n + i] = self.minutes[i * n + j]
+
+    def lookup(self, a, b):
+        if a == b:
+            return 0
+        i, j = self.index.get(a), self.index.get(b)
+        if i is None or j is None:
+            return None
+        return self.minutes[i * self.n + j]
+
+def lessons_by_id(data):
+    return index_cache.get('lessons_by_id', lambda: {l['id']: l for l in data.get('lessons', []) if l.get('id')}, data)
+
+def travel_matrix(data):
+    return index_cache.get('travel_matrix', lambda: TravelMatrix(data.get('travel_times')), data)
+
+class DayTimeline:
+    """時刻のある習い事を曜日・開始時刻の順に1列に並べたもの（revision ごとに1回作る）。
+
+    パターンの習い事は並び順の番号で整列するだけで曜日ごとの並びになり、隣どうしを比べればよい。
+    """
+    def __init__(self, data):
+        lessons = [l for l in data.get('lessons', []) if l.get('id') and l.get('day')
+                   and 0 <= time_to_min(l.get('start')) <= time_to_min(l.get('end'))]
+        lessons.sort(key=lambda l: (DAY_ORDER.get(l['day'], len(DAYS)), l['day'], time_to_min(l['start'])))
+        self.lessons = lessons
+        self.start = [time_to_min(l['start']) for l in lessons]
+        self.end = [time_to_min(l['end']) for l in lessons]
+        self.rank = {l['id']: i for i, l in enumerate(lessons)}
+        self._meets = {}
+
+    def meets(self, i, j):
+        """2件が同じ日に開かれることがあるか（繰り返し規則の判定は組ごとに1回だけ行う）。"""
+        key = (i, j)
+        if key not in self._meets:
+            self._meets[key] = lessons_overlap(self.lessons[i], self.lessons[j])
+        return self._meets[key]
+
+def day_timeline(data):
+    return index_cache.get('day_timeline', lambda: DayTimeline(data), data)
+
+def travel_issues(data, ids):
+    """同じ日に続く習い事の組ごとに、移動が間に合わない・許容範囲を超える・移動時間が未登録のものを返す。"""
+    timeline, matrix = day_timeline(data), travel_matrix(data)
+    limit = parse_minutes(data.get('conditions', {}).get('travel_limit'))
+    ranks = sorted({timeline.rank[i] for i in ids if i in timeline.rank})
+    issues = []
+    for k in range(1, len(ranks)):
+        cur = ranks[k]
+        nxt = timeline.lessons[cur]
+        # 直前の習い事からの移動を見る。隔週どうしなど同じ日に開かれない組のときだけ、さらに前へ遡る
+        back = k - 1
+        while back >= 0 and timeline.lessons[ranks[back]]['day'] == nxt['day'] and not timeline.meets(ranks[back], cur):
+            back -= 1
+        if back < 0 or timeline.lessons[ranks[back]]['day'] != nxt['day']:
+            continue
+        prev_rank = ranks[back]
+        prev = timeline.lessons[prev_rank]
+        gap = timeline.start[cur] - timeline.end[prev_rank]
+        a, b = prev.get('school', ''), nxt.get('school', '')
+        if gap < 0 or not a or not b or a == b:
+            continue
+        minutes = matrix.lookup(a, b)
+        if minutes is None:
+            kind = 'unknown'
+        elif minutes > gap:
+            kind = 'impossible'
+        elif limit is not None and minutes > limit:
+            kind = 'over_limit'
+        else:
+            continue
+        issues.append({'kind': kind, 'day': nxt['day'], 'from': prev['id'], 'to': nxt['id'],
+                       'from_school': a, 'to_school': b, 'gap': gap, 'minutes': minutes})
+    return issues
+
+def _impossible_transitions(data):
+    found = {}
+    for key, pat in data.get('patterns', {}).items():
+        if isinstance(pat, dict):
+            for issue in travel_issues(data, pat.get('ids', [])):
+                if issue['kind'] == 'impossible':
+                    found[(key, issue['from'], issue['to'])] = issue
+    return found
+
+def strict_travel_violations(data, previous):
+    """conditions.travel_strict が有効なとき、今回の保存で新たに生じた「移動が間に合わない」組み合わせを返す。"""
+    if not data.get('conditions', {}).get('travel_strict'):
+        return {}
+    before = _impossible_transitions(previous)
+    violations = {}
+    for (key, a, b), issue in _impossible_transitions(data).items():
+        if (key, a, b) not in before:
+            violations.setdefault(key, []).append(issue)
+    return violations
+
+# =========== Availability Constraints ===========
+# conditions の自由記述（お迎え時間・平日/土日の空き時間帯）を曜日ごとの分単位ビットマスクに変換する。
+# 編集ごとに1回だけ変換し、習い事が枠内かどうかはマスクの AND 1回で判定する。
+MINUTES_PER_DAY = 24 * 60
+FULL_DAY_MASK = (1 << MINUTES_PER_DAY) - 1
+_TIME_TOKEN = r'(\d{1,2})(?:\s*:\s*(\d{2})|\s*時\s*(?:(半)|(\d{1,2})\s*分?)?)?'
+_RANGE_RE = re.compile(_TIME_TOKEN + r'\s*(?:〜|~|-|−|ー|–|から)\s*' + _TIME_TOKEN)
+_SINGLE_TIME_RE = re.compile(r'^\s*' + _TIME_TOKEN + r'\s*$')
+
+def _token_minutes(h, m, half, m2):
+    h = int(h)
+    m = int(m) if m else 30 if half else int(m2) if m2 else 0
+    if h > 24 or m > 59 or (h == 24 and m):
+        raise ValueError('時刻が範囲外です')
+    return h * 60 + m
+
+def parse_clock(text):
+    """'18:00' / '18時' / '18時半' を分に変換する。空なら None。"""
+    s = unicodedata.normalize('NFKC', str(text or '')).strip()
+    if not s:
+        return None
+    match = _SINGLE_TIME_RE.match(s)
+    if not match:
+        raise ValueError('時刻を読み取れません: %s' % text)
+    return _token_minutes(*match.groups())
+
+def range_mask(start, end):
+    if end <= start:
+        return 0
+    return ((1 << (end - start)) - 1) << start
+
+# 曜日指定の語。1文字ずつ探すと「平日」「毎日」「曜日」の「日」を日曜と取り違えるので、語・範囲・1文字の順に読む
+_DAY_KEYWORDS = (('平日', range(5)), ('毎日', range(7)), ('土日', (5, 6)), ('週末', (5, 6)))
+_DAY_RANGE_RE = re.compile(r'([{0}])\s*(?:〜|~|-|−|ー|–|から)\s*([{0}])'.format(''.join(DAYS)))
+
+def parse_days(prefix):
+    """時間帯の前の曜日指定（'平日' / '月〜金' / '月水金' / '日曜日'）を曜日の添字の一覧に変換する。"""
+    days = set()
+    for word, indices in _DAY_KEYWORDS:
+        if word in prefix:
+            days.update(indices)
+            prefix = prefix.replace(word, ' ')
+    prefix = prefix.replace('曜日', ' ').replace('曜', ' ')
+
+    def expand(match):
+        first, last = DAYS.index(match.group(1)), DAYS.index(match.group(2))
+        days.update((first + k) % 7 for k in range((last - first) % 7 + 1))
+        return ' '
+    prefix = _DAY_RANGE_RE.sub(expand, prefix)
+    days.update(i for i, d in enumerate(DAYS) if d in prefix)
+    return sorted(days)
+
+def parse_windows(text, default_days):
+    """'16:00〜19:00' / '月水 16時〜18時、金 17:00-19:00' を {曜日の添字: マスク} に変換する。"""
+    s = unicodedata.normalize('NFKC', str(text or ''))
+    windows, errors = {}, []
+    for segment in re.split(r'[,、/;\n]', s):
+        if not segment.strip():
+            continue
+        ranges = list(_RANGE_RE.finditer(segment))
+        if not ranges:
+            errors.append('時間帯を読み取れません: %s' % segment.strip())
+            continue
+        prefix = segment[:ranges[0].start()]
+        days = parse_days(prefix) or default_days
+        for match in ranges:
+            try:
+                start = _token_minutes(*match.groups()[:4])
+                end = _token_minutes(*match.groups()[4:])
+            except ValueError as e:
+                errors.append('%s: %s' % (e, match.group()))
+                continue
+            for day in days:
+                windows[day] = windows.get(day, 0) | range_mask(start, end)
+    return windows, errors
+
+class Availability:
+    def __init__(self, conditions):
+        self.masks = [FULL_DAY_MASK] * 7
+        self.errors = []
+        for field, default_days in (('weekday_available', list(range(5))), ('weekend_available', [5, 6])):
+            windows, errors = parse_windows(conditions.get(field), default_days)
+            self.errors.extend(errors)
+            for day, mask in windows.items():
+                self.masks[day] = mask
+        try:
+            pickup = parse_clock(conditions.get('pickup_time'))
+        except ValueError as e:
+            self.errors.append(str(e))
+            pickup = None
+        if pickup is not None:
+            # 平日はお迎え前に習い事を入れられない
+            for day in range(5):
+                self.masks[day] &= range_mask(pickup, MINUTES_PER_DAY)
+
+    def fits(self, lesson):
+        """習い事が空き時間帯に収まるか。曜日・時刻が未設定なら判定できないので True。"""
+        day = DAY_ORDER.get(lesson.get('day'))
+        start, end = time_to_min(lesson.get('start')), time_to_min(lesson.get('end'))
+        if day is None or start < 0 or end <= start:
+            return True
+        mask = range_mask(start, min(end, MINUTES_PER_DAY))
+        return self.masks[day] & mask == mask
+
+    def windows(self):
+        """曜日ごとの空き時間帯を [['16:00', '19:00'], ...] で返す（画面用）。"""
+        result = {}
+        for day, mask in zip(DAYS, self.masks):
+            spans, minute = [], 0
+            while mask >> minute:
+                if not (mask >> minute) & 1:
+                    minute += 1
+                    continue
+                start = minute
+                while (mask >> minute) & 1:
+                    minute += 1
+                spans.append(['%02d:%02d' % divmod(start, 60), '%02d:%02d' % divmod(minute, 60)])
+            result[day] = spans
+        return result
+
+def availability(data):
+    return index_cache.get('availability', lambda: Availability(data.get('conditions', {})), data)
+
+# =========== Age Eligibility ===========
+# memo の「2才6ケ月～小学１年生」「3歳〜が目安」から対象年齢を読み取り、
+# 子ども（誕生日あり）× 習い事ごとに通える期間 [開始日, 終了日) を索引にする。
+# 境界は ('years', 満年齢)・('months', 月齢)・('grade', 学年) で、学年は 年少=4, 年中=5, 年長=6, 小1=7 … 中1=13。
+# 上限は含むので、「3歳まで」は4歳の誕生日の前日まで、「2歳6か月まで」は2歳7か月になる前日まで、「年長まで」は小1の4月1日の前日まで。
+_AGE_BOUND = (r'(?:(\d{1,2})\s*[歳才]\s*(?:(\d{1,2})\s*[かカヵヶケ]\s*月)?'
+              r'|(\d{1,2})\s*[かカヵヶケ]\s*月'
+              r'|(未就園児?|未就学児?|年少|年中|年長|小学\s*(\d)\s*年生?|小(\d)|中学\s*(\d)\s*年生?|中(\d)))')
+_AGE_RANGE_RE = re.compile(_AGE_BOUND + r'\s*(?:〜|~|-|ー|から)\s*(?:' + _AGE_BOUND + ')?')
+_GRADES = {'年少': 4, '年中': 5, '年長': 6, '未就園': 3, '未就園児': 3, '未就学': 6, '未就学児': 6}
+_AGE_LABEL_GRADES = {4: '年少', 5: '年中', 6: '年長'}
+
+def _age_bound(years, months, only_months, grade, elem, elem2, junior, junior2):
+    if years and not months:
+        return ('years', int(years))
+    if years or months or only_months:
+        return ('months', int(years or 0) * 12 + int(months or only_months or 0))
+    if not grade:
+        return None
+    if grade in _GRADES:
+        return ('grade', _GRADES[grade])
+    if elem or elem2:
+        return ('grade', 6 + int(elem or elem2))
+    return ('grade', 12 + int(junior or junior2))
+
+@lru_cache(maxsize=4096)
+def parse_age_range(memo):
+    """memo から対象年齢 (下限, 上限) を取り出す。上限は含む。見つからなければ None。"""
+    s = unicodedata.normalize('NFKC', memo or '')
+    match = _AGE_RANGE_RE.search(s)
+    if not match:
+        return None
+    groups = match.groups()
+    lower, upper = _age_bound(*groups[:8]), _age_bound(*groups[8:])
+    if lower == ('grade', 3):
+        lower = None
+    return (lower, upper)
+
+def age_bound_label(bound):
+    if bound is None:
+        return ''
+    kind, value = bound
+    if kind == 'years':
+        return '%d歳' % value
+    if kind == 'months':
+        years, months = divmod(value, 12)
+        return ('%d歳' % years if years else '') + ('%dか月' % months if months else '')
+    if value in _AGE_LABEL_GRADES:
+        return _AGE_LABEL_GRADES[value]
+    if value == 3:
+        return '未就園児'
+    return '小学%d年生' % (value - 6) if value <= 12 else '中学%d年生' % (value - 12)
+
+def add_months(day, months):
+    year, month = divmod(day.month - 1 + months, 12)
+    year += day.year
+    month += 1
+    last = (date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(day.day, last))
+
+def school_year_of_birth(birthday):
+    # 4月2日〜翌4月1日生まれが同じ学年
+    return birthday.year if (birthday.month, birthday.day) >= (4, 2) else birthday.year - 1
+
+def eligible_period(birthday, age_range):
+    """誕生日と対象年齢から通える期間 (開始日, 終了日) を返す。None は制限なし。"""
+    lower, upper = age_range
+    base = school_year_of_birth(birthday)
+    start = end = None
+    if lower is not None:
+        kind, value = lower
+        if kind == 'years':
+            start = add_months(birthday, value * 12)
+        elif kind == 'months':
+            start = add_months(birthday, value)
+        else:
+            start = date(base + value, 4, 1)
+    if upper is not None:
+        # 年齢・月齢はその年齢・月齢の最後の日まで（次の誕生日・次の月の誕生日の前日）、学年は学年末まで
+        kind, value = upper
+        if kind == 'years':
+            end = add_months(birthday, (value + 1) * 12)
+        elif kind == 'months':
+            end = add_months(birthday, value + 1)
+        else:
+            end = date(base + value + 1, 4, 1)
+    return start, end
+
+def _birthday(member):
+    try:
+        return date.fromisoformat(member.get('birthday') or '')
+    except (TypeError, ValueError):
+        return None
+
+class EligibilityIndex:
+    """習い事 ID → 対象年齢と、子ども → 通える期間の並び（開始日・ID の順）。
+
+    Store の listener として、memo・ID の変更、習い事の追加・削除、家族の誕生日の変更があった分だけを直す。
+    習い事1件の変更は子どもごとに二分探索で1件抜き差しするだけで、全件は読み直さない。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = None        # 位置 → 習い事 ID（挿入・削除に合わせて動かす）
+        self._counts = {}       # 習い事 ID → 同じ ID の件数（重複した ID は作り直しで扱う）
+        self.ranges = {}
+        self.birthdays = {}     # 人の番号 → 誕生日
+        self.children = {}      # 人の番号 → (通える期間の並び, 開始日の並び)
+        self._revision = -1
+        self._data = None
+
+    def _build(self, data):
+        self._ids = [lesson.get('id') for lesson in data.get('lessons', [])]
+        self._counts = {}
+        for lid in self._ids:
+            self._counts[lid] = self._counts.get(lid, 0) + 1
+        self.ranges, self.birthdays, self.children = {}, {}, {}
+        for lesson in data.get('lessons', []):
+            age_range = parse_age_range(str(lesson.get('memo') or ''))
+            if lesson.get('id') and age_range:
+                self.ranges[lesson['id']] = age_range
+        self._set_family(data)
+        self._revision, self._data = data.get('revision', 0), data
+
+    def _periods(self, birthday):
+        periods = sorted((eligible_period(birthday, r) + (lid,) for lid, r in self.ranges.items()),
+                         key=lambda p: (p[0] or date.min, p[2]))
+        return periods, [p[0] or date.min for p in periods]
+
+    def _set_family(self, data):
+        # 誕生日が変わった子ども・新しい子どもだけ期間を作り直す
+        birthdays = {}
+        for member in family_members(data):
+            birthday = _birthday(member)
+            if birthday is not None:
+                birthdays[member['id']] = birthday
+        for number, birthday in birthdays.items():
+            if self.birthdays.get(number) != birthday:
+                self.children[number] = self._periods(birthday)
+        for number in set(self.children) - set(birthdays):
+            del self.children[number]
+        self.birthdays = birthdays
+
+    def _put(self, lid, age_range):
+        self.ranges[lid] = age_range
+        for number, birthday in self.birthdays.items():
+            period = eligible_period(birthday, age_range) + (lid,)
+            periods, starts = self.children[number]
+            key = period[0] or date.min
+            pos = bisect_left(starts, key)
+            while pos < len(starts) and starts[pos] == key and periods[pos][2] < lid:
+                pos += 1
+            periods.insert(pos, period)
+            starts.insert(pos, key)
+
+    def _drop(self, lid):
+        age_range = self.ranges.pop(lid, None)
+        if age_range is None:
+            return
+        for number, birthday in self.birthdays.items():
+            periods, starts = self.children[number]
+            pos = bisect_left(starts, eligible_period(birthday, age_range)[0] or date.min)
+            while periods[pos][2] != lid:
+                pos += 1
+            del periods[pos], starts[pos]
+
+    def _count(self, lid, delta):
+        if lid:
+            self._counts[lid] = self._counts.get(lid, 0) + delta
+
+    def _apply(self, op, data):
+        """op を1つ反映する。位置から ID を決められない（ID が重複している）ときは False。"""
+        kind = op['op']
+        if kind in ('lesson_set', 'lesson_unset') and op['field'] in ('memo', 'id'):
+            lid = self._ids[op['index']]
+            value = op.get('value') if kind == 'lesson_set' else None
+            if lid and self._counts.get(lid, 0) > 1:
+                return False
+            if op['field'] == 'memo':
+                self._drop(lid)
+                age_range = parse_age_range(str(value or ''))
+                if lid and age_range:
+                    self._put(lid, age_range)
+                return True
+            if value == lid:
+                return True
+            if value and self._counts.get(value, 0):
+                return False
+            age_range = self.ranges.get(lid)
+            self._drop(lid)
+            self._count(lid, -1)
+            self._count(value, 1)
+            self._ids[op['index']] = value
+            if value and age_range:
+                self._put(value, age_range)
+        elif kind == 'lesson_insert':
+            ids = [lesson.get('id') for lesson in op['lessons']]
+            named = [lid for lid in ids if lid]
+            if len(set(named)) != len(named) or any(self._counts.get(lid, 0) for lid in named):
+                return False
+            self._ids[op['index']:op['index']] = ids
+            for lid, lesson in zip(ids, op['lessons']):
+                self._count(lid, 1)
+                age_range = parse_age_range(str(lesson.get('memo') or ''))
+                if lid and age_range:
+                    self._put(lid, age_range)
+        elif kind == 'lesson_delete':
+            removed = self._ids[op['index']:op['index'] + op['count']]
+            if any(lid and self._counts.get(lid, 0) > 1 for lid in removed):
+                return False
+            del self._ids[op['index']:op['index'] + op['count']]
+            for lid in removed:
+                self._drop(lid)
+                self._count(lid, -1)
+        elif kind == 'renumber' or (kind in ('set', 'unset') and op['key'] == 'lessons'):
+            # 全件の ID の振り直し・習い事の置き換えは作り直す
+            return False
+        elif kind in ('set', 'unset') and op['key'] == 'family':
+            self._set_family(data)
+        return True
+
+    def ensure(self):
+        store.read()  # 開くのは索引のロックの外で（Store を開くときは Store のロックを取る）
+        with self._lock:
+            if self._ids is None:
+                self._build(store.read())
+
+    def update(self, revision, ops, data):
+        """Store の listener。対象年齢・ID・家族に関わる操作だけを索引に反映する。"""
+        with self._lock:
+            # 索引を作る前の commit や、作ったときに取り込み済みの commit は見ない
+            if self._ids is None or revision <= self._revision:
+                return
+            for op in ops:
+                if not self._apply(op, data):
+                    self._build(data)
+                    return
+            self._revision, self._data = revision, data
+
+    def lookup(self, child, on):
+        """on の日に対象年齢内の習い事 ID と、まだ早い・もう過ぎた ID を返す。"""
+        periods, starts = self.children.get(child, ([], []))
+        pos = bisect_right(starts, on)
+        eligible = [p[2] for p in periods[:pos] if p[1] is None or on < p[1]]
+        aged_out = [p[2] for p in periods[:pos] if p[1] is not None and p[1] <= on]
+        not_yet = [{'id': p[2], 'from': p[0].isoformat()} for p in periods[pos:]]
+        return {'eligible': eligible, 'not_yet': not_yet, 'aged_out': aged_out}
+
+    def describe(self):
+        """習い事ごとの対象年齢と子どもごとの通える期間（画面・API用）。"""
+        lessons = {lid: {'from': lower, 'until': upper, 'label': '%s〜%s' % (age_bound_label(lower), age_bound_label(upper))}
+                   for lid, (lower, upper) in self.ranges.items()}
+        children = {number: {p[2]: {'from': p[0] and p[0].isoformat(), 'until': p[1] and p[1].isoformat()} for p in periods}
+                    for number, (periods, _) in self.children.items()}
+        return {'lessons': lessons, 'children': children}
+
+    def report(self, on, child=''):
+        """describe() に on の日の子どもごとの lookup を加え、索引が反映済みの文書と一緒に返す。"""
+        self.ensure()
+        with self._lock:
+            data = self._data
+            # child は呼び名か人の番号。結果は人の番号ごとに返す
+            numbers = [person_index(data).resolve(child)] if child else list(self.children)
+            result = self.describe()
+            result['lookup'] = {number: self.lookup(number, on) for number in numbers if number is not None}
+            return data, result
+
+eligibility_index = EligibilityIndex()
+store.subscribe(eligibility_index.update)
+
+# =========== Pattern Sets ===========
+# パターンの採用 ID を習い事の並び順（序数）のビット列 (int) にして、所属判定・和・積・差を整数演算で行う。
+# 保存形式は従来どおり ids の配列で、ビット列は revision ごとに作り直す。
+def _lesson_fee(lesson):
+    fee = str(lesson.get('fee') or '')
+    return int(fee) if fee.isdigit() else 0
+
+class PatternSets:
+    def __init__(self, data):
+        self.ids, self.ordinals, self.fees = [], {}, []
+        for lesson in data.get('lessons', []):
+            lid = lesson.get('id')
+            if lid and lid not in self.ordinals:
+                self.ordinals[lid] = len(self.ids)
+                self.ids.append(lid)
+                self.fees.append(_lesson_fee(lesson))
+        self.masks = {key: self.mask(pat.get('ids', []))
+                      for key, pat in data.get('patterns', {}).items() if isinstance(pat, dict)}
+
+    def mask(self, ids):
+        bits = bytearray((len(self.ids) + 7) // 8)
+        for lid in ids:
+            o = self.ordinals.get(lid)
+            if o is not None:
+                bits[o >> 3] |= 1 << (o & 7)
+        return int.from_bytes(bits, 'little')
+
+    def members(self, mask):
+        """ビット列に含まれる ID を習い事の並び順で返す。"""
+        result = []
+        while mask:
+            low = mask & -mask
+            result.append(self.ids[low.bit_length() - 1])
+            mask ^= low
+        return result
+
+    def fee(self, mask):
+        return sum(self.fees[self.ordinals[lid]] for lid in self.members(mask))
+
+    def compare(self, base):
+        """base と各パターンの共通・追加・削除の件数と月謝の差。"""
+        base_mask = self.masks[base]
+        base_fee = self.fee(base_mask)
+        result = {}
+        for key, mask in self.masks.items():
+            fee = self.fee(mask)
+            result[key] = {'count': bin(mask).count('1'), 'fee': fee, 'fee_diff': fee - base_fee,
+                           'common': bin(mask & base_mask).count('1'),
+                           'added': self.members(mask & ~base_mask), 'removed': self.members(base_mask & ~mask)}
+        return result
+
+def pattern_sets(data):
+    return index_cache.get('pattern_sets', lambda: PatternSets(data), data)
+
+# =========== Pattern Stats ===========
+# パターンごとの集計（月謝合計・曜日別件数・人物別件数・時間の重なり）を持ち、編集の ops から
+# 影響するパターンだけを捨てる。対象はメンバーの fee/day/start/end/who/repeat の変更と採用の変更。
+PATTERN_STAT_FIELDS = ('id', 'fee', 'day', 'start', 'end', 'who', 'members', 'repeat')
+# 丸ごと置き換わると全パターンの集計を捨てるトップレベルのキー（family は人物別の件数・呼び名の元になる）
+PATTERN_STAT_KEYS = ('lessons', 'patterns', 'family')
+
+def compute_pattern_stats(data, key):
+    by_id, index = lessons_by_id(data), person_index(data)
+    members = [by_id[i] for i in dict.fromkeys(data['patterns'][key].get('ids', [])) if i in by_id]
+    days, people, fee, timed_by_day = dict.fromkeys(DAYS, 0), {}, 0, {}
+    for lesson in members:
+        fee += _lesson_fee(lesson)
+        # 複数人の習い事はそれぞれの人に数える。家族にいない対象は who の文字のまま数える
+        for who in index.names(lesson) or [lesson.get('who') or '']:
+            people[who] = people.get(who, 0) + 1
+        day, start, end = lesson.get('day'), time_to_min(lesson.get('start')), time_to_min(lesson.get('end'))
+        if day in days:
+            days[day] += 1
+            if 0 <= start < end:
+                timed_by_day.setdefault(day, []).append((start, end, lesson['id']))
+    conflicts = []
+    for day, items in timed_by_day.items():
+        items.sort()
+        for i, (start, end, lid) in enumerate(items):
+            for other_start, _, other in items[i + 1:]:
+                if other_start >= end:
+                    break
+                # 隔週・第n週どうしなど、同じ日に開かれないものは重ならない
+                if lessons_overlap(by_id[lid], by_id[other]):
+                    conflicts.append([lid, other, day])
+    return {'count': len(members), 'fee': fee, 'days': days, 'people': people, 'conflicts': conflicts}
+
+class PatternStatsCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._deps = {}
+        self._generation = 0
+
+    def get(self, data, key):
+        if data is not store.read():
+            return compute_pattern_stats(data, key)
+        with self._lock:
+            if key in self._entries:
+                record_timing('cache_hit', 0)
+                return self._entries[key]
+            generation = self._generation
+        stats = compute_pattern_stats(data, key)
+        with self._lock:
+            # 計算中に commit があれば、その ops で捨てられたはずなので入れない
+            if self._generation == generation and data is store.read():
+                self._entries[key] = stats
+                for lid in data['patterns'][key].get('ids', []):
+                    self._deps.setdefault(lid, set()).add(key)
+        return stats
+
+    def invalidate(self, revision, ops, data):
+        """Store の listener。ops が触れた習い事を含むパターンと、変更されたパターンを捨てる。"""
+        lessons = data.get('lessons', [])
+        structural = any(op['op'] in ('lesson_insert', 'lesson_delete') for op in ops)
+        keys, ids, clear = set(), set(), False
+        for op in ops:
+            kind = op['op']
+            if kind in ('set', 'unset'):
+                clear = clear or op['key'] in PATTERN_STAT_KEYS
+            elif kind in ('lesson_set', 'lesson_unset'):
+                if op['field'] not in PATTERN_STAT_FIELDS:
+                    continue
+                # 挿入・削除と同じ ops では index が途中の状態を指すので、位置から ID を引けない
+                if structural or op['index'] >= len(lessons):
+                    clear = True
+                else:
+                    ids.add(lessons[op['index']].get('id'))
+                    if op['field'] == 'id':
+                        ids.add(op.get('value'))
+            elif kind == 'lesson_insert':
+                ids.update(l.get('id') for l in op['lessons'])
+            elif kind == 'lesson_delete':
+                clear = True
+            elif kind == 'renumber':
+                ids.update(op['map'])
+                ids.update(op['map'].values())
+            elif kind.startswith('pattern_'):
+                keys.add(op['key'])
+        with self._lock:
+            self._generation += 1
+            if clear:
+                self._entries, self._deps = {}, {}
+                return
+            for lid in ids:
+                keys |= self._deps.pop(lid, set())
+            for key in keys:
+                self._entries.pop(key, None)
+
+pattern_stats = PatternStatsCache()
+store.subscribe(pattern_stats.invalidate)
+
+# =========== Workload Heatmap ===========
+# 習い事の時間帯を revision ごとに週全体のビット列（15 分枠 7×96 ビットと 1 分単位 7×1440 ビット）にしておく。
+# 人ごとの枠の重なり数はビット列を桁ごとに足す（bit-sliced 加算）ので、習い事 1 件あたり数回の整数演算で済む。
+WORKLOAD_SLOT_MINUTES = 15
+SLOTS_PER_DAY = MINUTES_PER_DAY // WORKLOAD_SLOT_MINUTES
+workload_cache = RevisionCache(256)
+
+class LessonIntervals:
+    def __init__(self, data):
+        self.slots, self.minutes, self.who = {}, {}, {}
+        people = person_index(data)
+        for lesson in data.get('lessons', []):
+            lid, day = lesson.get('id'), lesson.get('day')
+            start, end = time_to_min(lesson.get('start')), time_to_min(lesson.get('end'))
+            if not lid or lid in self.slots or day not in DAYS or not 0 <= start < end <= MINUTES_PER_DAY:
+                continue
+            offset = DAYS.index(day)
+            first, last = start // WORKLOAD_SLOT_MINUTES, (end - 1) // WORKLOAD_SLOT_MINUTES
+            self.slots[lid] = range_mask(first, last + 1) << (offset * SLOTS_PER_DAY)
+            self.minutes[lid] = range_mask(start, end) << (offset * MINUTES_PER_DAY)
+            # 複数人の習い事はそれぞれの人の負荷に入れる（家族にいない対象は who の文字のまま）
+            self.who[lid] = tuple(people.names(lesson)) or (lesson.get('who') or '',)
+
+    def workload(self, ids, who=''):
+        """習い事 ID の集合について、人ごとに 15 分枠ごとの件数（曜日 × 枠）と曜日ごとの拘束時間（分）を返す。"""
+        planes_by_who, minutes_by_who = {}, {}
+        for lid in dict.fromkeys(ids):
+            if lid not in self.slots or (who and who not in self.who[lid]):
+                continue
+            for person in self.who[lid]:
+                if who and person != who:
+                    continue
+                # planes[i] は件数の 2^i の桁。1 件分の枠を繰り上がりつきで足す
+                planes, carry = planes_by_who.setdefault(person, []), self.slots[lid]
+                for i, plane in enumerate(planes):
+                    planes[i], carry = plane ^ carry, plane & carry
+                    if not carry:
+                        break
+                if carry:
+                    planes.append(carry)
+                minutes_by_who[person] = minutes_by_who.get(person, 0) | self.minutes[lid]
+        return {person: _workload_summary(planes, minutes_by_who[person]) for person, planes in planes_by_who.items()}
+
+def _workload_summary(planes, minutes):
+    counts = [0] * (len(DAYS) * SLOTS_PER_DAY)
+    for weight, plane in enumerate(planes):
+        while plane:
+            low = plane & -plane
+            counts[low.bit_length() - 1] += 1 << weight
+            plane ^= low
+    busy = {day: ((minutes >> (i * MINUTES_PER_DAY)) & FULL_DAY_MASK).bit_count() for i, day in enumerate(DAYS)}
+    return {'slots': {day: counts[i * SLOTS_PER_DAY:(i + 1) * SLOTS_PER_DAY] for i, day in enumerate(DAYS)},
+            'busy': busy, 'busy_total': sum(busy.values()), 'peak': max(counts),
+            'overlap_slots': sum(1 for c in counts if c > 1)}
+
+def lesson_intervals(data):
+    return index_cache.get('lesson_intervals', lambda: LessonIntervals(data), data)
+
+def pattern_workload(data, key, who=''):
+    def compute():
+        return lesson_intervals(data).workload(data['patterns'][key].get('ids', []), who)
+    return workload_cache.get((key, who), compute, data)
+
+# =========== Occurrences ===========
+# 習い事は毎週の枠なので、月ごとに実際の日付へ展開して回数と費用を出す。休業日は conditions.closures に
+# 「2026-08-10〜2026-08-16 お盆休み @スイミング」のように 1 行 1 件で書き、@ の後の語があれば
+# 習い事名か教室にその語を含むものだけを休みにする。月ごとの展開は revision ごとにキャッシュする。
+STANDARD_LESSONS_PER_MONTH = 4
+MAX_OCCURRENCE_MONTHS = 36
+_DATE_TOKEN = r'(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?'
+_CLOSURE_RE = re.compile(r'^' + _DATE_TOKEN + r'(?:\s*(?:〜|~|-|から)\s*' + _DATE_TOKEN + r')?(.*)$')
+occurrence_cache = RevisionCache(512)
+
+def _date(year, month, day):
+    try:
+        return date(int(year), int(month), int(day))
+    except ValueError:
+        raise ValueError('日付が正しくありません')
+
+def parse_closures(text):
+    """休業日の行を (開始日, 終了日, 名前, 対象の語) のリストに変換する。"""
+    closures, errors = [], []
+    for line in unicodedata.normalize('NFKC', str(text or '')).splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = _CLOSURE_RE.match(line)
+        if not match:
+            errors.append('日付を読み取れません: %s' % line)
+            continue
+        g = match.groups()
+        try:
+            first = _date(*g[:3])
+            last = _date(*g[3:6]) if g[3] else first
+        except ValueError as e:
+            errors.append('%s: %s' % (e, line))
+            continue
+        if last < first:
+            errors.append('終了日が開始日より前です: %s' % line)
+            continue
+        label, _, scope = g[6].partition('@')
+        closures.append((first, last, label.strip(), scope.strip()))
+    return closures, errors
+
+def parse_month(text):
+    """'2026-04' を (2026, 4) にする。"""
+    match = re.match(r'^(\d{4})-(\d{1,2})$', text or '')
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError('月は YYYY-MM で指定してください: %s' % text)
+    return int(match.group(1)), int(match.group(2))
+
+def add_month(year, month, n=1):
+    index = year * 12 + month - 1 + n
+    return index // 12, index % 12 + 1
+
+def month_range(year, month):
+    following = date(*add_month(year, month), 1)
+    return date(year, month, 1), following - timedelta(days=1)
+
+# =========== Recurrence Rules ===========
+# lesson.repeat で毎週以外の開催を表す（空なら毎週 lesson.day）。
+#   隔週 2026-04-06から / 3週ごと 2026-04-06〜2026-09-30 … 起点の日から N 週ごと
+#   第1・3 / 第2,最終 … 毎月第 n の lesson.day
+#   2026-04-01〜2026-09-30 / 〜2026-09-30 … 期間限定（上と組み合わせられる）
+#   体験 2026-05-10 … その日だけ（単発も同じ）
+# 日付は必要な分だけジェネレーターで出し、重なりの判定は日付を並べずに規則どうしで行う。
+RECURRENCE_OVERLAP_MONTHS = 60
+_DATE_RE = re.compile(_DATE_TOKEN)
+_NTH_RE = re.compile(r'第\s*(?:\d|最終)(?:\s*[・,、と]\s*(?:第\s*)?(?:\d|最終))*|最終')
+_INTERVAL_RE = re.compile(r'隔週|(\d+)\s*週\s*(?:ごと|毎)|毎週')
+_RANGE_AFTER_RE = re.compile(r'^\s*(?:〜|~|-|から)')
+_UNTIL_RE = re.compile(r'^\s*まで')
+
+class Recurrence:
+    def __init__(self, kind, weekday, interval=1, nths=frozenset(), start=None, end=None):
+        self.kind, self.weekday, self.interval, self.nths = kind, weekday, interval, nths
+        self.start, self.end = start, end
+        # N 週ごとの起点は期間の開始日以降で最初の該当曜日
+        self.anchor = start + timedelta(days=(weekday - start.weekday()) % 7) if start and weekday is not None else None
+
+    def label(self):
+        parts = []
+        if self.kind == 'once':
+            return '体験 %d/%d' % (self.start.month, self.start.day)
+        if self.kind == 'nth':
+            numbers = '・'.join(str(n) for n in sorted(self.nths) if n > 0)
+            parts.append('・'.join(filter(None, [numbers and '第' + numbers, '最終' if -1 in self.nths else ''])))
+        elif self.interval == 2:
+            parts.append('隔週')
+        elif self.interval > 2:
+            parts.append('%d週ごと' % self.interval)
+        if self.start or self.end:
+            parts.append('%s〜%s' % (self.start and '%d/%d' % (self.start.month, self.start.day) or '',
+                                    self.end and '%d/%d' % (self.end.month, self.end.day) or ''))
+        return ' '.join(parts) or '毎週'
+
+    def _nth_dates(self, year, month):
+        first, last = month_range(year, month)
+        day = first + timedelta(days=(self.weekday - first.weekday()) % 7)
+        dates = []
+        while day <= last:
+            dates.append(day)
+            day += timedelta(days=7)
+        return sorted({dates[n - 1] if n > 0 else dates[-1] for n in self.nths if n <= len(dates)})
+
+    def contains(self, day):
+        if self.weekday is None or day.weekday() != self.weekday:
+            return False
+        if (self.start and day < self.start) or (self.end and day > self.end):
+            return False
+        if self.kind == 'nth':
+            nth = (day.day - 1) // 7 + 1
+            return nth in self.nths or (-1 in self.nths and (day + timedelta(days=7)).month != day.month)
+        if self.interval > 1:
+            return ((day - self.anchor).days // 7) % self.interval == 0
+        return True
+
+    def iter_dates(self, first, last=None):
+        """first 以降（last まで、None なら終わりなく）の開催日を順に返す。"""
+        if self.weekday is None:
+            return
+        lo = max(first, self.start) if self.start else first
+        hi = min(d for d in (last, self.end) if d) if (last or self.end) else None
+        if hi is not None and lo > hi:
+            return
+        if self.kind == 'nth':
+            year, month = lo.year, lo.month
+            while hi is None or date(year, month, 1) <= hi:
+                for day in self._nth_dates(year, month):
+                    if hi is not None and day > hi:
+                        return
+                    if day >= lo:
+                        yield day
+                year, month = add_month(year, month)
+            return
+        day = lo + timedelta(days=(self.weekday - lo.weekday()) % 7)
+        if self.interval > 1:
+            day += timedelta(weeks=-((day - self.anchor).days // 7) % self.interval)
+        while hi is None or day <= hi:
+            yield day
+            day += timedelta(weeks=self.interval)
+
+WEEKLY = {i: Recurrence('weekly', i) for i in range(len(DAYS))}
+NO_DAY = Recurrence('weekly', None)
+
+@lru_cache(maxsize=4096)
+def parse_recurrence(text, day):
+    """lesson.repeat と曜日から Recurrence を作る。読めなければ ValueError。"""
+    s = unicodedata.normalize('NFKC', str(text or '')).strip()
+    weekday = DAYS.index(day) if day in DAYS else None
+    if not s or s == '毎週':
+        return WEEKLY[weekday] if weekday is not None else NO_DAY
+    start = end = None
+    dates = []
+    for match in _DATE_RE.finditer(s):
+        value = _date(*match.groups())
+        if _RANGE_AFTER_RE.match(s[match.end():]):
+            start = value
+        elif _UNTIL_RE.match(s[match.end():]) or re.search(r'(?:〜|~|-)\s*$', s[:match.start()]):
+            end = value
+        else:
+            dates.append(value)
+    rest = _DATE_RE.sub(' ', s)
+    if '体験' in s or '単発' in s:
+        if len(dates) != 1 or start or end:
+            raise ValueError('体験・単発は日付を1つだけ書いてください')
+        return Recurrence('once', dates[0].weekday(), start=dates[0], end=dates[0])
+    interval, nths = 1, set()
+    for match in _INTERVAL_RE.finditer(rest):
+        interval = 2 if match.group() == '隔週' else int(match.group(1) or 1)
+    for match in _NTH_RE.finditer(rest):
+        nths.update(-1 if n == '最終' else int(n) for n in re.findall(r'\d|最終', match.group()))
+    leftover = re.sub(r'[\s・,、〜~\-]|から|まで|と|の|週|[月火水木金土日]曜?日?', '',_NTH_RE.sub('', _INTERVAL_RE.sub('', rest)))
+    if leftover:
+        raise ValueError('繰り返しを読み取れません: %s' % leftover)
+    if dates:
+        # 日付が 1 つだけなら N 週ごとの起点として扱う
+        if len(dates) > 1 or start:
+            raise ValueError('日付は「開始〜終了」「〜から」「〜まで」の形で書いてください')
+        start = dates[0]
+    if start and end and end < start:
+        raise ValueError('終了日が開始日より前です')
+    if nths and interval > 1:
+        raise ValueError('第n週と隔週は同時に指定できません')
+    if not 1 <= interval <= 8 or any(n > 5 for n in nths) or 0 in nths:
+        raise ValueError('繰り返しの間隔は 8 週まで、第n は 1〜5 か最終で書いてください')
+    if interval > 1 and not start:
+        raise ValueError('隔週・N週ごとは起点の日付を書いてください（例: 隔週 2026-04-06から）')
+    return Recurrence('nth' if nths else 'weekly', weekday, interval, frozenset(nths), start, end)
+
+def lesson_rule(lesson):
+    """習い事の繰り返し規則（読めない repeat は毎週とみなす）。"""
+    try:
+        return parse_recurrence(lesson.get('repeat') or '', lesson.get('day') or '')
+    except ValueError:
+        return parse_recurrence('', lesson.get('day') or '')
+
+def _week_index(day):
+    return day.toordinal() // 7
+
+def rules_overlap(a, b):
+    """2 つの規則に同じ開催日があるか。毎週・N 週ごとどうしは合同式で、第n を含むときは共通の期間を月単位で見る。"""
+    if a.weekday is None or a.weekday != b.weekday:
+        return False
+    lo = max((d for d in (a.start, b.start) if d), default=None)
+    hi = min((d for d in (a.end, b.end) if d), default=None)
+    if lo and hi and lo > hi:
+        return False
+    if a.kind == 'once' or b.kind == 'once':
+        once, other = (a, b) if a.kind == 'once' else (b, a)
+        return other.contains(once.start)
+    if a.kind == 'weekly' and b.kind == 'weekly':
+        # 週番号 w が w ≡ 起点 (mod 間隔) を両方満たすか（中国剰余定理）。期間があれば最初の解が期間内か
+        ra = _week_index(a.anchor) % a.interval if a.anchor else 0
+        rb = _week_index(b.anchor) % b.interval if b.anchor else 0
+        g = gcd(a.interval, b.interval)
+        if (ra - rb) % g:
+            return False
+        if lo is None or hi is None:
+            return True
+        # 解は lcm 週ごとに現れるので、期間の始めから 1 周期だけ見ればよい
+        first = lo + timedelta(days=(a.weekday - lo.weekday()) % 7)
+        for k in range(a.interval * b.interval // g):
+            day = first + timedelta(weeks=k)
+            if day > hi:
+                return False
+            if a.contains(day) and b.contains(day):
+                return True
+        return False
+    monthly, other = (a, b) if a.kind == 'nth' else (b, a)
+    first = lo or (add_months(hi, -RECURRENCE_OVERLAP_MONTHS) if hi else date.today().replace(day=1))
+    last = hi or add_months(first, RECURRENCE_OVERLAP_MONTHS)
+    return any(other.contains(day) for day in monthly.iter_dates(first, last))
+
+def lessons_overlap(a, b):
+    return rules_overlap(lesson_rule(a), lesson_rule(b))
+
+def lesson_dates(lesson, first, last):
+    """習い事の first〜last の開催日（繰り返し規則に従う）。"""
+    return lesson_rule(lesson).iter_dates(first, last)
+
+class OccurrenceCalendar:
+    def __init__(self, data):
+        conditions = data.get('conditions', {})
+        self.closures, self.errors = parse_closures(conditions.get('closures'))
+        self.per_lesson = conditions.get('fee_basis') == 'per_lesson'
+        self._closed = {}
+
+    def closed_dates(self, lesson):
+        """習い事が休みになる日 {日付: 休業日の名前}（習い事名・教室の組ごとに作って使い回す）。"""
+        key = (lesson.get('name') or '', lesson.get('school') or '')
+        if key not in self._closed:
+            closed = {}
+            for first, last, label, scope in self.closures:
+                if scope and scope not in key[0] and scope not in key[1]:
+                    continue
+                for offset in range((last - first).days + 1):
+                    closed.setdefault(first + timedelta(days=offset), label or '休業日')
+            self._closed[key] = closed
+        return self._closed[key]
+
+    def expand(self, lesson, first, last):
+        """first〜last の実施日と、休業日で休みになる日 {日付: 名前} を返す。"""
+        closed = self.closed_dates(lesson)
+        held, skipped = [], {}
+        for day in lesson_dates(lesson, first, last):
+            if day in closed:
+                skipped[day] = closed[day]
+            else:
+                held.append(day)
+        return held, skipped
+
+    def cost(self, lesson, count):
+        # 月謝は月額固定（1 回でもあればその月の月謝）が既定。per_lesson なら月 4 回分として回数で按分する
+        fee = _lesson_fee(lesson)
+        if self.per_lesson:
+            return round(fee * count / STANDARD_LESSONS_PER_MONTH)
+        return fee if count else 0
+
+def occurrence_calendar(data):
+    return index_cache.get('occurrence_calendar', lambda: OccurrenceCalendar(data), data)
+
+def pattern_month(data, key, year, month):
+    """パターンの 1 か月分の実施日（日付・時刻順）と、習い事ごとの回数・費用・休みの日。"""
+    def compute():
+        calendar = occurrence_calendar(data)
+        first, last = month_range(year, month)
+        by_id = lessons_by_id(data)
+        occurrences, lessons, cost, skipped = [], {}, 0, 0
+        for lid in dict.fromkeys(data['patterns'][key].get('ids', [])):
+            lesson = by_id.get(lid)
+            if lesson is None:
+                continue
+            held, closed = calendar.expand(lesson, first, last)
+            lesson_cost = calendar.cost(lesson, len(held))
+            lessons[lid] = {'count': len(held), 'cost': lesson_cost,
+                            'skipped': [[d.isoformat(), label] for d, label in sorted(closed.items())]}
+            cost += lesson_cost
+            skipped += len(closed)
+            occurrences.extend((d, lesson.get('start') or '', lid) for d in held)
+        occurrences.sort()
+        return {'month': '%04d-%02d' % (year, month), 'count': len(occurrences), 'cost': cost, 'skipped': skipped,
+                'lessons': lessons,
+                'occurrences': [dict(date=d.isoformat(), day=by_id[lid].get('day'), start=start,
+                                     end=by_id[lid].get('end') or '', id=lid, name=by_id[lid].get('name', ''),
+                                     who=by_id[lid].get('who', '')) for d, start, lid in occurrences]}
+    return occurrence_cache.get((key, year, month), compute, data)
+
+# =========== Lesson IDs ===========
+# 習い事 ID は「対象-分類の文字+連番」（例: 花子-B03）。(対象, 分類の文字) ごとに使った連番の最大値を持ち、
+# 全件を走査せずに払い出す。最大値は減らさないので、払い出し後に保存される前の ID とも重ならない。
+CATEGORY_MAP = (('幼児教室', 'A'), ('スイミング', 'B'), ('水泳', 'B'), ('ピアノ', 'C'))
+LESSON_ID_RE = re.compile(r'^(.+)-([A-Z])(\d+)$')
+_FREE_LETTERS = [c for c in 'DEFGHIJKLMNOPQRSTUVWXYZ' if c not in {letter for _, letter in CATEGORY_MAP}]
+
+def _category_base(name):
+    return re.split(r'[（(]', name)[0]
+
+def unknown_categories(data):
+    """CATEGORY_MAP にない習い事名（括弧より前）を一覧に出てくる順に返す。"""
+    def compute():
+        names = [l['name'] for l in data.get('lessons', []) if l.get('name')]
+        return list(dict.fromkeys(_category_base(n) for n in names if not any(p in n for p, _ in CATEGORY_MAP)))
+    return index_cache.get('unknown_categories', compute, data)
+
+def category_letter(data, name):
+    """習い事名から分類の文字を決める（未知の分類は一覧の出現順に D, E, ... を割り当てる）。"""
+    if not name:
+        return 'Z'
+    for pattern, letter in CATEGORY_MAP:
+        if pattern in name:
+            return letter
+    unknown = unknown_categories(data)
+    base = _category_base(name)
+    index = unknown.index(base) if base in unknown else len(unknown)
+    return _FREE_LETTERS[index] if index < len(_FREE_LETTERS) else 'Z'
+
+def format_lesson_id(person, letter, number):
+    return '%s-%s%02d' % (person, letter, number)
+
+class LessonIdAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = None
+
+    def _observe(self, lesson_id):
+        match = LESSON_ID_RE.match(lesson_id or '')
+        if match:
+            key = (match.group(1), match.group(2))
+            self._counters[key] = max(self._counters.get(key, 0), int(match.group(3)))
+
+    def allocate(self, who, name, count=1):
+        data = store.read()
+        key = (who or '_', category_letter(data, name))
+        with self._lock:
+            if self._counters is None:
+                # 最大値はこのロックの中で読んだ文書から作る。ロックの外で読んだ文書からだと、読んでからロックを取るまでの
+                # commit は update が（counters が未作成なので）素通りしていて取りこぼす。ロックの中で読んだ後の commit は
+                # update がこのロックを待ってから取り込む（store は上で開いてあるので、ここで store のロックは取らない）
+                self._counters = {}
+                for lesson in store.read().get('lessons', []):
+                    self._observe(lesson.get('id'))
+            start = self._counters.get(key, 0) + 1
+            self._counters[key] = start + count - 1
+        return [format_lesson_id(key[0], key[1], n) for n in range(start, start + count)]
+
+    def update(self, revision, ops, data):
+        """Store の listener。手入力やインポートで保存された ID の連番を最大値に取り込む。"""
+        with self._lock:
+            if self._counters is None:
+                return
+            for op in ops:
+                kind = op['op']
+                if kind == 'lesson_set' and op['field'] == 'id':
+                    self._observe(op['value'])
+                elif kind == 'lesson_insert':
+                    for lesson in op['lessons']:
+                        self._observe(lesson.get('id'))
+                elif kind == 'renumber':
+                    for _, new_id in op['ids']:
+                        self._observe(new_id)
+                elif kind == 'set' and op['key'] == 'lessons':
+                    for lesson in op['value']:
+                        self._observe(lesson.get('id'))
+
+lesson_ids = LessonIdAllocator()
+store.subscribe(lesson_ids.update)
+
+def renumber_op(data):
+    """一覧の順に (対象, 分類) ごとの連番を振り直す 'renumber' 操作を作る（変更がなければ None）。"""
+    counters, ids, id_map = {}, [], {}
+    for index, lesson in enumerate(data.get('lessons', [])):
+        key = (lesson.get('who') or '_', category_letter(data, lesson.get('name')))
+        counters[key] = counters.get(key, 0) + 1
+        new_id = format_lesson_id(key[0], key[1], counters[key])
+        old_id = lesson.get('id')
+        if old_id != new_id:
+            ids.append([index, new_id])
+            if old_id:
+                id_map[old_id] = new_id
+    return {'op': 'renumber', 'ids': ids, 'map': id_map} if ids else None
+
+def renumber_lessons(attempts=3):
+    """全ての ID を振り直し、パターンの参照も同じ対応表で書き換えて 1 回の commit にする。"""
+    for _ in range(attempts):
+        data = store.read()
+        op = renumber_op(data)
+        if op is None:
+            return data['revision'], data['revision'], None
+        # 計算中に他の編集が入っていたら commit_ops が None を返すので、最新の文書で計算し直す
+        result = store.commit_ops([op], data['revision'])
+        if result is not None:
+            return data['revision'], result[0], op
+    return None
+
+# =========== Lesson Search ===========
+# name・school・address・memo を正規化（NFKC・小文字・カタカナ→ひらがな）して 2-gram の転置索引を持つ。
+# 形態素解析なしで日本語を部分一致で引ける。末尾に番兵を足すので 1 文字の語も「その文字で始まる 2-gram」で引ける。
+# 編集は ops から該当する習い事だけ索引し直す。
+SEARCH_FIELDS = (('name', 3), ('school', 2), ('address', 1), ('memo', 1))
+SEARCH_FIELD_NAMES = tuple(field for field, _ in SEARCH_FIELDS)
+SEARCH_MAX_LIMIT = 1000
+_KANA_FOLD = {c: c - 0x60 for c in range(0x30a1, 0x30f7)}
+
+def normalize_search_text(text):
+    return unicodedata.normalize('NFKC', str(text or '')).lower().translate(_KANA_FOLD)
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+class LessonSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = None       # 位置 → 文書番号
+        self._fields = {}       # 文書番号 → 正規化した (name, school, address, memo)
+        self._postings = {}     # 2-gram → 文書番号の集合
+        self._by_char = {}      # 1 文字目 → 2-gram の集合
+        self._positions = None  # 文書番号 → 位置（挿入・削除で作り直す）
+        self._next_doc = 0
+        self._revision = -1
+        self._data = None
+
+    def _grams(self, doc):
+        grams = set()
+        for text in self._fields[doc]:
+            grams |= _bigrams(text + '\0')
+        return grams
+
+    def _add(self, doc, fields):
+        self._fields[doc] = fields
+        for gram in self._grams(doc):
+            self._postings.setdefault(gram, set()).add(doc)
+            self._by_char.setdefault(gram[0], set()).add(gram)
+
+    def _remove(self, doc):
+        for gram in self._grams(doc):
+            docs = self._postings[gram]
+            docs.discard(doc)
+            if not docs:
+                del self._postings[gram]
+                self._by_char[gram[0]].discard(gram)
+        return self._fields.pop(doc)
+
+    def _insert(self, position, lessons):
+        docs = list(range(self._next_doc, self._next_doc + len(lessons)))
+        self._next_doc += len(lessons)
+        for doc, lesson in zip(docs, lessons):
+            self._add(doc, tuple(normalize_search_text(lesson.get(f)) for f in SEARCH_FIELD_NAMES))
+        self._docs[position:position] = docs
+        self._positions = None
+
+    def _build(self, data):
+        self._docs, self._fields, self._postings, self._by_char = [], {}, {}, {}
+        self._insert(0, data.get('lessons', []))
+        self._revision, self._data = data['revision'], data
+
+    def ensure(self):
+        with self._lock:
+            if self._docs is None:
+                self._build(store.read())
+
+    def update(self, revision, ops, data):
+        """Store の listener。検索対象の項目の変更・挿入・削除だけを索引に反映する。"""
+        with self._lock:
+            # 索引を作る前の commit や、作ったときに取り込み済みの commit は見ない
+            if self._docs is None or revision <= self._revision:
+                return
+            for op in ops:
+                kind = op['op']
+                if kind in ('lesson_set', 'lesson_unset') and op['field'] in SEARCH_FIELD_NAMES:
+                    doc = self._docs[op['index']]
+                    fields = list(self._remove(doc))
+                    fields[SEARCH_FIELD_NAMES.index(op['field'])] = normalize_search_text(op.get('value'))
+                    self._add(doc, tuple(fields))
+                elif kind == 'lesson_insert':
+                    self._insert(op['index'], op['lessons'])
+                elif kind == 'lesson_delete':
+                    for doc in self._docs[op['index']:op['index'] + op['count']]:
+                        self._remove(doc)
+                    del self._docs[op['index']:op['index'] + op['count']]
+                    self._positions = None
+                elif kind in ('set', 'unset') and op['key'] == 'lessons':
+                    self._build(data)
+                    return
+            self._revision, self._data = revision, data
+
+    def _term_docs(self, term):
+        if len(term) == 1:
+            docs = set()
+            for gram in self._by_char.get(term, ()):
+                docs |= self._postings[gram]
+            return docs
+        postings = sorted((self._postings.get(gram, set()) for gram in _bigrams(term)), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def search(self, query, limit):
+        """空白区切りの語をすべて含む習い事を、関連度の高い順に (文書, 件数, [(位置, 点数, 一致した項目)]) で返す。"""
+        terms = normalize_search_text(query).split()
+        self.ensure()
+        with self._lock:
+            candidates = None
+            for term in sorted(terms, key=len, reverse=True):
+                docs = self._term_docs(term)
+                candidates = docs if candidates is None else candidates & docs
+                if not candidates:
+                    break
+            if self._positions is None:
+                self._positions = {doc: i for i, doc in enumerate(self._docs)}
+            positions, scored = self._positions, []
+            for doc in candidates or ():
+                # 2-gram がそろっていても連続していないことがあるので、実際に含むかを確かめて点数をつける
+                fields, score = self._fields[doc], 0
+                for term in terms:
+                    best = 0
+                    for (_, weight), text in zip(SEARCH_FIELDS, fields):
+                        if term in text:
+                            best = max(best, weight * 2 if text.startswith(term) else weight)
+                    if not best:
+                        break
+                    score += best
+                else:
+                    scored.append((-score, positions[doc], doc))
+            hits = []
+            for score, position, doc in heapq.nsmallest(limit, scored):
+                matched = [field for field, text in zip(SEARCH_FIELD_NAMES, self._fields[doc]) if any(t in text for t in terms)]
+                hits.append((position, -score, matched))
+            return self._data, len(scored), hits
+
+lesson_search = LessonSearchIndex()
+store.subscribe(lesson_search.update)
+
+# =========== Calendar Fragments ===========
+# パターン画面のカレンダー（7〜22時、1時間 64px）をサーバーで HTML にして、revision ごとに LRU で持つ。
+# 画面側の描画と同じ配置・クラス名で出力する。
+CALENDAR_PX_PER_HOUR = 64
+CALENDAR_MIN_HOUR, CALENDAR_MAX_HOUR = 7, 22
+calendar_cache = RevisionCache(128)
+
+def who_style(index, lesson):
+    """予定の色のクラスと CSS 変数。複数人なら背景を人数分の帯に分け、右端の線を最後の人の色にする。"""
+    ids = index.member_ids(lesson)
+    if not ids:
+        return 'who-none', ''
+    colors = [member_colors(i) for i in ids]
+    if len(colors) == 1:
+        return 'who-member', '--who:%s;--who-bg:%s;--who-text:%s;' % colors[0]
+    width = 100 / len(colors)
+    bands = ', '.join('%s %s%% %s%%' % (bg, _css_num(i * width), _css_num((i + 1) * width)) for i, (_, bg, _) in enumerate(colors))
+    return 'who-member who-multi', ('--who:%s;--who-edge:%s;--who-bg:linear-gradient(135deg, %s);--who-text:#555;'
+                                    % (colors[0][0], colors[-1][0], bands))
+
+def who_icons(index, lesson):
+    return ''.join(index.by_id[i].get('icon') or '' for i in index.member_ids(lesson))
+
+def _css_num(value):
+    # JavaScript のテンプレート文字列と同じ数値表記（整数は小数点なし）
+    return str(int(value)) if value == int(value) else repr(value)
+
+def layout_day_events(lessons):
+    """1日分の習い事を開始順に並べ、重なるもの同士で横幅を分けた (習い事, 開始分, 終了分, style) を返す。"""
+    events = sorted(((time_to_min(l.get('start')), time_to_min(l.get('end')), l) for l in lessons), key=lambda e: e[0])
+    result = []
+    for start, end, lesson in events:
+        group = [e for e in events if e[0] < end and e[1] > start]
+        style = ''
+        if len(group) > 1:
+            width = 100 / len(group)
+            left = next(i for i, e in enumerate(group) if e[2] is lesson) * width
+            style = 'left:calc(%s%% + 2px);right:calc(%s%% + 2px);' % (_css_num(left), _css_num(100 - left - width))
+        result.append((lesson, start, end, style))
+    return result
+
+def render_calendar(data, key, days, who=''):
+    by_id, people = lessons_by_id(data), person_index(data)
+    person = people.resolve(who) if who else None
+    by_day = {}
+    for lid in dict.fromkeys(data['patterns'][key].get('ids', [])):
+        lesson = by_id.get(lid)
+        if not lesson or not lesson.get('day') or not 0 <= time_to_min(lesson.get('start')) <= time_to_min(lesson.get('end')):
+            continue
+        if who and person not in people.member_ids(lesson):
+            continue
+        by_day.setdefault(lesson['day'], []).append(lesson)
+    px, min_h, max_h = CALENDAR_PX_PER_HOUR, CALENDAR_MIN_HOUR, CALENDAR_MAX_HOUR
+    grid_h = (max_h - min_h) * px
+    out = ['<div class="schedule-wrapper"><div class="cal-grid" style="grid-template-columns:54px repeat(%d, 1fr);'
+           'grid-template-rows:auto %dpx;min-width:%dpx">' % (len(days), grid_h, max(200, len(days) * 100 + 54)),
+           '<div class="cal-header" style="background:var(--pattern-color)"></div>']
+    out.extend('<div class="cal-header" style="background:var(--pattern-color)">%s</div>' % d for d in days)
+    out.append('<div class="cal-time-labels" style="position:relative;">')
+    for h in range(min_h, max_h):
+        out.append('<div class="cal-time-label" style="position:absolute;top:%dpx;left:0;right:0;height:%dpx;">%d:00</div>'
+                   % ((h - min_h) * px, px, h))
+    out.append('</div>')
+    hour_lines = ''.join('<div class="cal-hour-line" style="top:%dpx;"></div>' % ((h - min_h) * px) for h in range(min_h, max_h))
+    for d in days:
+        out.append('<div class="cal-day-col" style="position:relative;height:%dpx;">' % grid_h + hour_lines)
+        for lesson, start, end, overlap in layout_day_events(by_day.get(d, [])):
+            top = (start / 60 - min_h) * px
+            height = max((end - start) / 60 * px, 24)
+            cal_cls, colors = who_style(people, lesson)
+            fee = _lesson_fee(lesson)
+            tooltip = '[%s] %s\n対象: %s\n時間: %s〜%s' % (lesson.get('id'), lesson.get('name', ''), lesson.get('who', ''),
+                                                       lesson['start'], lesson['end'])
+            tooltip += ''.join('\n%s: %s' % (label, value) for label, value in
+                               (('教室', lesson.get('school')), ('場所', lesson.get('address')),
+                                ('月謝', fee and '{:,}円'.format(fee)), ('メモ', lesson.get('memo'))) if value)
+            out.append('<div class="cal-event %s" style="top:%spx;height:%spx;%s%s" title="%s">'
+                       % (cal_cls, _css_num(top), _css_num(height), overlap, colors, html_escape(tooltip)))
+            school = '【%s】' % lesson['school'] if lesson.get('school') else ''
+            out.append('<div class="cal-event-name">%s</div>' % html_escape('%s %s%s' % (lesson['id'], lesson.get('name', ''), school)))
+            if height >= 34:
+                out.append('<div class="cal-event-who">%s %s</div>' % (who_icons(people, lesson), html_escape(lesson.get('who') or '')))
+            if height >= 56:
+                out.append('<div class="cal-event-detail">%s〜%s</div>' % (html_escape(lesson['start']), html_escape(lesson['end'])))
+            out.append('</div>')
+        out.append('</div>')
+    out.append('</div></div>')
+    return ''.join(out)
+
+# =========== Service Worker ===========
+# 画面（/）はキャッシュから即表示して裏で更新し、読み取り系 API はネットワーク優先・失敗時はキャッシュ。
+SERVICE_WORKER_JS = """
+const SHELL_CACHE = 'family-schedule-shell-__VERSION__';
+const API_CACHE = 'family-schedule-api';
+// API の応答はクエリごとに別のエントリになるので、古いものから消して件数を抑える
+const API_CACHE_MAX_ENTRIES = 60;
+
+function trimCache(cache) {
+  // keys() は追加順（同じ URL を入れ直すと末尾に回る）
+  return cache.keys().then(keys => Promise.all(keys.slice(0, Math.max(0, keys.length - API_CACHE_MAX_ENTRIES)).map(k => cache.delete(k))));
+}
+
+self.addEventListener('install', e => {
+  e.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.add('/')).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', e => {
+  e.waitUntil(caches.keys()
+    .then(keys => Promise.all(keys.filter(k => k.startsWith('family-schedule-shell-') && k !== SHELL_CACHE).map(k => caches.delete(k))))
+    .then(() => self.clients.claim()));
+});
+
+self.addEventListener('fetch', e => {
+  const req = e.request;
+  const url = new URL(req.url);
+  if (req.method !== 'GET' || url.origin !== self.location.origin) return;
+  if (url.pathname === '/api/events' || url.pathname.endsWith('.ics') || url.pathname.startsWith('/api/lessons/export')) return;
+  if (req.mode === 'navigate' || url.pathname === '/') {
+    e.respondWith(caches.open(SHELL_CACHE).then(cache => cache.match('/').then(cached => {
+      const fresh = fetch(req).then(res => {
+        if (res.ok) cache.put('/', res.clone());
+        return res;
+      });
+      if (cached) {
+        e.waitUntil(fresh.catch(() => null));
+        return cached;
+      }
+      return fresh;
+    })));
+  } else if (url.pathname.startsWith('/api/')) {
+    e.respondWith(fetch(req).then(res => {
+      if (res.ok) {
+        const copy = res.clone();
+        caches.open(API_CACHE).then(cache => cache.put(req, copy).then(() => trimCache(cache)));
+      }
+      return res;
+    }).catch(() => caches.match(req).then(cached => cached || Promise.reject(new Error('offline')))));
+  }
+});
+"""
+
 HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="ja">
@@ -109,10 +3030,10 @@ HTML_TEMPLATE = """
   --text-sub: #777;
   --accent: #3b6cb4;
   --accent-light: #e8f0fe;
-  --sister: #ff9a5c;
-  --sister-bg: #fff3eb;
-  --brother: #4ecdc4;
-  --brother-bg: #e6faf8;
+  /* 人ごとの色は要素に --who / --who-bg / --who-text を入れて使う（ここは対象なしの色） */
+  --who: #b0b0b0;
+  --who-bg: #f3f3f3;
+  --who-text: #666;
   --eqwel: #b07cd8;
   --eqwel-bg: #f3eafa;
   --swimming: #5b9bd5;
@@ -125,9 +3046,6 @@ HTML_TEMPLATE = """
   --border: #e8e5e0;
   --shadow: 0 2px 12px rgba(0,0,0,0.06);
   --radius: 12px;
-  --pattern-a: #3b6cb4;
-  --pattern-b: #27ae60;
-  --pattern-c: #e67e22;
 }
 * { margin:0; padding:0; box-sizing:border-box; }
 body {
@@ -276,10 +3194,9 @@ body {
   border-radius: 20px;
   font-size: 0.75rem;
   font-weight: 700;
+  background: var(--who-bg);
+  color: var(--who);
 }
-.lesson-who.sister { background: var(--sister-bg); color: var(--sister); }
-.lesson-who.brother { background: var(--brother-bg); color: var(--brother); }
-.lesson-who.both { background: linear-gradient(90deg, var(--sister-bg), var(--brother-bg)); color: #555; }
 .lesson-status {
   margin-left: auto;
   padding: 2px 10px;
@@ -379,6 +3296,7 @@ body {
 .lesson-table .col-who { width: 100px; }
 .lesson-table .col-day { width: 58px; }
 .lesson-table .col-time { width: 80px; }
+.lesson-table .col-repeat { width: 110px; }
 .lesson-table .col-fee { width: 72px; }
 .lesson-table .col-status { width: 84px; }
 .lesson-table .col-url { min-width: 50px; text-align: center; }
@@ -452,10 +3370,9 @@ body {
   font-size: 0.72rem;
   font-weight: 700;
   white-space: nowrap;
+  background: var(--who-bg);
+  color: var(--who);
 }
-.who-badge.sister { background: var(--sister-bg); color: var(--sister); }
-.who-badge.brother { background: var(--brother-bg); color: var(--brother); }
-.who-badge.both { background: linear-gradient(90deg, var(--sister-bg), var(--brother-bg)); color: #555; }
 
 /* Calendar-style schedule */
 .schedule-wrapper { overflow-x: auto; }
@@ -532,9 +3449,8 @@ body {
 .cal-event.piano { background: var(--piano-bg); color: var(--piano); border-left: 3px solid var(--piano); }
 .cal-event.other { background: #f5f5f5; color: #666; border-left: 3px solid #bbb; }
 /* Who-based coloring for calendar events */
-.cal-event.who-sister { background: var(--sister-bg); color: #c05a20; border-left: 4px solid var(--sister); }
-.cal-event.who-brother { background: var(--brother-bg); color: #2a9d8f; border-left: 4px solid var(--brother); }
-.cal-event.who-both { background: linear-gradient(135deg, var(--sister-bg) 50%, var(--brother-bg) 50%); color: #555; border-left: 4px solid var(--sister); border-right: 4px solid var(--brother); }
+.cal-event.who-member, .cal-event.who-none { background: var(--who-bg); color: var(--who-text); border-left: 4px solid var(--who); }
+.cal-event.who-multi { border-right: 4px solid var(--who-edge); }
 .cal-event-name { font-weight: 700; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
 .cal-event-detail { font-size: 0.65rem; opacity: 0.85; }
 .cal-event-who {
@@ -546,9 +3462,8 @@ body {
 }
 .who-dot {
   width: 7px; height: 7px; border-radius: 50%; flex-shrink: 0;
+  background: var(--who);
 }
-.who-dot.sister { background: var(--sister); }
-.who-dot.brother { background: var(--brother); }
 /* Overlap: shift horizontally */
 .cal-event.overlap-1 { right: 52%; }
 .cal-event.overlap-2 { left: 52%; }
@@ -556,6 +3471,7 @@ body {
 /* Pattern sub-tabs */
 .pattern-tabs {
   display: flex;
+  flex-wrap: wrap;
   gap: 0;
   margin-bottom: 20px;
   border-radius: var(--radius);
@@ -563,7 +3479,7 @@ body {
   border: 2px solid var(--border);
 }
 .pattern-tab {
-  flex: 1;
+  flex: 1 1 120px;
   padding: 12px 8px;
   text-align: center;
   font-size: 0.9rem;
@@ -578,9 +3494,8 @@ body {
 }
 .pattern-tab:not(:last-child) { border-right: 1.5px solid var(--border); }
 .pattern-tab:hover { background: var(--accent-light); }
-.pattern-tab.active-a { background: var(--pattern-a); color: white; }
-.pattern-tab.active-b { background: var(--pattern-b); color: white; }
-.pattern-tab.active-c { background: var(--pattern-c); color: white; }
+.pattern-tab.active { background: var(--pattern-color); color: white; }
+.pattern-tab.add { flex: 0 0 56px; font-size: 1.1rem; }
 
 /* Pattern comparison */
 .patterns-grid {
@@ -602,9 +3517,12 @@ body {
   align-items: center;
   gap: 8px;
 }
-.pattern-header.a { background: var(--pattern-a); }
-.pattern-header.b { background: var(--pattern-b); }
-.pattern-header.c { background: var(--pattern-c); }
+.pattern-header { background: var(--pattern-color); }
+.pattern-toolbar { display: flex; gap: 6px; align-items: center; flex-wrap: wrap; margin-bottom: 10px; font-size: 0.8rem; color: var(--text-sub); }
+.pattern-toolbar select { padding: 3px 6px; font-size: 0.8rem; }
+.pattern-compare { width: 100%; border-collapse: collapse; font-size: 0.8rem; margin-top: 12px; }
+.pattern-compare th, .pattern-compare td { padding: 4px 8px; border-bottom: 1px solid var(--border); text-align: right; }
+.pattern-compare th:first-child, .pattern-compare td:first-child { text-align: left; }
 .pattern-body { padding: 16px; }
 .pattern-ids {
   display: flex;
@@ -716,6 +3634,20 @@ body {
 .stat-label { font-size: 0.7rem; color: var(--text-sub); }
 .stat-num.warn { color: #e74c3c; }
 
+/* Availability */
+.pattern-chip.out-of-window { opacity: 0.5; text-decoration: line-through; }
+.pattern-chip.out-of-window.selected { opacity: 1; outline: 2px solid #e74c3c; }
+.availability-errors { color: #e74c3c; font-size: 0.8rem; margin-top: 8px; }
+
+/* Travel warnings */
+.travel-warnings { margin-top: 10px; font-size: 0.8rem; }
+.travel-warning { padding: 4px 8px; border-radius: 6px; margin-top: 4px; }
+.travel-warning.impossible { background: #fde8e8; color: #e74c3c; }
+.travel-warning.over_limit { background: #fff5e0; color: #b9770e; }
+.travel-warning.unknown { background: #f5f5f5; color: var(--text-sub); }
+.travel-row { display: flex; gap: 8px; align-items: center; margin-bottom: 6px; flex-wrap: wrap; }
+.travel-row select, .travel-row input { padding: 6px 8px; border: 1px solid var(--border); border-radius: 6px; font-family: inherit; }
+
 /* Day filter buttons */
 .day-filter {
   display: flex;
@@ -779,6 +3711,30 @@ body {
 .day-count-item.has-items { background: var(--accent-light); }
 .day-count-item.overload { background: #fde8e8; color: #e74c3c; }
 
+/* Workload heatmap */
+.workload { margin-top: 12px; }
+.workload-title { font-size: 0.82rem; font-weight: 700; margin-bottom: 6px; }
+.workload-person { margin-bottom: 10px; }
+.workload-name { font-size: 0.8rem; font-weight: 700; margin-bottom: 4px; }
+.workload-name span { font-weight: 400; color: var(--text-sub); margin-left: 6px; }
+.workload-grid { display: grid; gap: 1px; font-size: 0.68rem; align-items: center; }
+.workload-hour { color: var(--text-sub); }
+.workload-day { text-align: center; }
+.workload-busy { color: var(--text-sub); padding-left: 6px; white-space: nowrap; }
+.workload-cell { height: 14px; background: #f3f1ee; }
+.workload-cell.l1 { background: #a8c7fa; }
+.workload-cell.l2 { background: #f5a7a0; }
+.workload-cell.l3 { background: #e74c3c; }
+
+/* Monthly cost */
+.monthly-cost { margin-top: 12px; }
+.monthly-grid { display: grid; grid-template-columns: repeat(auto-fill, minmax(64px, 1fr)); gap: 4px; }
+.monthly-item { text-align: center; padding: 6px 2px; border-radius: 6px; background: var(--accent-light); font-size: 0.72rem; }
+.monthly-item.has-closure { background: #fff4e0; }
+.monthly-item .count { font-weight: 700; font-size: 0.95rem; }
+.monthly-label, .monthly-fee { color: var(--text-sub); }
+.monthly-total { margin-top: 6px; font-size: 0.8rem; text-align: right; }
+
 /* Person filter */
 .person-filter {
   display: flex;
@@ -804,13 +3760,31 @@ body {
 .person-filter-btn:not(:last-child) { border-right: 1.5px solid var(--border); }
 .person-filter-btn:hover { background: var(--accent-light); }
 .person-filter-btn.active-all { background: var(--accent); color: white; }
-.person-filter-btn.active-sister { background: var(--sister); color: white; }
-.person-filter-btn.active-brother { background: var(--brother); color: white; }
+.person-filter-btn.active-member { background: var(--who); color: white; }
 .person-filter-btn .person-count {
   font-size: 0.72rem;
   opacity: 0.85;
   display: block;
 }
+.who-picker { display: flex; flex-wrap: wrap; gap: 3px; min-width: 90px; }
+.who-pick {
+  padding: 2px 6px;
+  border: 1.5px solid var(--border);
+  border-radius: 12px;
+  background: var(--card);
+  color: var(--text-sub);
+  font-size: 0.72rem;
+  cursor: pointer;
+  white-space: nowrap;
+  font-family: inherit;
+}
+.who-pick.on { background: var(--who-bg); border-color: var(--who); color: var(--who-text); font-weight: 700; }
+
+/* Age filter */
+.age-filter { display: flex; align-items: center; gap: 8px; flex-wrap: wrap; margin-bottom: 10px; font-size: 0.82rem; color: var(--text-sub); }
+.age-filter input { margin-left: 4px; }
+.lesson-search { display: flex; align-items: center; gap: 8px; margin-bottom: 10px; font-size: 0.82rem; color: var(--text-sub); }
+.lesson-search input { flex: 1; max-width: 360px; padding: 6px 10px; border: 1.5px solid var(--border); border-radius: 8px; font-size: 0.85rem; }
 
 @media (max-width: 768px) {
   .app-header { padding: 16px; }
@@ -851,6 +3825,17 @@ body {
         同じ習い事でも曜日や教室が違う選択肢は、別々に登録してください
       </p>
       <div class="person-filter" id="person-filter"></div>
+      <div class="lesson-search">
+        <input type="search" id="lesson-search" placeholder="🔍 習い事名・教室・住所・備考で検索（空白区切りで絞込）" oninput="setLessonSearch(this.value)">
+        <span id="lesson-search-count"></span>
+      </div>
+      <div class="age-filter">
+        <label>🎂 対象年齢で絞込（この日に通える）:
+          <input type="date" id="age-filter-date" onchange="setAgeFilter(this.value)">
+        </label>
+        <button class="day-filter-reset" onclick="setAgeFilter(new Date().toISOString().slice(0, 10))">今日</button>
+        <button class="day-filter-reset" onclick="setAgeFilter('')">解除</button>
+      </div>
       <div class="lesson-table-wrap">
         <table class="lesson-table" id="lessons-table"></table>
       </div>
@@ -858,6 +3843,9 @@ body {
         <button class="add-btn" style="flex:1;margin:0;" onclick="addLesson()">＋ 習い事候補を追加</button>
         <button class="csv-btn" onclick="renumberAllIds()">🔄 ID振り直し</button>
         <button class="csv-btn" onclick="exportCSV()">📥 CSV出力</button>
+        <button class="csv-btn" onclick="exportCSV('xlsx')">📊 Excel出力</button>
+        <button class="csv-btn" onclick="document.getElementById('csv-import-file').click()">📤 CSV取込</button>
+        <input type="file" id="csv-import-file" accept=".csv,text/csv" style="display:none" onchange="importCSV(this)">
       </div>
     </div>
   </div>
@@ -907,6 +3895,33 @@ body {
           <input type="text" id="cond-papa" placeholder="例: 土日のみ" onchange="saveConditions()">
         </div>
       </div>
+      <div class="availability-errors" id="availability-errors"></div>
+      <div class="form-grid" style="margin-top:12px;">
+        <div class="form-group">
+          <label>休業日（1行に1件。@の後に習い事名・教室名を書くとそれだけ休み）</label>
+          <textarea id="cond-closures" rows="4" placeholder="例: 2026-08-10〜2026-08-16 お盆休み @スイミング&#10;2026-12-29〜2027-01-03 年末年始" onchange="saveConditions()"></textarea>
+        </div>
+        <div class="form-group">
+          <label>月ごとの費用の計算</label>
+          <select id="cond-fee-basis" onchange="saveConditions()">
+            <option value="monthly">月謝は月額固定（休業で0回の月は0円）</option>
+            <option value="per_lesson">回数で按分（月謝を月4回分とみなす）</option>
+          </select>
+        </div>
+      </div>
+      <div class="availability-errors" id="closure-errors"></div>
+    </div>
+    <div class="card">
+      <div class="card-title">🚗 教室間の移動時間</div>
+      <p style="color:var(--text-sub);font-size:0.85rem;margin-bottom:12px;">
+        教室の組み合わせごとに片道の移動時間（分）を入力してください。逆方向が未入力なら同じ時間とみなします。
+      </p>
+      <div id="travel-list"></div>
+      <button class="add-btn" onclick="addTravel()">＋ 移動時間を追加</button>
+      <label style="display:flex;gap:6px;align-items:center;margin-top:12px;font-size:0.85rem;">
+        <input type="checkbox" id="cond-travel-strict" onchange="saveConditions()">
+        移動が間に合わない組み合わせはパターンに追加できないようにする
+      </label>
     </div>
   </div>
 
@@ -1036,6 +4051,7 @@ function getCategoryLetter(lessonName) {
   return 'Z';
 }
 
+// サーバーに繋がらないときだけ手元の一覧から採番する
 function generateLessonId(who, lessonName, excludeIdx) {
   const personPrefix = who || '_';
   const catLetter = getCategoryLetter(lessonName);
@@ -1054,10 +4070,31 @@ function isAutoGeneratedId(id) {
   return /^.+-[A-Z]\d+$/.test(id);
 }
 
+function assignLessonId(lesson) {
+  // 採番はサーバーの連番カウンタで行う。名前・対象の変更を先に送ってから頼む
+  const who = lesson.who, name = lesson.name, oldId = lesson.id;
+  return pendingSave.then(() => fetch('/api/lessons/ids', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({ who, name })
+  })).then(r => r.json()).then(res => {
+    if (!res.ok) throw new Error(res.error);
+    return res.id;
+  }).catch(() => generateLessonId(who, name, appData.lessons.indexOf(lesson))).then(newId => {
+    // 待っている間に別の編集や再読み込みがあれば何もしない
+    if (!appData.lessons.includes(lesson) || lesson.who !== who || lesson.name !== name || lesson.id !== oldId) return;
+    lesson.id = newId;
+    updatePatternIds(oldId, newId);
+    invalidatePatternStats([], [oldId, newId]);
+    saveToServer();
+    renderLessons();
+  });
+}
+
 function updatePatternIds(oldId, newId) {
   if (!oldId || oldId === newId) return;
-  ['A', 'B', 'C'].forEach(patKey => {
-    const ids = appData.patterns[patKey].ids;
+  Object.values(appData.patterns).forEach(pat => {
+    const ids = pat.ids;
     const idx = ids.indexOf(oldId);
     if (idx >= 0) {
       if (newId) ids[idx] = newId;
@@ -1092,31 +4129,124 @@ function getStatusClass(s) {
   return 'reviewing';
 }
 
-function getWhoClass(w) {
-  if (!w) return '';
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
-  const bothName = sisterName + '＋' + brotherName;
-  if (w === bothName) return 'both';
-  if (w === sisterName) return 'sister';
-  if (w === brotherName) return 'brother';
-  // fallback for legacy data
-  if (w.includes('＋')) return 'both';
-  if (w.includes('姉') && !w.includes('弟')) return 'sister';
-  if (w.includes('弟') && !w.includes('姉')) return 'brother';
-  return 'sister';
-}
-
-function getWhoEmoji(w) {
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
-  const bothName = sisterName + '＋' + brotherName;
-  if (w === sisterName) return '👧';
-  if (w === brotherName) return '👶';
-  if (w === bothName) return '👧👶';
-  return '';
+// =========== Family Members ===========
+// 家族は appData.family.members に何人でも並べ、習い事は members に対象の番号を持つ（who は呼び名を「＋」でつないだ表示用）。
+// 人 → 習い事の位置の索引は文書が変わったときだけ作り直し、人物別の絞り込み・件数・色は索引から引く（サーバーの PersonIndex と同じ規則）。
+const WHO_SEPARATOR = '＋';
+const MEMBER_COLORS = [['#5b8def', '#e8f2fb', '#2f5fb3'], ['#e86a92', '#fdf0f3', '#b8436a'], ['#ff9a5c', '#fff3eb', '#c05a20'],
+                       ['#4ecdc4', '#e6faf8', '#2a9d8f'], ['#9b7bd4', '#f3eefb', '#6b4ba3'], ['#e0a82e', '#fdf6e3', '#9a6f10']];
+const LEGACY_MEMBERS = [['papa', 'parent', '👨'], ['mama', 'parent', '👩'], ['sister', 'child', '👧'], ['brother', 'child', '👶']];
+const LEGACY_WHO_HINTS = [['sister', '姉'], ['brother', '弟']];
+let personIndex = null;
+
+function familyMembers() {
+  return (appData.family && appData.family.members) || [];
+}
+
+function splitWho(who) {
+  return String(who || '').split(/\\s*[＋+、,]\\s*/).filter(Boolean);
+}
+
+function memberColors(id) {
+  return MEMBER_COLORS[(id - 1) % MEMBER_COLORS.length];
+}
+
+function memberStyle(id) {
+  const [color, bg, text] = memberColors(id);
+  return `--who:${color};--who-bg:${bg};--who-text:${text};`;
+}
+
+function buildPersonIndex(doc) {
+  const members = (doc.family && doc.family.members) || [];
+  const byId = new Map(members.map(m => [m.id, m]));
+  const order = new Map(members.map((m, i) => [m.id, i]));
+  const byName = new Map();
+  members.forEach(m => { if (!byName.has(m.name || '')) byName.set(m.name || '', m.id); });
+  const index = { data: doc, revision: doc.revision, version: localVersion, byId, order, byName,
+                  lessons: new Map(members.map(m => [m.id, []])), withId: new Map(members.map(m => [m.id, 0])), byLesson: new Map() };
+  doc.lessons.forEach((lesson, idx) => {
+    const ids = Array.isArray(lesson.members) ? lesson.members.filter(id => byId.has(id)) : resolveWho(index, lesson.who);
+    index.byLesson.set(lesson, ids);
+    ids.forEach(id => {
+      index.lessons.get(id).push(idx);
+      if (lesson.id) index.withId.set(id, index.withId.get(id) + 1);
+    });
+  });
+  return index;
+}
+
+function getPersonIndex() {
+  if (personIndex && personIndex.data === appData && personIndex.revision === appData.revision && personIndex.version === localVersion) return personIndex;
+  personIndex = buildPersonIndex(appData);
+  return personIndex;
+}
+
+function orderMembers(index, ids) {
+  return Array.from(ids).filter(id => index.byId.has(id)).sort((a, b) => index.order.get(a) - index.order.get(b));
+}
+
+function resolveWho(index, who) {
+  return orderMembers(index, new Set(splitWho(who).filter(n => index.byName.has(n)).map(n => index.byName.get(n))));
+}
+
+function lessonMembers(lesson) {
+  return getPersonIndex().byLesson.get(lesson) || [];
+}
+
+function whoFromMembers(ids) {
+  const names = new Map(familyMembers().map(m => [m.id, m.name || '']));
+  return ids.map(id => names.get(id)).join(WHO_SEPARATOR);
+}
+
+function whoStyle(lesson) {
+  // サーバーの who_style と同じクラス・CSS 変数（カレンダーの描画を揃えるため）
+  const ids = lessonMembers(lesson);
+  if (!ids.length) return { cls: 'who-none', style: '' };
+  const colors = ids.map(memberColors);
+  if (colors.length === 1) return { cls: 'who-member', style: memberStyle(ids[0]) };
+  const width = 100 / colors.length;
+  const bands = colors.map(([, bg], i) => `${bg} ${i * width}% ${(i + 1) * width}%`).join(', ');
+  return { cls: 'who-member who-multi', style: `--who:${colors[0][0]};--who-edge:${colors[colors.length - 1][0]};--who-bg:linear-gradient(135deg, ${bands});--who-text:#555;` };
+}
+
+function whoIcons(lesson) {
+  const byId = getPersonIndex().byId;
+  return lessonMembers(lesson).map(id => byId.get(id).icon || '').join('');
+}
+
+function personIcon(name) {
+  const index = getPersonIndex();
+  const member = index.byId.get(index.byName.get(name));
+  return member ? member.icon || '' : '';
+}
+
+function migrateFamily(doc) {
+  // 旧形式（family.papa/mama/sister/brother と who だけの習い事）を人の番号で参照する形に直す（サーバーの migrate_family と同じ）
+  const family = doc.family;
+  if (!family || family.members) return false;
+  const members = [], legacy = {};
+  LEGACY_MEMBERS.forEach(([key, role, icon], i) => {
+    if (!family[key]) return;
+    members.push(Object.assign({ id: i + 1, name: '', role, icon, birthday: '', info: '' }, family[key], { id: i + 1, role, icon }));
+    legacy[key] = i + 1;
+  });
+  doc.family = { members, next_id: LEGACY_MEMBERS.length + 1 };
+  const index = buildPersonIndex(Object.assign({}, doc, { lessons: [] }));
+  doc.lessons.forEach(lesson => {
+    if (lesson.members) return;
+    const ids = new Set();
+    splitWho(lesson.who).forEach(name => {
+      let id = index.byName.get(name);
+      if (id === undefined) {
+        const hint = LEGACY_WHO_HINTS.find(([, ch]) => name.includes(ch));
+        id = hint ? legacy[hint[0]] : undefined;
+      }
+      if (id !== undefined) ids.add(id);
+    });
+    lesson.members = orderMembers(index, ids);
+    if (ids.size) lesson.who = lesson.members.map(id => index.byId.get(id).name || '').join(WHO_SEPARATOR);
+  });
+  return true;
 }
 
 function escHtml(str) {
@@ -1130,17 +4260,35 @@ function urlLink(url) {
   return '<a class="url-link" href="' + safe + '" target="_blank" rel="noopener" title="' + safe + '">🔗</a>';
 }
 
-function buildWhoOptions(current) {
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
-  const bothName = sisterName + '＋' + brotherName;
-  const options = [sisterName, brotherName, bothName];
-  return options.map(o => `<option value="${o}" ${current===o?'selected':''}>${o}</option>`).join('');
+function buildWhoPicker(idx) {
+  // 対象は家族ごとのボタンで切り替える（複数人を選べる）
+  const selected = new Set(lessonMembers(appData.lessons[idx]));
+  return '<div class="who-picker">' + familyMembers().map(m =>
+    `<button class="who-pick${selected.has(m.id) ? ' on' : ''}" style="${memberStyle(m.id)}" onclick="toggleLessonMember(${idx},${m.id})" title="${escHtml(m.name || '')}">${m.icon || ''}${escHtml(m.name || '')}</button>`
+  ).join('') + '</div>';
 }
 
 // =========== Person Filter ===========
-let lessonPersonFilter = 'all'; // 'all', 'sister', 'brother'
+let lessonPersonFilter = 'all'; // 'all' か人の番号
+
+function validPersonFilter(filter) {
+  return filter === 'all' || getPersonIndex().byId.has(filter) ? filter : 'all';
+}
+
+function personFilterButtons(current, handler, count, total) {
+  // 子どもと、習い事のある人だけボタンにする
+  let html = `<button class="person-filter-btn${current==='all'?' active-all':''}" onclick="${handler}('all')">
+      📋 全員<span class="person-count">${total}件</span>
+    </button>`;
+  familyMembers().forEach(m => {
+    const n = count(m.id);
+    if (m.role !== 'child' && !n) return;
+    html += `<button class="person-filter-btn${current===m.id?' active-member':''}" style="${memberStyle(m.id)}" onclick="${handler}(${m.id})">
+      ${m.icon || ''} ${escHtml(m.name || '')}<span class="person-count">${n}件</span>
+    </button>`;
+  });
+  return html;
+}
 
 function setPersonFilter(filter) {
   lessonPersonFilter = filter;
@@ -1149,37 +4297,124 @@ function setPersonFilter(filter) {
 }
 
 function renderPersonFilter() {
-  const container = document.getElementById('person-filter');
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
-
-  const sisterCount = appData.lessons.filter(l => l.who === sisterName || (l.who && l.who.includes(sisterName))).length;
-  const brotherCount = appData.lessons.filter(l => l.who === brotherName || (l.who && l.who.includes(brotherName))).length;
-  const allCount = appData.lessons.length;
-
-  container.innerHTML = `
-    <button class="person-filter-btn${lessonPersonFilter==='all'?' active-all':''}" onclick="setPersonFilter('all')">
-      📋 全員<span class="person-count">${allCount}件</span>
-    </button>
-    <button class="person-filter-btn${lessonPersonFilter==='sister'?' active-sister':''}" onclick="setPersonFilter('sister')">
-      👧 ${sisterName}<span class="person-count">${sisterCount}件</span>
-    </button>
-    <button class="person-filter-btn${lessonPersonFilter==='brother'?' active-brother':''}" onclick="setPersonFilter('brother')">
-      👶 ${brotherName}<span class="person-count">${brotherCount}件</span>
-    </button>
-  `;
+  const index = getPersonIndex();
+  lessonPersonFilter = validPersonFilter(lessonPersonFilter);
+  document.getElementById('person-filter').innerHTML =
+    personFilterButtons(lessonPersonFilter, 'setPersonFilter', id => index.lessons.get(id).length, appData.lessons.length);
 }
 
 function getFilteredLessonIndices(sortedIndices) {
-  if (lessonPersonFilter === 'all') return sortedIndices;
-  const f = appData.family;
-  const filterName = lessonPersonFilter === 'sister'
-    ? (f.sister ? f.sister.name : 'お姉ちゃん')
-    : (f.brother ? f.brother.name : '弟くん');
-  return sortedIndices.filter(idx => {
-    const who = appData.lessons[idx].who || '';
-    return who === filterName || who.includes(filterName);
+  const indices = filterByAge(filterBySearch(sortedIndices));
+  const filter = validPersonFilter(lessonPersonFilter);
+  if (filter === 'all') return indices;
+  const positions = new Set(getPersonIndex().lessons.get(filter));
+  return indices.filter(idx => positions.has(idx));
+}
+
+// =========== Lesson Search ===========
+// サーバーの 2-gram 索引で探し、結果の位置と順位を持つ。未送信の編集や他端末の変更で位置がずれたとき、
+// オフラインのときは手元で同じ規則（正規化して部分一致、項目の重み）で探し直す
+const SEARCH_DEBOUNCE_MS = 200;
+const SEARCH_LIMIT = 1000;
+const SEARCH_FIELDS = [['name', 3], ['school', 2], ['address', 1], ['memo', 1]];
+let lessonSearch = null; // { q, revision, version, rank: Map(位置 → 順位) }
+let searchTimer = null;
+
+function normalizeSearchText(text) {
+  return String(text || '').normalize('NFKC').toLowerCase()
+    .replace(/[\\u30a1-\\u30f6]/g, c => String.fromCharCode(c.charCodeAt(0) - 0x60));
+}
+
+function setLessonSearch(value) {
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(() => loadLessonSearch(value.trim()), SEARCH_DEBOUNCE_MS);
+}
+
+function searchLocally(q) {
+  const terms = normalizeSearchText(q).split(/\\s+/).filter(Boolean);
+  const scored = [];
+  appData.lessons.forEach((lesson, idx) => {
+    const texts = SEARCH_FIELDS.map(([field]) => normalizeSearchText(lesson[field]));
+    let score = 0;
+    for (const term of terms) {
+      let best = 0;
+      SEARCH_FIELDS.forEach(([, weight], i) => {
+        if (texts[i].includes(term)) best = Math.max(best, texts[i].startsWith(term) ? weight * 2 : weight);
+      });
+      if (!best) return;
+      score += best;
+    }
+    scored.push([score, idx]);
+  });
+  scored.sort((a, b) => b[0] - a[0] || a[1] - b[1]);
+  return scored.map(([, idx]) => idx);
+}
+
+function setSearchResult(q, indices) {
+  lessonSearch = { q, revision: appData.revision, version: localVersion, rank: new Map(indices.map((idx, i) => [idx, i])) };
+}
+
+function loadLessonSearch(q) {
+  if (!q) {
+    lessonSearch = null;
+    renderLessons();
+    return Promise.resolve();
+  }
+  return fetch('/api/lessons/search?' + new URLSearchParams({ q, limit: SEARCH_LIMIT })).then(r => r.json()).then(res => {
+    if (!res.ok) throw new Error(res.error);
+    // 件数が上限を超えたときや、応答までに編集があって位置がずれたときは手元で探す
+    if (res.total > res.results.length || isDirty() || res.revision !== appData.revision) throw new Error('stale');
+    return res.results.map(hit => hit.index);
+  }).catch(() => searchLocally(q)).then(indices => {
+    if (document.getElementById('lesson-search').value.trim() !== q) return;
+    setSearchResult(q, indices);
+    renderLessons();
+  });
+}
+
+function filterBySearch(indices) {
+  if (!lessonSearch) return indices;
+  if (lessonSearch.revision !== appData.revision || lessonSearch.version !== localVersion) {
+    setSearchResult(lessonSearch.q, searchLocally(lessonSearch.q));
+  }
+  const rank = lessonSearch.rank;
+  const hits = indices.filter(idx => rank.has(idx));
+  // 並べ替えを選んでいなければ関連度の高い順に出す
+  return lessonSort.key ? hits : hits.sort((a, b) => rank.get(a) - rank.get(b));
+}
+
+// =========== Age Filter ===========
+// 対象年齢はサーバーの索引で判定済みのものを使い、ここでは子どもごとの対象外 ID の集合を引くだけ
+let ageFilter = null; // { date, excluded: { 子どもの番号: Set(ID) } }
+
+function setAgeFilter(value) {
+  document.getElementById('age-filter-date').value = value;
+  if (!value) {
+    ageFilter = null;
+    renderLessons();
+    return;
+  }
+  loadAgeFilter(value).then(renderLessons);
+}
+
+function loadAgeFilter(value) {
+  return fetch('/api/eligibility?date=' + encodeURIComponent(value)).then(r => r.json()).then(res => {
+    if (!res.ok) { alert(res.error); return; }
+    const excluded = {};
+    Object.keys(res.lookup).forEach(id => {
+      const l = res.lookup[id];
+      excluded[id] = new Set(l.aged_out.concat(l.not_yet.map(n => n.id)));
+    });
+    ageFilter = { date: value, excluded: excluded };
+  });
+}
+
+function filterByAge(indices) {
+  if (!ageFilter) return indices;
+  // 対象の誰かが年齢外なら外す（lookup は人の番号ごと）
+  return indices.filter(idx => {
+    const lesson = appData.lessons[idx];
+    return !lessonMembers(lesson).some(id => ageFilter.excluded[id] && ageFilter.excluded[id].has(lesson.id));
   });
 }
 
@@ -1232,6 +4467,7 @@ function renderLessons() {
     {key:'day', label:'曜日', cls:'col-day'},
     {key:'start', label:'開始', cls:'col-time'},
     {key:'end', label:'終了', cls:'col-time'},
+    {key:'repeat', label:'繰り返し', cls:'col-repeat'},
     {key:'fee', label:'月謝', cls:'col-fee'},
     {key:'status', label:'状態', cls:'col-status'},
     {key:null, label:'URL', cls:'col-url'},
@@ -1252,22 +4488,21 @@ function renderLessons() {
 
   const sortedIndices = getSortedLessonIndices();
   const filteredIndices = getFilteredLessonIndices(sortedIndices);
+  document.getElementById('lesson-search-count').textContent = lessonSearch ? filteredIndices.length + '件' : '';
   filteredIndices.forEach(idx => {
     const lesson = appData.lessons[idx];
     html += `<tr>
       <td><input value="${escHtml(lesson.id)}" onchange="updateLesson(${idx},'id',this.value)" placeholder="自動" style="font-weight:700;color:var(--accent);font-size:0.82rem;" title="対象と習い事名から自動生成。手動入力で上書き可能。"></td>
       <td><input value="${escHtml(lesson.name)}" onchange="updateLesson(${idx},'name',this.value)" placeholder="幼児教室"></td>
       <td><input value="${escHtml(lesson.school)}" onchange="updateLesson(${idx},'school',this.value)" placeholder="○○教室"></td>
-      <td><select onchange="updateLesson(${idx},'who',this.value)">
-            <option value="">-</option>
-            ${buildWhoOptions(lesson.who)}
-          </select></td>
+      <td>${buildWhoPicker(idx)}</td>
       <td><select onchange="updateLesson(${idx},'day',this.value)">
             <option value="">-</option>
             ${DAYS.map(d => '<option value="' + d + '"' + (lesson.day===d?' selected':'') + '>' + d + '</option>').join('')}
           </select></td>
       <td><input type="text" class="time-input" data-time-field="start" data-lesson-idx="${idx}" value="${lesson.start || ''}" inputmode="numeric" placeholder="9:00"></td>
       <td><input type="text" class="time-input" data-time-field="end" data-lesson-idx="${idx}" value="${lesson.end || ''}" inputmode="numeric" placeholder="10:00"></td>
+      <td><input value="${escHtml(lesson.repeat)}" onchange="updateLesson(${idx},'repeat',this.value)" placeholder="毎週" title="空なら毎週。例: 隔週 2026-04-06から / 第1・3 / 2026-04-01〜2026-09-30 / 体験 2026-05-10"></td>
       <td><input type="number" value="${lesson.fee || ''}" onchange="updateLesson(${idx},'fee',this.value)" placeholder="7000" style="width:70px"></td>
       <td><select onchange="updateLesson(${idx},'status',this.value)">
             <option value="継続確定" ${lesson.status==='継続確定'?'selected':''}>継続確定</option>
@@ -1306,35 +4541,44 @@ function updateLesson(idx, field, value) {
   lesson[field] = value;
 
   // Auto-generate ID when 'who' or 'name' changes
-  if (field === 'who' || field === 'name') {
-    if (lesson.who && lesson.name) {
-      const newId = generateLessonId(lesson.who, lesson.name, idx);
-      if (!oldId || isAutoGeneratedId(oldId)) {
-        lesson.id = newId;
-        updatePatternIds(oldId, newId);
-      }
-    }
-  }
+  const regenerateId = (field === 'who' || field === 'name') && lesson.who && lesson.name && (!oldId || isAutoGeneratedId(oldId));
   // If user manually edits the ID field, update pattern references
   if (field === 'id' && oldId !== value) {
     updatePatternIds(oldId, value);
   }
+  if (PATTERN_STAT_FIELDS.includes(field) || lesson.id !== oldId) invalidatePatternStats([], [oldId, lesson.id]);
 
   saveToServer();
+  if (regenerateId) assignLessonId(lesson);
+  if ((field === 'repeat' || field === 'day') && lesson.repeat) checkRecurrence(lesson);
   if (field === 'who') renderPersonFilter();
   renderLessons();
 }
 
+function toggleLessonMember(idx, memberId) {
+  const lesson = appData.lessons[idx];
+  const index = getPersonIndex();
+  const ids = new Set(lessonMembers(lesson));
+  if (ids.has(memberId)) ids.delete(memberId); else ids.add(memberId);
+  lesson.members = orderMembers(index, ids);
+  // who は members から作り直す（ID の自動生成・人物別の件数の更新は who の変更として扱う）
+  updateLesson(idx, 'who', whoFromMembers(lesson.members));
+}
+
+function checkRecurrence(lesson) {
+  // 繰り返しの書き方はサーバーで読み取り、読めなければ知らせる（保存はされ、毎週として扱われる）
+  const query = new URLSearchParams({ repeat: lesson.repeat || '', day: lesson.day || '' });
+  return fetch('/api/recurrence?' + query).then(r => r.json()).then(res => {
+    if (!res.ok) alert('繰り返しを読み取れません（毎週として扱います）: ' + res.error);
+  }).catch(() => {});
+}
+
 function addLesson() {
-  const f = appData.family;
-  let defaultWho = '';
-  if (lessonPersonFilter === 'sister') {
-    defaultWho = f.sister ? f.sister.name : 'お姉ちゃん';
-  } else if (lessonPersonFilter === 'brother') {
-    defaultWho = f.brother ? f.brother.name : '弟くん';
-  }
+  // 人物で絞り込んでいればその人の習い事として追加する
+  const filter = validPersonFilter(lessonPersonFilter);
+  const members = filter === 'all' ? [] : [filter];
   appData.lessons.push({
-    id: '', name: '', school: '', address: '', who: defaultWho, day: '', start: '', end: '', fee: '', status: '検討中', url: '', memo: ''
+    id: '', name: '', school: '', address: '', who: whoFromMembers(members), members, day: '', start: '', end: '', repeat: '', fee: '', status: '検討中', url: '', memo: ''
   });
   saveToServer();
   renderPersonFilter();
@@ -1346,11 +4590,10 @@ function deleteLesson(idx) {
     const deletedId = appData.lessons[idx].id;
     appData.lessons.splice(idx, 1);
     if (deletedId) {
-      ['A', 'B', 'C'].forEach(patKey => {
-        const ids = appData.patterns[patKey].ids;
-        const pidx = ids.indexOf(deletedId);
-        if (pidx >= 0) ids.splice(pidx, 1);
+      Object.values(appData.patterns).forEach(pat => {
+        pat.ids = pat.ids.filter(id => id !== deletedId);
       });
+      invalidatePatternStats([], [deletedId]);
     }
     saveToServer();
     renderPersonFilter();
@@ -1362,185 +4605,664 @@ function duplicateLesson(idx) {
   const src = appData.lessons[idx];
   const copy = Object.assign({}, src);
   copy.id = '';
-  // Auto-generate new ID if possible
-  if (copy.who && copy.name) {
-    copy.id = generateLessonId(copy.who, copy.name, -1);
-  }
+  if (Array.isArray(src.members)) copy.members = src.members.slice();
   appData.lessons.splice(idx + 1, 0, copy);
   saveToServer();
+  // Auto-generate new ID if possible
+  if (copy.who && copy.name) assignLessonId(copy);
   renderPersonFilter();
   renderLessons();
 }
 
 function renumberAllIds() {
   if (!confirm('全てのIDを自動で振り直しますか？\\n（パターンの参照も自動更新されます）')) return;
-  const idMap = {};
-  const counters = {};
-  appData.lessons.forEach(lesson => {
-    const oldId = lesson.id;
-    const person = lesson.who || '_';
-    const catLetter = getCategoryLetter(lesson.name);
-    const key = person + '-' + catLetter;
-    counters[key] = (counters[key] || 0) + 1;
-    const newId = person + '-' + catLetter + String(counters[key]).padStart(2, '0');
-    if (oldId && oldId !== newId) idMap[oldId] = newId;
-    lesson.id = newId;
+  requestRenumber().then(ok => {
+    if (!ok) alert('IDを振り直せませんでした。オンラインになってからもう一度お試しください');
   });
-  ['A', 'B', 'C'].forEach(patKey => {
-    appData.patterns[patKey].ids = appData.patterns[patKey].ids.map(oldId => idMap[oldId] || oldId);
-  });
-  saveToServer();
-  renderPersonFilter();
-  renderLessons();
 }
 
-// =========== CSV Export ===========
-function exportCSV() {
-  const BOM = '\uFEFF';
-  const headers = ['ID','習い事','教室','対象','曜日','開始','終了','月謝','状態','URL','備考'];
-  const rows = [headers.join(',')];
-  const sortedIndices = getSortedLessonIndices();
-  const filteredIndices = getFilteredLessonIndices(sortedIndices);
-  filteredIndices.forEach(idx => {
-    const l = appData.lessons[idx];
-    const fields = [l.id, l.name, l.school, l.who, l.day, l.start, l.end, l.fee, l.status, l.url, l.memo];
-    rows.push(fields.map(v => {
-      const s = String(v || '').replace(/"/g, '""');
-      return s.includes(',') || s.includes('"') || s.includes(String.fromCharCode(10)) ? '"' + s + '"' : s;
-    }).join(','));
-  });
-  const blob = new Blob([BOM + rows.join(String.fromCharCode(10))], { type: 'text/csv;charset=utf-8;' });
-  const url = URL.createObjectURL(blob);
-  const a = document.createElement('a');
-  a.href = url;
-  a.download = '習い事候補_' + new Date().toISOString().slice(0,10) + '.csv';
-  a.click();
-  URL.revokeObjectURL(url);
+function requestRenumber() {
+  // 振り直しはサーバーで 1 回の操作として行い、返ってきた 'renumber' 操作をこの端末にも当てる
+  runSync();
+  return pendingSave.then(() => {
+    if (isDirty()) return null;
+    return fetch('/api/lessons/renumber', {
+      method: 'POST',
+      headers: {'X-Client-Id': CLIENT_ID}
+    }).then(r => r.json());
+  }).then(res => {
+    if (!res || !res.ok) return false;
+    if (!res.op) return true;
+    if (!isDirty() && !syncing && res.base === shadow.revision) {
+      applyOps([res.op]);
+      invalidateStatsForOps([res.op]);
+      appData.revision = res.revision;
+      shadow = cloneDoc(appData);
+      persistLocal();
+      renderAll();
+    } else {
+      needsPull = true;
+      reloadData();
+    }
+    return true;
+  }).catch(() => false);
 }
 
-// =========== Patterns ===========
-let activePatternTab = 'A';
-let patternDayFilter = ['月','火','水','木','金','土','日'];
-let patternPersonFilter = 'all';
-let patternCollapsedGroups = new Set();
+// =========== CSV Export ===========
+function personFilterParam(filter) {
+  // サーバーには人の番号で渡す（名前を変えても購読 URL が変わらない）
+  filter = validPersonFilter(filter);
+  return filter === 'all' ? '' : String(filter);
+}
 
-function switchPatternTab(key) {
-  activePatternTab = key;
-  renderPatterns();
+function exportLessons(format, params) {
+  const query = new URLSearchParams(Object.assign({ format }, params));
+  window.location.href = '/api/lessons/export?' + query.toString();
 }
 
-function toggleDayFilter(day) {
-  const idx = patternDayFilter.indexOf(day);
-  if (idx >= 0) {
-    if (patternDayFilter.length === 1) return; // keep at least 1 day
-    patternDayFilter.splice(idx, 1);
-  } else {
-    patternDayFilter.push(day);
-    // restore DAYS order
-    patternDayFilter.sort((a, b) => DAYS.indexOf(a) - DAYS.indexOf(b));
+function exportCSV(format) {
+  const params = { who: personFilterParam(lessonPersonFilter) };
+  if (lessonSort.key) {
+    params.sort = lessonSort.key;
+    params.order = lessonSort.asc ? 'asc' : 'desc';
   }
-  renderPatterns();
+  exportLessons(format || 'csv', params);
 }
 
-function resetDayFilter() {
-  patternDayFilter = ['月','火','水','木','金','土','日'];
-  renderPatterns();
+function showCalendarFeed(patKey) {
+  const who = personFilterParam(patternPersonFilter);
+  let url = location.origin + '/api/patterns/' + encodeURIComponent(patKey) + '.ics';
+  if (who) url += '?who=' + encodeURIComponent(who);
+  prompt('カレンダーアプリに登録するURL（URLで購読）', url);
 }
 
-function setPatternPersonFilter(filter) {
-  patternPersonFilter = filter;
-  renderPatterns();
+// =========== CSV Import ===========
+function importCSV(input) {
+  const file = input.files[0];
+  input.value = '';
+  if (!file) return;
+  fetch('/api/lessons/import', {
+    method: 'POST',
+    headers: {'Content-Type': 'text/csv', 'X-Client-Id': CLIENT_ID},
+    body: file
+  }).then(r => r.json()).then(res => {
+    if (!res.ok) { alert('CSV取込に失敗しました: ' + res.error); return; }
+    let msg = `追加 ${res.inserted}件 / 更新 ${res.updated}件`;
+    if (res.error_count) {
+      msg += `\\nエラー ${res.error_count}行（取り込まれていません）:\\n` +
+        res.errors.slice(0, 10).map(e => `${e.row}行目: ${e.errors.join(' / ')}`).join('\\n');
+    }
+    alert(msg);
+    reloadData();
+  });
 }
 
-function toggleGroupCollapse(catKey) {
-  if (patternCollapsedGroups.has(catKey)) {
-    patternCollapsedGroups.delete(catKey);
-  } else {
-    patternCollapsedGroups.add(catKey);
+// =========== Pattern Sets ===========
+// パターンの採用 ID を習い事の序数のビット列で持ち、所属判定・和・積・差・複製を配列の検索なしで行う。
+// 保存形式は ids の配列のままで、ビット列は編集のたびに作り直す。
+const PATTERN_COLORS = ['#3b6cb4', '#27ae60', '#e67e22', '#8e44ad', '#c0392b', '#16a085', '#d35400', '#2c3e50'];
+
+class LessonBits {
+  constructor(size, words) {
+    this.words = words || new Uint32Array((size + 31) >>> 5);
+  }
+  has(o) { return o !== undefined && ((this.words[o >>> 5] >>> (o & 31)) & 1) === 1; }
+  add(o) { this.words[o >>> 5] |= 1 << (o & 31); }
+  clone() { return new LessonBits(0, this.words.slice()); }
+  combine(other, fn) {
+    const words = new Uint32Array(this.words.length);
+    for (let i = 0; i < words.length; i++) words[i] = fn(this.words[i], other.words[i]);
+    return new LessonBits(0, words);
+  }
+  union(other) { return this.combine(other, (a, b) => a | b); }
+  intersect(other) { return this.combine(other, (a, b) => a & b); }
+  difference(other) { return this.combine(other, (a, b) => a & ~b); }
+  get size() {
+    let n = 0;
+    this.words.forEach(w => {
+      w = w - ((w >>> 1) & 0x55555555);
+      w = (w & 0x33333333) + ((w >>> 2) & 0x33333333);
+      n += (((w + (w >>> 4)) & 0x0F0F0F0F) * 0x01010101) >>> 24;
+    });
+    return n;
+  }
+  forEach(fn) {
+    this.words.forEach((w, i) => {
+      while (w) {
+        const low = w & -w;
+        fn((i << 5) + 31 - Math.clz32(low));
+        w ^= low;
+      }
+    });
   }
-  renderPatterns();
 }
 
-function selectAllInGroup(patKey, catKey, selectAll) {
-  const ids = appData.patterns[patKey].ids;
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
+let patternIndex = null;
 
-  appData.lessons.filter(l => l.id).forEach(lesson => {
-    if (getCategoryLetter(lesson.name) !== catKey) return;
-    if (patternPersonFilter !== 'all') {
-      const filterName = patternPersonFilter === 'sister' ? sisterName : brotherName;
-      if (lesson.who !== filterName && !(lesson.who && lesson.who.includes(filterName))) return;
-    }
-    if (lesson.day && !patternDayFilter.includes(lesson.day)) return;
-    const idx = ids.indexOf(lesson.id);
-    if (selectAll && idx < 0) {
-      ids.push(lesson.id);
-    } else if (!selectAll && idx >= 0) {
-      ids.splice(idx, 1);
+function invalidatePatternSets() {
+  patternIndex = null;
+}
+
+function getPatternIndex() {
+  if (patternIndex) return patternIndex;
+  const ordinals = new Map();
+  const lessons = [];
+  appData.lessons.forEach(l => {
+    if (l.id && !ordinals.has(l.id)) {
+      ordinals.set(l.id, lessons.length);
+      lessons.push(l);
     }
   });
-  saveToServer();
-  renderPatterns();
+  const sets = {};
+  Object.keys(appData.patterns).forEach(key => {
+    const bits = new LessonBits(lessons.length);
+    (appData.patterns[key].ids || []).forEach(id => {
+      const o = ordinals.get(id);
+      if (o !== undefined) bits.add(o);
+    });
+    sets[key] = bits;
+  });
+  patternIndex = { ordinals, lessons, sets };
+  return patternIndex;
 }
 
-function renderPatterns() {
-  const tabsContainer = document.getElementById('pattern-tabs');
-  const grid = document.getElementById('patterns-grid');
+function patternBits(key) {
+  return getPatternIndex().sets[key];
+}
 
-  const patKeys = ['A','B','C'];
-  const patColors = { A:'a', B:'b', C:'c' };
+function isInPattern(key, lessonId) {
+  const index = getPatternIndex();
+  return index.sets[key].has(index.ordinals.get(lessonId));
+}
 
-  // Render sub-tabs
-  let tabsHtml = '';
-  patKeys.forEach(key => {
-    const pat = appData.patterns[key];
-    const stats = calcStats(pat.ids || []);
-    const isActive = key === activePatternTab;
-    const activeCls = isActive ? ` active-${patColors[key]}` : '';
-    tabsHtml += `<button class="pattern-tab${activeCls}" onclick="switchPatternTab('${key}')">
-      ${pat.name || 'パターン'+key}
-      <span style="font-size:0.75rem;opacity:0.85;display:block;">${stats.total}件 / ${stats.fee ? stats.fee.toLocaleString()+'円' : '-'}</span>
-    </button>`;
-  });
-  tabsContainer.innerHTML = tabsHtml;
+function bitsToIds(bits) {
+  const lessons = getPatternIndex().lessons;
+  const ids = [];
+  bits.forEach(o => ids.push(lessons[o].id));
+  return ids;
+}
 
-  // Render active pattern only
-  grid.innerHTML = '';
-  const key = activePatternTab;
-  const pi = patColors[key];
+function patternKeys() {
+  return Object.keys(appData.patterns).sort((a, b) => a.length - b.length || (a < b ? -1 : a > b ? 1 : 0));
+}
+
+function patternColor(key) {
+  return PATTERN_COLORS[Math.max(0, patternKeys().indexOf(key)) % PATTERN_COLORS.length];
+}
+
+function nextPatternKey() {
+  // A〜Z, AA, AB … の順で空いているキー
+  for (let n = 1; ; n++) {
+    let key = '';
+    for (let m = n; m > 0; m = Math.floor((m - 1) / 26)) key = String.fromCharCode(65 + (m - 1) % 26) + key;
+    if (!appData.patterns[key]) return key;
+  }
+}
+
+function addPattern(ids, name) {
+  const key = nextPatternKey();
+  appData.patterns[key] = { name: name || 'パターン' + key, ids: ids || [], memo: '' };
+  invalidatePatternStats([key]);
+  activePatternTab = key;
+  saveToServer();
+  renderPatterns();
+}
+
+function duplicatePattern(key) {
+  const src = appData.patterns[key];
+  addPattern(bitsToIds(patternBits(key).clone()), (src.name || 'パターン' + key) + ' のコピー');
+}
+
+function renamePattern(key) {
+  const name = prompt('パターン名', appData.patterns[key].name || '');
+  if (name === null) return;
+  appData.patterns[key].name = name;
+  saveToServer();
+  renderPatterns();
+}
+
+function deletePattern(key) {
+  if (patternKeys().length <= 1) { alert('最後のパターンは削除できません'); return; }
+  if (!confirm('「' + (appData.patterns[key].name || key) + '」を削除しますか？')) return;
+  delete appData.patterns[key];
+  invalidatePatternStats([key]);
+  activePatternTab = patternKeys()[0];
+  saveToServer();
+  renderPatterns();
+}
+
+function combinePatterns(key) {
+  const other = document.getElementById('pattern-combine-with').value;
+  const op = document.getElementById('pattern-combine-op').value;
+  if (!appData.patterns[other]) return;
+  const a = patternBits(key), b = patternBits(other);
+  const bits = op === 'union' ? a.union(b) : op === 'intersect' ? a.intersect(b) : a.difference(b);
+  const symbol = { union: '∪', intersect: '∩', difference: '−' }[op];
+  addPattern(bitsToIds(bits), (appData.patterns[key].name || key) + ' ' + symbol + ' ' + (appData.patterns[other].name || other));
+}
+
+function renderPatternComparison(key) {
+  const base = patternBits(key);
+  const baseFee = getPatternStats(key).fee;
+  const others = patternKeys().filter(k => k !== key);
+  if (!others.length) return '';
+  let html = `<table class="pattern-compare"><thead><tr><th>比較</th><th>件数</th><th>共通</th><th>追加</th><th>削除</th><th>月謝差(円)</th></tr></thead><tbody>`;
+  others.forEach(k => {
+    const bits = patternBits(k);
+    const fee = getPatternStats(k).fee;
+    const diff = fee - baseFee;
+    html += `<tr><td><span style="color:${patternColor(k)}">■</span> ${escHtml(appData.patterns[k].name || k)}</td>
+      <td>${bits.size}</td><td>${bits.intersect(base).size}</td>
+      <td>${bits.difference(base).size}</td><td>${base.difference(bits).size}</td>
+      <td>${diff > 0 ? '+' : ''}${diff.toLocaleString()}</td></tr>`;
+  });
+  return html + '</tbody></table>';
+}
+
+// =========== Pattern Stats Cache ===========
+// パターンごとの集計とカレンダー配置を持ち、メンバーの fee/day/start/end/who と採用の変更だけで捨てる（サーバーと同じ規則）
+const PATTERN_STAT_FIELDS = ['id', 'fee', 'day', 'start', 'end', 'who', 'members', 'repeat'];
+let patternStats = {};
+let patternStatDeps = new Map(); // 習い事 ID -> Set(パターンキー)
+
+function clearPatternStats() {
+  patternStats = {};
+  patternStatDeps = new Map();
+}
+
+function invalidatePatternStats(keys, lessonIds) {
+  const drop = new Set(keys || []);
+  (lessonIds || []).forEach(id => {
+    const deps = patternStatDeps.get(id);
+    if (!deps) return;
+    deps.forEach(k => drop.add(k));
+    patternStatDeps.delete(id);
+  });
+  drop.forEach(k => { delete patternStats[k]; });
+}
+
+function invalidateStatsForOps(ops) {
+  const structural = ops.some(op => op.op === 'lesson_insert' || op.op === 'lesson_delete');
+  const keys = [], ids = [];
+  for (const op of ops) {
+    if (op.op === 'set' || op.op === 'unset') {
+      if (['lessons', 'patterns', 'family'].includes(op.key)) { clearPatternStats(); return; }
+    } else if (op.op === 'lesson_set' || op.op === 'lesson_unset') {
+      if (!PATTERN_STAT_FIELDS.includes(op.field)) continue;
+      if (structural || !appData.lessons[op.index]) { clearPatternStats(); return; }
+      ids.push(appData.lessons[op.index].id);
+      if (op.field === 'id') ids.push(op.value);
+    } else if (op.op === 'lesson_insert') {
+      op.lessons.forEach(l => ids.push(l.id));
+    } else if (op.op === 'lesson_delete') {
+      clearPatternStats();
+      return;
+    } else if (op.op === 'renumber') {
+      Object.keys(op.map).forEach(id => ids.push(id, op.map[id]));
+    } else if (op.op.startsWith('pattern_')) {
+      keys.push(op.key);
+    }
+  }
+  invalidatePatternStats(keys, ids);
+}
+
+function getPatternStats(key) {
+  if (patternStats[key]) return patternStats[key];
+  const bits = patternBits(key);
+  const stats = calcStats(bits);
+  stats.events = layoutPatternEvents(bits);
+  patternStats[key] = stats;
+  (appData.patterns[key].ids || []).forEach(id => {
+    if (!patternStatDeps.has(id)) patternStatDeps.set(id, new Set());
+    patternStatDeps.get(id).add(key);
+  });
+  return stats;
+}
+
+function layoutPatternEvents(bits) {
+  // 曜日ごとに開始順に並べ、重なるもの同士で横幅を分ける
+  const lessons = getPatternIndex().lessons;
+  const events = {};
+  bits.forEach(o => {
+    const lesson = lessons[o];
+    if (!lesson.day || !lesson.start || !lesson.end) return;
+    const sParts = lesson.start.split(':');
+    const eParts = lesson.end.split(':');
+    const startMin = parseInt(sParts[0]) * 60 + parseInt(sParts[1] || 0);
+    const endMin = parseInt(eParts[0]) * 60 + parseInt(eParts[1] || 0);
+    (events[lesson.day] = events[lesson.day] || []).push({ lesson, startMin, endMin, overlapStyle: '' });
+  });
+  Object.values(events).forEach(dayEvents => {
+    dayEvents.sort((a, b) => a.startMin - b.startMin);
+    dayEvents.forEach(ev => {
+      const overlapGroup = dayEvents.filter(other => other.startMin < ev.endMin && other.endMin > ev.startMin);
+      if (overlapGroup.length < 2) return;
+      const myIdx = overlapGroup.indexOf(ev);
+      const widthPct = 100 / overlapGroup.length;
+      const leftPct = myIdx * widthPct;
+      ev.overlapStyle = `left:calc(${leftPct}% + 2px);right:calc(${100 - leftPct - widthPct}% + 2px);`;
+    });
+  });
+  return events;
+}
+
+// =========== Server Sections ===========
+// パターン画面のうちサーバーで集計する部分（負荷・月ごとの費用）は revision ごとに受け取って保持する
+const sectionResults = new Map(); // 'revision|URL' -> 応答
+
+function serverSection(elementId, key, url, render) {
+  const cached = savesInFlight ? undefined : sectionResults.get((appData.revision || 0) + '|' + url);
+  if (cached) return `<div id="${elementId}">${render(cached)}</div>`;
+  const previous = document.getElementById(elementId);
+  const keep = previous && previous.dataset.key === key ? previous.innerHTML : '';
+  setTimeout(() => loadServerSection(elementId, key, url, render), 0);
+  return `<div id="${elementId}" data-key="${escHtml(key)}">${keep}</div>`;
+}
+
+function loadServerSection(elementId, key, url, render) {
+  pendingSave.then(() => fetch(url)).then(r => r.json()).then(res => {
+    if (!res.ok) throw new Error(res.error);
+    sectionResults.set(res.revision + '|' + url, res);
+    if (sectionResults.size > CALENDAR_FRAGMENT_LIMIT) sectionResults.delete(sectionResults.keys().next().value);
+    const el = document.getElementById(elementId);
+    if (!el || activePatternTab !== key) return;
+    el.innerHTML = render(res);
+    el.dataset.key = key;
+  }).catch(() => {});
+}
+
+// =========== Workload Heatmap ===========
+// 人ごとの 15 分枠の件数と曜日別の拘束時間（/api/workload）
+function workloadSection(key) {
+  return serverSection('pattern-workload', key, '/api/workload?patterns=' + encodeURIComponent(key),
+    res => renderWorkload(Object.assign({ slotMinutes: res.slot_minutes }, res.patterns[key])));
+}
+
+function formatMinutes(m) {
+  const h = Math.floor(m / 60), rest = m % 60;
+  return h ? h + '時間' + (rest ? rest + '分' : '') : rest + '分';
+}
+
+function renderWorkload(result) {
+  const people = Object.keys(result.people);
+  if (!people.length) return '';
+  // 表示する時間帯は、誰かが埋まっている枠を含む 1 時間単位の範囲に絞る
+  const perHour = 60 / result.slotMinutes;
+  let first = Infinity, last = -1;
+  people.forEach(p => DAYS.forEach(d => result.people[p].slots[d].forEach((c, i) => {
+    if (c) { first = Math.min(first, i); last = Math.max(last, i); }
+  })));
+  first = Math.floor(first / perHour) * perHour;
+  last = (Math.floor(last / perHour) + 1) * perHour;
+  let html = '<div class="workload"><div class="workload-title">🔥 時間帯ごとの負荷（' + result.slotMinutes + '分単位）</div>';
+  people.forEach(p => {
+    const w = result.people[p];
+    html += `<div class="workload-person"><div class="workload-name">${personIcon(p)} ${escHtml(p || '対象未設定')}<span>週 ${formatMinutes(w.busy_total)}</span></div>`;
+    html += `<div class="workload-grid" style="grid-template-columns:20px repeat(${last - first},1fr) 72px"><div></div>`;
+    for (let s = first; s < last; s += perHour) html += `<div class="workload-hour" style="grid-column:span ${perHour}">${s / perHour}</div>`;
+    html += '<div></div>';
+    DAYS.forEach(d => {
+      html += `<div class="workload-day">${d}</div>`;
+      w.slots[d].slice(first, last).forEach((c, i) => {
+        html += `<div class="workload-cell l${Math.min(c, 3)}" title="${d} ${minToTime((first + i) * result.slotMinutes)}〜 ${c}件"></div>`;
+      });
+      html += `<div class="workload-busy">${w.busy[d] ? formatMinutes(w.busy[d]) : ''}</div>`;
+    });
+    html += '</div></div>';
+  });
+  return html + '</div>';
+}
+
+// =========== Monthly Cost ===========
+// 毎週の枠を月ごとの実際の日付に展開し、休業日を除いた回数と費用（/api/patterns/<キー>/months）
+function monthlySection(key) {
+  return serverSection('pattern-months', key, '/api/patterns/' + encodeURIComponent(key) + '/months', renderMonthlyCost);
+}
+
+function renderMonthlyCost(res) {
+  if (!res.count && !res.cost) return '';
+  const basis = res.fee_basis === 'per_lesson' ? '回数で按分' : '月額固定';
+  let html = `<div class="monthly-cost"><div class="workload-title">📅 月ごとの回数と費用（${res.from}〜、${basis}）</div><div class="monthly-grid">`;
+  res.months.forEach(m => {
+    html += `<div class="monthly-item${m.skipped ? ' has-closure' : ''}" title="${m.skipped ? '休業日で ' + m.skipped + '回休み' : ''}">
+      <div class="monthly-label">${parseInt(m.month.slice(5))}月</div>
+      <div class="count">${m.count}回</div>
+      <div class="monthly-fee">${m.cost.toLocaleString()}</div>
+    </div>`;
+  });
+  html += `</div><div class="monthly-total">${res.months.length}か月で ${res.cost.toLocaleString()}円（${res.count}回、月平均 ${Math.round(res.cost / res.months.length).toLocaleString()}円）</div></div>`;
+  return html;
+}
+
+// =========== Calendar Fragments ===========
+// カレンダー部分はサーバーで描画した HTML を revision ごとに受け取る。取得できないときだけ手元で描画する。
+const CALENDAR_FRAGMENT_LIMIT = 32;
+const calendarFragments = new Map(); // 'revision|パターン|曜日' -> HTML
+let pendingSave = Promise.resolve();
+let savesInFlight = 0;
+
+function calendarCacheKey(key, days) {
+  return (appData.revision || 0) + '|' + key + '|' + days.join('');
+}
+
+function calendarPlaceholder(key, days, stats) {
+  const cached = savesInFlight ? undefined : calendarFragments.get(calendarCacheKey(key, days));
+  if (cached !== undefined) return `<div id="pattern-calendar">${cached}</div>`;
+  const previous = document.getElementById('pattern-calendar');
+  const keep = previous && previous.dataset.key === key ? previous.innerHTML : '';
+  setTimeout(() => loadPatternCalendar(key, days, stats), 0);
+  return `<div id="pattern-calendar" data-key="${escHtml(key)}" style="min-height:${(22 - 7) * 64}px">${keep}</div>`;
+}
+
+function loadPatternCalendar(key, days, stats) {
+  pendingSave.then(() => {
+    const cacheKey = calendarCacheKey(key, days);
+    if (calendarFragments.has(cacheKey)) return calendarFragments.get(cacheKey);
+    return fetch('/api/patterns/' + encodeURIComponent(key) + '/calendar?days=' + encodeURIComponent(days.join('')))
+      .then(r => {
+        if (!r.ok) throw new Error('HTTP ' + r.status);
+        return r.text();
+      })
+      .then(html => {
+        calendarFragments.set(cacheKey, html);
+        if (calendarFragments.size > CALENDAR_FRAGMENT_LIMIT) calendarFragments.delete(calendarFragments.keys().next().value);
+        return html;
+      });
+  }).catch(() => renderCalendarHtml(days, stats)).then(html => {
+    const el = document.getElementById('pattern-calendar');
+    if (!el || activePatternTab !== key || patternDayFilter.join('') !== days.join('')) return;
+    el.innerHTML = html;
+    el.dataset.key = key;
+  });
+}
+
+function renderCalendarHtml(filteredDays, stats) {
+  const PX_PER_HOUR = 64;
+  const minH = 7;
+  const maxH = 22;
+  const dispHours = maxH - minH;
+  const gridH = dispHours * PX_PER_HOUR;
+  const numDays = filteredDays.length;
+
+  let html = `<div class="schedule-wrapper"><div class="cal-grid" style="grid-template-columns:54px repeat(${numDays}, 1fr);grid-template-rows:auto ${gridH}px;min-width:${Math.max(200, numDays * 100 + 54)}px">`;
+
+  html += `<div class="cal-header" style="background:var(--pattern-color)"></div>`;
+  filteredDays.forEach(d => {
+    html += `<div class="cal-header" style="background:var(--pattern-color)">${d}</div>`;
+  });
+
+  html += `<div class="cal-time-labels" style="position:relative;">`;
+  for (let h = minH; h < maxH; h++) {
+    const top = (h - minH) * PX_PER_HOUR;
+    html += `<div class="cal-time-label" style="position:absolute;top:${top}px;left:0;right:0;height:${PX_PER_HOUR}px;">${h}:00</div>`;
+  }
+  html += `</div>`;
+
+  filteredDays.forEach(d => {
+    html += `<div class="cal-day-col" style="position:relative;height:${gridH}px;">`;
+
+    for (let h = minH; h < maxH; h++) {
+      const top = (h - minH) * PX_PER_HOUR;
+      html += `<div class="cal-hour-line" style="top:${top}px;"></div>`;
+    }
+
+    const dayEvents = stats.events[d] || [];
+    dayEvents.forEach(ev => {
+      const topPx = ((ev.startMin / 60) - minH) * PX_PER_HOUR;
+      const heightPx = Math.max(((ev.endMin - ev.startMin) / 60) * PX_PER_HOUR, 24);
+      const who = whoStyle(ev.lesson);
+      const overlapStyle = ev.overlapStyle;
+
+      const whoEmoji = whoIcons(ev.lesson);
+      const schoolTip = ev.lesson.school ? '\\n教室: ' + ev.lesson.school : '';
+      const addressTip = ev.lesson.address ? '\\n場所: ' + ev.lesson.address : '';
+      const feeTip = ev.lesson.fee ? '\\n月謝: ' + parseInt(ev.lesson.fee).toLocaleString() + '円' : '';
+      const memoTip = ev.lesson.memo ? '\\nメモ: ' + ev.lesson.memo : '';
+      const tooltip = `[${ev.lesson.id}] ${ev.lesson.name}\\n対象: ${ev.lesson.who}\\n時間: ${ev.lesson.start}〜${ev.lesson.end}${schoolTip}${addressTip}${feeTip}${memoTip}`;
+
+      html += `<div class="cal-event ${who.cls}" style="top:${topPx}px;height:${heightPx}px;${overlapStyle}${who.style}" title="${tooltip}">`;
+      const schoolSuffix = ev.lesson.school ? '【' + ev.lesson.school + '】' : '';
+      html += `<div class="cal-event-name">${ev.lesson.id} ${ev.lesson.name}${schoolSuffix}</div>`;
+      if (heightPx >= 34) {
+        html += `<div class="cal-event-who">${whoEmoji} ${ev.lesson.who}</div>`;
+      }
+      if (heightPx >= 56) {
+        html += `<div class="cal-event-detail">${ev.lesson.start}〜${ev.lesson.end}</div>`;
+      }
+      html += `</div>`;
+    });
+
+    html += `</div>`;
+  });
+  html += `</div></div>`;
+
+  return html;
+}
+
+// =========== Patterns ===========
+let activePatternTab = null;
+let patternDayFilter = ['月','火','水','木','金','土','日'];
+let patternPersonFilter = 'all';
+let patternCollapsedGroups = new Set();
+
+function switchPatternTab(key) {
+  activePatternTab = key;
+  renderPatterns();
+}
+
+function toggleDayFilter(day) {
+  const idx = patternDayFilter.indexOf(day);
+  if (idx >= 0) {
+    if (patternDayFilter.length === 1) return; // keep at least 1 day
+    patternDayFilter.splice(idx, 1);
+  } else {
+    patternDayFilter.push(day);
+    // restore DAYS order
+    patternDayFilter.sort((a, b) => DAYS.indexOf(a) - DAYS.indexOf(b));
+  }
+  renderPatterns();
+}
+
+function resetDayFilter() {
+  patternDayFilter = ['月','火','水','木','金','土','日'];
+  renderPatterns();
+}
+
+function setPatternPersonFilter(filter) {
+  patternPersonFilter = filter;
+  renderPatterns();
+}
+
+function toggleGroupCollapse(catKey) {
+  if (patternCollapsedGroups.has(catKey)) {
+    patternCollapsedGroups.delete(catKey);
+  } else {
+    patternCollapsedGroups.add(catKey);
+  }
+  renderPatterns();
+}
+
+function selectAllInGroup(patKey, catKey, selectAll) {
+  const pat = appData.patterns[patKey];
+  const removed = new Set();
+  const person = validPersonFilter(patternPersonFilter);
+
+  appData.lessons.filter(l => l.id).forEach(lesson => {
+    if (getCategoryLetter(lesson.name) !== catKey) return;
+    if (person !== 'all' && !lessonMembers(lesson).includes(person)) return;
+    if (lesson.day && !patternDayFilter.includes(lesson.day)) return;
+    const selected = isInPattern(patKey, lesson.id);
+    if (selectAll && !selected) {
+      pat.ids.push(lesson.id);
+    } else if (!selectAll && selected) {
+      removed.add(lesson.id);
+    }
+  });
+  if (removed.size) pat.ids = pat.ids.filter(id => !removed.has(id));
+  invalidatePatternStats([patKey]);
+  saveToServer();
+  renderPatterns();
+}
+
+function renderPatterns() {
+  const tabsContainer = document.getElementById('pattern-tabs');
+  const grid = document.getElementById('patterns-grid');
+
+  const patKeys = patternKeys();
+  if (!appData.patterns[activePatternTab]) activePatternTab = patKeys[0];
+
+  // Render sub-tabs
+  let tabsHtml = '';
+  patKeys.forEach(key => {
+    const pat = appData.patterns[key];
+    const stats = getPatternStats(key);
+    const isActive = key === activePatternTab;
+    tabsHtml += `<button class="pattern-tab${isActive ? ' active' : ''}" style="--pattern-color:${patternColor(key)}" onclick="switchPatternTab('${key}')">
+      ${escHtml(pat.name || 'パターン'+key)}
+      <span style="font-size:0.75rem;opacity:0.85;display:block;">${stats.total}件 / ${stats.fee ? stats.fee.toLocaleString()+'円' : '-'}</span>
+    </button>`;
+  });
+  tabsHtml += `<button class="pattern-tab add" onclick="addPattern()" title="パターンを追加">＋</button>`;
+  tabsContainer.innerHTML = tabsHtml;
+
+  // Render active pattern only
+  grid.innerHTML = '';
+  if (!patKeys.length) return;
+  const key = activePatternTab;
+  const color = patternColor(key);
   const pat = appData.patterns[key];
-  const selectedIds = pat.ids || [];
-  const stats = calcStats(selectedIds);
+  const selectedBits = patternBits(key);
+  const selectedIds = bitsToIds(selectedBits);
+  const stats = getPatternStats(key);
 
   let html = `
-    <div class="pattern-card">
-      <div class="pattern-header ${pi}">
-        📋 ${pat.name || 'パターン'+key}
+    <div class="pattern-card" style="--pattern-color:${color}">
+      <div class="pattern-header">
+        📋 ${escHtml(pat.name || 'パターン'+key)}
+        <button class="csv-btn" style="float:right;padding:2px 8px;font-size:0.75rem;" onclick="exportLessons('csv', {pattern: '${key}', who: personFilterParam(patternPersonFilter)})">📥 CSV</button>
+        <button class="csv-btn" style="float:right;padding:2px 8px;font-size:0.75rem;margin-right:6px;" onclick="showCalendarFeed('${key}')">🗓 購読</button>
       </div>
       <div class="pattern-body">
+        <div class="pattern-toolbar">
+          <button class="csv-btn" onclick="renamePattern('${key}')">✏️ 名前変更</button>
+          <button class="csv-btn" onclick="duplicatePattern('${key}')">📄 複製</button>
+          <button class="csv-btn" onclick="deletePattern('${key}')">🗑 削除</button>`;
+  if (patKeys.length > 1) {
+    html += `<span>このパターンと</span>
+          <select id="pattern-combine-with">${patKeys.filter(k => k !== key).map(k => `<option value="${k}">${escHtml(appData.patterns[k].name || k)}</option>`).join('')}</select>
+          <select id="pattern-combine-op"><option value="union">の和</option><option value="intersect">の共通</option><option value="difference">にないもの</option></select>
+          <button class="csv-btn" onclick="combinePatterns('${key}')">で新規パターン</button>`;
+  }
+  html += `</div>
         <div style="font-size:0.8rem;color:var(--text-sub);margin-bottom:8px;">採用する候補をクリック：</div>`;
 
   // Person filter for pattern tab
-  const f = appData.family;
-  const sisterName = f.sister ? f.sister.name : 'お姉ちゃん';
-  const brotherName = f.brother ? f.brother.name : '弟くん';
+  const people = getPersonIndex();
+  patternPersonFilter = validPersonFilter(patternPersonFilter);
   const lessonsWithId = appData.lessons.filter(l => l.id);
-  const allCount = lessonsWithId.length;
-  const sisterCount = lessonsWithId.filter(l => l.who === sisterName || (l.who && l.who.includes(sisterName))).length;
-  const brotherCount = lessonsWithId.filter(l => l.who === brotherName || (l.who && l.who.includes(brotherName))).length;
 
   html += `<div class="person-filter" style="margin-bottom:8px;">
-    <button class="person-filter-btn${patternPersonFilter==='all'?' active-all':''}" onclick="setPatternPersonFilter('all')">
-      📋 全員<span class="person-count">${allCount}件</span>
-    </button>
-    <button class="person-filter-btn${patternPersonFilter==='sister'?' active-sister':''}" onclick="setPatternPersonFilter('sister')">
-      👧 ${sisterName}<span class="person-count">${sisterCount}件</span>
-    </button>
-    <button class="person-filter-btn${patternPersonFilter==='brother'?' active-brother':''}" onclick="setPatternPersonFilter('brother')">
-      👶 ${brotherName}<span class="person-count">${brotherCount}件</span>
-    </button>
+    ${personFilterButtons(patternPersonFilter, 'setPatternPersonFilter', id => people.withId.get(id), lessonsWithId.length)}
   </div>`;
 
   // Day filter buttons (above chips for filtering)
@@ -1561,8 +5283,7 @@ function renderPatterns() {
   // Filter lessons by person and day
   let filteredLessons = lessonsWithId.slice();
   if (patternPersonFilter !== 'all') {
-    const filterName = patternPersonFilter === 'sister' ? sisterName : brotherName;
-    filteredLessons = filteredLessons.filter(l => l.who === filterName || (l.who && l.who.includes(filterName)));
+    filteredLessons = filteredLessons.filter(l => people.byLesson.get(l).includes(patternPersonFilter));
   }
   filteredLessons = filteredLessons.filter(l => !l.day || patternDayFilter.includes(l.day));
   filteredLessons.sort((a, b) => naturalCompare(a.id, b.id));
@@ -1588,7 +5309,7 @@ function renderPatterns() {
     }
     groups[catLetter].schools[school].push(lesson);
     groups[catLetter].count++;
-    if (selectedIds.includes(lesson.id)) groups[catLetter].selectedCount++;
+    if (isInPattern(key, lesson.id)) groups[catLetter].selectedCount++;
   });
 
   // Render grouped chips
@@ -1624,18 +5345,21 @@ function renderPatterns() {
         }
         html += `<div class="pattern-ids">`;
         group.schools[school].forEach(lesson => {
-          const isSelected = selectedIds.includes(lesson.id);
+          const isSelected = isInPattern(key, lesson.id);
+          const fits = fitsAvailability(lesson);
           const cls = getLessonClass(lesson.name);
-          const whoMark = getWhoEmoji(lesson.who);
+          const whoMark = whoIcons(lesson);
           const dayLabel = lesson.day || '';
           const timeLabel = lesson.start || '';
           // Extract variant from name (e.g., ベビー, リトル, キンダー)
           const variantMatch = lesson.name.match(/[（(]([^）)]+)[）)]/);
           const variant = variantMatch ? variantMatch[1] : '';
           const chipLabel = [dayLabel, timeLabel, variant].filter(Boolean).join(' ');
-          html += `<button class="pattern-chip ${isSelected ? 'selected '+cls : ''}"
+          const repeatMark = lesson.repeat && lesson.repeat !== '毎週' ? '🔁' : '';
+          html += `<button class="pattern-chip ${isSelected ? 'selected '+cls : ''}${fits ? '' : ' out-of-window'}"
+                    title="${fits ? escHtml(lesson.repeat || '') : '空き時間帯の外です'}"
                     onclick="togglePatternId('${key}','${escHtml(lesson.id)}')">
-                    ${chipLabel || lesson.name} ${whoMark}
+                    ${chipLabel || lesson.name} ${whoMark}${repeatMark}
                    </button>`;
         });
         html += `</div>`;
@@ -1648,97 +5372,8 @@ function renderPatterns() {
 
   html += `</div>`;
 
-  // Calendar-style schedule (full day view)
-  const PX_PER_HOUR = 64;
-  const minH = 7;
-  const maxH = 22;
-  const dispHours = maxH - minH;
-  const gridH = dispHours * PX_PER_HOUR;
-  const numDays = filteredDays.length;
-
-  html += `<div class="schedule-wrapper"><div class="cal-grid" style="grid-template-columns:54px repeat(${numDays}, 1fr);grid-template-rows:auto ${gridH}px;min-width:${Math.max(200, numDays * 100 + 54)}px">`;
-
-  html += `<div class="cal-header" style="background:var(--pattern-${pi})"></div>`;
-  filteredDays.forEach(d => {
-    html += `<div class="cal-header" style="background:var(--pattern-${pi})">${d}</div>`;
-  });
-
-  html += `<div class="cal-time-labels" style="position:relative;">`;
-  for (let h = minH; h < maxH; h++) {
-    const top = (h - minH) * PX_PER_HOUR;
-    html += `<div class="cal-time-label" style="position:absolute;top:${top}px;left:0;right:0;height:${PX_PER_HOUR}px;">${h}:00</div>`;
-  }
-  html += `</div>`;
-
-  filteredDays.forEach(d => {
-    html += `<div class="cal-day-col" style="position:relative;height:${gridH}px;">`;
-
-    for (let h = minH; h < maxH; h++) {
-      const top = (h - minH) * PX_PER_HOUR;
-      html += `<div class="cal-hour-line" style="top:${top}px;"></div>`;
-    }
-
-    const dayEvents = [];
-    selectedIds.forEach(id => {
-      const lesson = appData.lessons.find(l => l.id === id);
-      if (!lesson || lesson.day !== d || !lesson.start || !lesson.end) return;
-      const sParts = lesson.start.split(':');
-      const eParts = lesson.end.split(':');
-      const startMin = parseInt(sParts[0]) * 60 + parseInt(sParts[1] || 0);
-      const endMin = parseInt(eParts[0]) * 60 + parseInt(eParts[1] || 0);
-      dayEvents.push({ lesson, startMin, endMin });
-    });
-
-    dayEvents.sort((a, b) => a.startMin - b.startMin);
-    dayEvents.forEach((ev, i) => {
-      let overlapIdx = 0;
-      for (let j = 0; j < i; j++) {
-        if (dayEvents[j].endMin > ev.startMin) {
-          overlapIdx = (dayEvents[j].overlapIdx || 0) + 1;
-        }
-      }
-      ev.overlapIdx = overlapIdx;
-    });
-
-    dayEvents.forEach(ev => {
-      const topPx = ((ev.startMin / 60) - minH) * PX_PER_HOUR;
-      const heightPx = Math.max(((ev.endMin - ev.startMin) / 60) * PX_PER_HOUR, 24);
-      const whoCls = getWhoClass(ev.lesson.who);
-      const whoCalCls = whoCls === 'brother' ? 'who-brother' : whoCls === 'sister' ? 'who-sister' : 'who-both';
-
-      const hasOverlap = dayEvents.filter(other => other !== ev && other.startMin < ev.endMin && other.endMin > ev.startMin).length > 0;
-      let overlapStyle = '';
-      if (hasOverlap) {
-        const overlapGroup = dayEvents.filter(other => other.startMin < ev.endMin && other.endMin > ev.startMin);
-        const myIdx = overlapGroup.indexOf(ev);
-        const total = overlapGroup.length;
-        const widthPct = 100 / total;
-        const leftPct = myIdx * widthPct;
-        overlapStyle = `left:calc(${leftPct}% + 2px);right:calc(${100 - leftPct - widthPct}% + 2px);`;
-      }
-
-      const whoEmoji = getWhoEmoji(ev.lesson.who);
-      const schoolTip = ev.lesson.school ? '\\n教室: ' + ev.lesson.school : '';
-      const addressTip = ev.lesson.address ? '\\n場所: ' + ev.lesson.address : '';
-      const feeTip = ev.lesson.fee ? '\\n月謝: ' + parseInt(ev.lesson.fee).toLocaleString() + '円' : '';
-      const memoTip = ev.lesson.memo ? '\\nメモ: ' + ev.lesson.memo : '';
-      const tooltip = `[${ev.lesson.id}] ${ev.lesson.name}\\n対象: ${ev.lesson.who}\\n時間: ${ev.lesson.start}〜${ev.lesson.end}${schoolTip}${addressTip}${feeTip}${memoTip}`;
-
-      html += `<div class="cal-event ${whoCalCls}" style="top:${topPx}px;height:${heightPx}px;${overlapStyle}" title="${tooltip}">`;
-      const schoolSuffix = ev.lesson.school ? '【' + ev.lesson.school + '】' : '';
-      html += `<div class="cal-event-name">${ev.lesson.id} ${ev.lesson.name}${schoolSuffix}</div>`;
-      if (heightPx >= 34) {
-        html += `<div class="cal-event-who">${whoEmoji} ${ev.lesson.who}</div>`;
-      }
-      if (heightPx >= 56) {
-        html += `<div class="cal-event-detail">${ev.lesson.start}〜${ev.lesson.end}</div>`;
-      }
-      html += `</div>`;
-    });
-
-    html += `</div>`;
-  });
-  html += `</div></div>`;
+  // Calendar-style schedule: サーバーで描画したものを使う
+  html += calendarPlaceholder(key, filteredDays, stats);
 
   // Day counts
   html += `<div class="day-counts">`;
@@ -1749,106 +5384,256 @@ function renderPatterns() {
   });
   html += `</div>`;
 
+  html += workloadSection(key);
+  html += monthlySection(key);
+
+  html += renderTravelWarnings(travelIssues(selectedIds));
+
   // Stats
   html += `<div class="stats-row">
     <div class="stat-box"><div class="stat-num">${stats.total}</div><div class="stat-label">合計件数</div></div>
     <div class="stat-box"><div class="stat-num ${stats.fee > (parseInt(appData.conditions.budget)||Infinity) ? 'warn' : ''}">${stats.fee ? stats.fee.toLocaleString() : '-'}</div><div class="stat-label">月謝合計(円)</div></div>
-    <div class="stat-box" style="border-left:3px solid var(--sister)"><div class="stat-num">${stats.sisterCount}</div><div class="stat-label">${appData.family.sister ? appData.family.sister.name : '姉'}の件数</div></div>
-    <div class="stat-box" style="border-left:3px solid var(--brother)"><div class="stat-num">${stats.brotherCount}</div><div class="stat-label">${appData.family.brother ? appData.family.brother.name : '弟'}の件数</div></div>
+    ${familyMembers().filter(m => m.role === 'child' || stats.people[m.id]).map(m =>
+      `<div class="stat-box" style="${memberStyle(m.id)}border-left:3px solid var(--who)"><div class="stat-num">${stats.people[m.id] || 0}</div><div class="stat-label">${escHtml(m.name || '')}の件数</div></div>`).join('')}
   </div>`;
 
+  html += renderPatternComparison(key);
+
   html += `</div></div>`;
   grid.innerHTML = html;
 }
 
 function togglePatternId(patKey, lessonId) {
-  const ids = appData.patterns[patKey].ids;
-  const idx = ids.indexOf(lessonId);
-  if (idx >= 0) ids.splice(idx, 1);
-  else ids.push(lessonId);
+  const pat = appData.patterns[patKey];
+  const selected = isInPattern(patKey, lessonId);
+  if (!selected) {
+    const lesson = appData.lessons.find(l => l.id === lessonId);
+    if (lesson && !fitsAvailability(lesson)) {
+      alert('空き時間帯の外のため追加できません（基本情報の前提条件を確認してください）');
+      return;
+    }
+  }
+  if (!selected && appData.conditions.travel_strict) {
+    const blocked = travelIssues(bitsToIds(patternBits(patKey)).concat([lessonId])).filter(i => i.kind === 'impossible' && (i.from === lessonId || i.to === lessonId));
+    if (blocked.length) {
+      alert('移動が間に合わないため追加できません: ' + blocked.map(i => i.from + ' → ' + i.to).join(', '));
+      return;
+    }
+  }
+  if (selected) pat.ids = pat.ids.filter(id => id !== lessonId);
+  else pat.ids.push(lessonId);
+  invalidatePatternStats([patKey]);
   saveToServer();
   renderPatterns();
 }
 
-function calcStats(selectedIds) {
-  let total = 0, fee = 0, sisterCount = 0, brotherCount = 0;
+function calcStats(bits) {
+  let total = 0, fee = 0;
+  const people = {}; // 人の番号 → 件数（複数人の習い事はそれぞれに数える）
   const dayCounts = {};
   DAYS.forEach(d => { dayCounts[d] = 0; });
-  
-  selectedIds.forEach(id => {
-    const lesson = appData.lessons.find(l => l.id === id);
-    if (!lesson) return;
+  const lessons = getPatternIndex().lessons;
+
+  bits.forEach(o => {
+    const lesson = lessons[o];
     total++;
     if (lesson.fee) fee += parseInt(lesson.fee) || 0;
     if (lesson.day) dayCounts[lesson.day] = (dayCounts[lesson.day]||0) + 1;
-    const wCls = getWhoClass(lesson.who);
-    if (wCls === 'sister' || wCls === 'both') sisterCount++;
-    if (wCls === 'brother' || wCls === 'both') brotherCount++;
+    lessonMembers(lesson).forEach(id => { people[id] = (people[id] || 0) + 1; });
   });
-  return { total, fee, sisterCount, brotherCount, dayCounts };
+  return { total, fee, people, dayCounts };
 }
 
 // =========== Family ===========
 function renderFamily() {
   const container = document.getElementById('family-list');
-  const members = [
-    { key: 'papa', icon: '👨', bg: '#e8f2fb' },
-    { key: 'mama', icon: '👩', bg: '#fdf0f3' },
-    { key: 'sister', icon: '👧', bg: 'var(--sister-bg)', hasBirthday: true },
-    { key: 'brother', icon: '👶', bg: 'var(--brother-bg)', hasBirthday: true },
-  ];
+  const index = getPersonIndex();
   let html = '';
-  members.forEach(m => {
-    const data = appData.family[m.key] || {};
-    html += `<div style="padding:16px;border-radius:8px;background:${m.bg};">
-      <div style="font-weight:700;margin-bottom:8px;">${m.icon} ${data.name || m.key}</div>
+  familyMembers().forEach(m => {
+    const isChild = m.role === 'child';
+    const count = index.lessons.get(m.id).length;
+    html += `<div style="padding:16px;border-radius:8px;background:${memberColors(m.id)[1]};">
+      <div style="font-weight:700;margin-bottom:8px;">${m.icon || ''} ${escHtml(m.name || '')}
+        <span style="font-weight:400;font-size:0.8rem;color:var(--text-sub);">${isChild ? '子ども' : '大人'}・習い事${count}件</span>
+        <button class="del-btn" style="float:right" onclick="deleteFamilyMember(${m.id})" title="削除">✕</button>
+      </div>
       <div class="form-grid" style="grid-template-columns:repeat(auto-fit,minmax(160px,1fr))">
         <div class="form-group">
           <label>呼び名</label>
-          <input value="${data.name || ''}" onchange="updateFamily('${m.key}','name',this.value)" placeholder="名前">
+          <input value="${escHtml(m.name || '')}" onchange="updateFamily(${m.id},'name',this.value)" placeholder="名前">
+        </div>
+        <div class="form-group">
+          <label>アイコン</label>
+          <input value="${escHtml(m.icon || '')}" onchange="updateFamily(${m.id},'icon',this.value)" placeholder="🧒" style="width:60px">
         </div>`;
-    if (m.hasBirthday) {
+    if (isChild) {
       html += `<div class="form-group">
           <label>生年月日</label>
-          <input type="date" value="${data.birthday || ''}" onchange="updateFamily('${m.key}','birthday',this.value)">
+          <input type="date" value="${m.birthday || ''}" onchange="updateFamily(${m.id},'birthday',this.value)">
         </div>`;
     }
-    html += `<div class="form-group"${!m.hasBirthday ? ' style="grid-column:span 2"' : ''}>
+    html += `<div class="form-group"${!isChild ? ' style="grid-column:span 2"' : ''}>
           <label>メモ</label>
-          <input value="${data.info || ''}" onchange="updateFamily('${m.key}','info',this.value)" placeholder="職業・園など">
+          <input value="${escHtml(m.info || '')}" onchange="updateFamily(${m.id},'info',this.value)" placeholder="職業・園など">
         </div>
       </div>
     </div>`;
   });
+  html += `<div><button class="csv-btn" onclick="addFamilyMember('child')">＋ 子どもを追加</button>
+    <button class="csv-btn" onclick="addFamilyMember('parent')">＋ 大人を追加</button></div>`;
   container.innerHTML = html;
 }
 
-function updateFamily(memberKey, field, value) {
-  if (!appData.family[memberKey]) appData.family[memberKey] = {};
-  const oldName = appData.family[memberKey].name || '';
-  appData.family[memberKey][field] = value;
-
-  // When name changes, update lesson who fields and pattern references
-  if (field === 'name' && oldName && oldName !== value) {
-    const otherKey = memberKey === 'sister' ? 'brother' : 'sister';
-    const otherName = appData.family[otherKey] ? appData.family[otherKey].name : '';
-    const oldBothName = oldName + '＋' + otherName;
-    const oldBothNameRev = otherName + '＋' + oldName;
-    const newBothName = value + '＋' + otherName;
-    const newBothNameFromOther = otherName + '＋' + value;
-
-    appData.lessons.forEach(lesson => {
-      if (lesson.who === oldName) {
-        lesson.who = value;
-      } else if (lesson.who === oldBothName || lesson.who === oldBothNameRev) {
-        lesson.who = memberKey === 'sister' ? newBothName : newBothNameFromOther;
-      }
+function renderPeople() {
+  renderFamily();
+  renderPersonFilter();
+  renderLessons();
+}
+
+function addFamilyMember(role) {
+  // 番号は next_id から振り、削除した人の番号は使い回さない
+  if (!appData.family || !appData.family.members) appData.family = { members: [], next_id: 1 };
+  const family = appData.family;
+  const id = Math.max(family.next_id || 1, ...family.members.map(m => m.id + 1));
+  family.next_id = id + 1;
+  family.members.push({ id, name: '', role, icon: role === 'child' ? '🧒' : '🧑', birthday: '', info: '' });
+  saveToServer();
+  renderPeople();
+}
+
+function deleteFamilyMember(memberId) {
+  const index = getPersonIndex();
+  const member = index.byId.get(memberId);
+  const positions = index.lessons.get(memberId);
+  const note = positions.length ? `\\n（${positions.length}件の習い事の対象から外れます）` : '';
+  if (!confirm(`${member.name || 'この人'}を削除しますか？` + note)) return;
+  appData.family.members = familyMembers().filter(m => m.id !== memberId);
+  positions.forEach(idx => {
+    const lesson = appData.lessons[idx];
+    lesson.members = index.byLesson.get(lesson).filter(id => id !== memberId);
+    lesson.who = whoFromMembers(lesson.members);
+  });
+  clearPatternStats();
+  saveToServer();
+  renderPeople();
+}
+
+function updateFamily(memberId, field, value) {
+  // 名前を変える前の索引で対象の習い事を引く（members の無い習い事は古い呼び名で対応付いている）
+  const index = getPersonIndex();
+  const member = index.byId.get(memberId);
+  if (!member) return;
+  const oldName = member.name || '';
+  member[field] = value;
+
+  // 習い事は番号で参照しているので、名前が変わったら表示用の who を作り直すだけ
+  if (field === 'name' && oldName !== value) {
+    index.lessons.get(memberId).forEach(idx => {
+      const lesson = appData.lessons[idx];
+      lesson.members = index.byLesson.get(lesson);
+      lesson.who = whoFromMembers(lesson.members);
     });
-    renderLessons();
   }
 
   saveToServer();
-  renderFamily();
+  if (field === 'name' || field === 'icon') renderPeople();
+  else renderFamily();
+}
+
+// =========== Travel Time ===========
+// 移動時間は「出発\t到着」をキーにした Map に変換しておき、隣り合う2件ごとに1回引くだけにする
+let travelIndex = new Map();
+let travelIndexSource = null;
+
+function parseMinutes(text) {
+  const s = String(text || '').replace(/[０-９]/g, c => String.fromCharCode(c.charCodeAt(0) - 0xFEE0));
+  const h = s.match(/([0-9]+(?:\\.[0-9]+)?)\\s*時間/);
+  const m = s.match(/([0-9]+)\\s*分/);
+  if (h || m) return Math.floor(h ? parseFloat(h[1]) * 60 : 0) + (m ? parseInt(m[1]) : 0);
+  const d = s.match(/[0-9]+/);
+  return d ? parseInt(d[0]) : null;
+}
+
+function getTravelIndex() {
+  if (travelIndexSource === appData.travel_times) return travelIndex;
+  const entries = (appData.travel_times || []).filter(e => e.from && e.to && parseMinutes(e.minutes) !== null);
+  travelIndex = new Map();
+  entries.forEach(e => travelIndex.set(e.from + '\t' + e.to, parseMinutes(e.minutes)));
+  entries.forEach(e => {
+    const rev = e.to + '\t' + e.from;
+    if (!travelIndex.has(rev)) travelIndex.set(rev, parseMinutes(e.minutes));
+  });
+  travelIndexSource = appData.travel_times;
+  return travelIndex;
+}
+
+function travelIssues(ids) {
+  const index = getTravelIndex();
+  const limit = parseMinutes(appData.conditions.travel_limit);
+  const byId = new Map(appData.lessons.filter(l => l.id).map(l => [l.id, l]));
+  const byDay = {};
+  ids.forEach(id => {
+    const l = byId.get(id);
+    if (l && l.day && l.start && l.end) (byDay[l.day] = byDay[l.day] || []).push(l);
+  });
+  const issues = [];
+  Object.keys(byDay).forEach(day => {
+    const list = byDay[day].sort((a, b) => timeToMin(a.start) - timeToMin(b.start));
+    for (let i = 1; i < list.length; i++) {
+      const prev = list[i - 1], next = list[i];
+      const gap = timeToMin(next.start) - timeToMin(prev.end);
+      if (gap < 0 || !prev.school || !next.school || prev.school === next.school) continue;
+      const minutes = index.has(prev.school + '\t' + next.school) ? index.get(prev.school + '\t' + next.school) : null;
+      let kind = null;
+      if (minutes === null) kind = 'unknown';
+      else if (minutes > gap) kind = 'impossible';
+      else if (limit !== null && minutes > limit) kind = 'over_limit';
+      if (kind) issues.push({ kind, day, from: prev.id, to: next.id, fromSchool: prev.school, toSchool: next.school, gap, minutes });
+    }
+  });
+  return issues;
+}
+
+function renderTravelWarnings(issues) {
+  if (!issues.length) return '';
+  const labels = { impossible: '移動が間に合いません', over_limit: '送迎の許容範囲を超えています', unknown: '移動時間が未登録です' };
+  let html = '<div class="travel-warnings">';
+  issues.forEach(i => {
+    const detail = i.minutes === null ? `間隔 ${i.gap}分` : `移動 ${i.minutes}分 / 間隔 ${i.gap}分`;
+    html += `<div class="travel-warning ${i.kind}">🚗 ${labels[i.kind]}（${i.day}）${escHtml(i.from)}【${escHtml(i.fromSchool)}】→ ${escHtml(i.to)}【${escHtml(i.toSchool)}】 ${detail}</div>`;
+  });
+  return html + '</div>';
+}
+
+function renderTravel() {
+  const container = document.getElementById('travel-list');
+  const schools = [...new Set(appData.lessons.map(l => l.school).filter(Boolean))].sort();
+  const options = (current) => '<option value="">-</option>' + schools.concat(schools.includes(current) || !current ? [] : [current])
+    .map(s => `<option value="${escHtml(s)}" ${s === current ? 'selected' : ''}>${escHtml(s)}</option>`).join('');
+  container.innerHTML = (appData.travel_times || []).map((e, i) => `<div class="travel-row">
+      <select onchange="updateTravel(${i},'from',this.value)">${options(e.from)}</select>
+      →
+      <select onchange="updateTravel(${i},'to',this.value)">${options(e.to)}</select>
+      <input type="number" min="0" value="${e.minutes === undefined ? '' : e.minutes}" onchange="updateTravel(${i},'minutes',this.value)" placeholder="15" style="width:70px">分
+      <button class="del-btn" onclick="deleteTravel(${i})" title="削除">✕</button>
+    </div>`).join('');
+}
+
+function addTravel() {
+  appData.travel_times = (appData.travel_times || []).concat([{ from: '', to: '', minutes: '' }]);
+  renderTravel();
+}
+
+function updateTravel(idx, field, value) {
+  appData.travel_times = appData.travel_times.map((e, i) => i === idx ? Object.assign({}, e, { [field]: field === 'minutes' ? parseMinutes(value) : value }) : e);
+  saveToServer();
+  renderTravel();
+}
+
+function deleteTravel(idx) {
+  appData.travel_times = appData.travel_times.filter((_, i) => i !== idx);
+  saveToServer();
+  renderTravel();
 }
 
 // =========== Conditions ===========
@@ -1860,6 +5645,9 @@ function loadConditions() {
   document.getElementById('cond-weekday').value = c.weekday_available || '';
   document.getElementById('cond-weekend').value = c.weekend_available || '';
   document.getElementById('cond-papa').value = c.papa_days || '';
+  document.getElementById('cond-travel-strict').checked = !!c.travel_strict;
+  document.getElementById('cond-closures').value = c.closures || '';
+  document.getElementById('cond-fee-basis').value = c.fee_basis || 'monthly';
 }
 
 function saveConditions() {
@@ -1870,16 +5658,418 @@ function saveConditions() {
     weekday_available: document.getElementById('cond-weekday').value,
     weekend_available: document.getElementById('cond-weekend').value,
     papa_days: document.getElementById('cond-papa').value,
+    travel_strict: document.getElementById('cond-travel-strict').checked,
+    closures: document.getElementById('cond-closures').value,
+    fee_basis: document.getElementById('cond-fee-basis').value,
   };
-  saveToServer();
+  saveToServer().then(loadAvailability);
+}
+
+// =========== Availability ===========
+// 空き時間帯はサーバーで変換済みのものを受け取り、曜日ごとの [開始分, 終了分] の配列として持つ
+let availability = null;
+
+function loadAvailability() {
+  return fetch('/api/constraints').then(r => r.json()).then(res => {
+    availability = {};
+    Object.keys(res.days).forEach(d => {
+      availability[d] = res.days[d].map(w => [timeToMin(w[0]), timeToMin(w[1])]);
+    });
+    document.getElementById('availability-errors').textContent = res.errors.join(' / ');
+    document.getElementById('closure-errors').textContent = (res.closure_errors || []).join(' / ');
+    if (document.getElementById('panel-patterns').classList.contains('active')) renderPatterns();
+  });
+}
+
+function fitsAvailability(lesson) {
+  if (!availability || !lesson.day || !lesson.start || !lesson.end) return true;
+  const windows = availability[lesson.day];
+  if (!windows) return true;
+  const s = timeToMin(lesson.start), e = timeToMin(lesson.end);
+  return windows.some(w => w[0] <= s && e <= w[1]);
 }
 
 // =========== Save ===========
+// =========== Offline Sync ===========
+// 編集はまず IndexedDB に保存し、オンラインのときに「サーバーで確認済みの文書（shadow）」との差分だけを
+// まとめて /api/ops に送る。他の端末の変更と重なって載せ直せないときだけ、上書きか破棄かを選んでもらう。
+const SYNC_DEBOUNCE_MS = 300;
+const SYNC_RETRY_MAX_MS = 60000;
+// 上書きしても続けて重なる（他のタブと交互に保存し合う）ときは、この回数でサーバーの内容に合わせる
+const CONFLICT_RETRY_MAX = 3;
+// 位置で習い事を指す操作と、位置をずらす操作。ずらす操作を取り消したら、後に続く位置指定の操作も一緒に取り消す
+const POSITION_OPS = ['lesson_set', 'lesson_unset', 'lesson_insert', 'lesson_delete', 'renumber'];
+const SHIFTING_OPS = ['lesson_insert', 'lesson_delete', 'renumber'];
+let shadow = JSON.parse(JSON.stringify(appData));
+let localVersion = 0, syncedVersion = 0;
+let syncTimer = null, syncing = false, syncRetryMs = 1000, needsPull = false, conflictRetries = 0;
+let syncWaiters = [];
+let dbPromise = null;
+
+function openDb() {
+  if (!dbPromise) {
+    dbPromise = new Promise((resolve, reject) => {
+      if (!window.indexedDB) { reject(new Error('IndexedDB unavailable')); return; }
+      const req = indexedDB.open('family-schedule', 1);
+      req.onupgradeneeded = () => req.result.createObjectStore('state');
+      req.onsuccess = () => resolve(req.result);
+      req.onerror = () => reject(req.error);
+    });
+  }
+  return dbPromise;
+}
+
+function idbRequest(mode, fn) {
+  return openDb().then(db => new Promise((resolve, reject) => {
+    const req = fn(db.transaction('state', mode).objectStore('state'));
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  }));
+}
+
+function persistLocal() {
+  const state = { local: appData, shadow: shadow, dirty: localVersion !== syncedVersion };
+  return idbRequest('readwrite', st => st.put(state, 'doc')).catch(() => {});
+}
+
+function isDirty() {
+  return localVersion !== syncedVersion;
+}
+
+function cloneDoc(doc) {
+  return JSON.parse(JSON.stringify(doc));
+}
+
+function sameJson(a, b) {
+  return JSON.stringify(a) === JSON.stringify(b);
+}
+
+function diffDocs(old, cur) {
+  // サーバーの diff_ops と同じ形の編集操作を作る
+  const ops = [];
+  new Set(Object.keys(old).concat(Object.keys(cur))).forEach(key => {
+    if (key === 'revision' || key === 'lessons' || key === 'patterns') return;
+    if (!(key in cur)) ops.push({ op: 'unset', key });
+    else if (!sameJson(old[key], cur[key])) ops.push({ op: 'set', key, value: cur[key] });
+  });
+  diffLessonList(old.lessons || [], cur.lessons || [], ops);
+  diffPatternMap(old.patterns || {}, cur.patterns || {}, ops);
+  return ops;
+}
+
+function diffLessonList(a, b, ops) {
+  let head = 0;
+  while (head < a.length && head < b.length && sameJson(a[head], b[head])) head++;
+  let tail = 0;
+  while (tail < a.length - head && tail < b.length - head && sameJson(a[a.length - 1 - tail], b[b.length - 1 - tail])) tail++;
+  const oldMid = a.slice(head, a.length - tail), newMid = b.slice(head, b.length - tail);
+  if (oldMid.length === newMid.length) {
+    newMid.forEach((lesson, i) => {
+      const before = oldMid[i];
+      Object.keys(before).forEach(field => {
+        if (!(field in lesson)) ops.push({ op: 'lesson_unset', index: head + i, field });
+      });
+      Object.keys(lesson).forEach(field => {
+        if (!sameJson(before[field], lesson[field])) ops.push({ op: 'lesson_set', index: head + i, field, value: lesson[field] });
+      });
+    });
+    return;
+  }
+  if (oldMid.length) ops.push({ op: 'lesson_delete', index: head, count: oldMid.length });
+  if (newMid.length) ops.push({ op: 'lesson_insert', index: head, lessons: newMid });
+}
+
+function diffPatternMap(a, b, ops) {
+  Object.keys(a).forEach(key => { if (!(key in b)) ops.push({ op: 'pattern_delete', key }); });
+  Object.keys(b).forEach(key => {
+    const before = a[key], pat = b[key];
+    if (sameJson(before, pat)) return;
+    if (!before || !sameJson(Object.keys(before), Object.keys(pat))) {
+      ops.push({ op: 'pattern_put', key, value: pat });
+      return;
+    }
+    Object.keys(pat).forEach(field => {
+      if (field === 'ids' || sameJson(before[field], pat[field])) return;
+      ops.push({ op: 'pattern_set', key, field, value: pat[field] });
+    });
+    const oldIds = before.ids || [], newIds = pat.ids || [];
+    if (sameJson(oldIds, newIds)) return;
+    const removed = oldIds.filter(id => !newIds.includes(id));
+    const kept = oldIds.filter(id => newIds.includes(id));
+    const added = newIds.filter(id => !oldIds.includes(id));
+    if (sameJson(kept.concat(added), newIds) && new Set(newIds).size === newIds.length && new Set(oldIds).size === oldIds.length) {
+      removed.forEach(id => ops.push({ op: 'pattern_toggle', key, id, on: false }));
+      added.forEach(id => ops.push({ op: 'pattern_toggle', key, id, on: true }));
+    } else {
+      ops.push({ op: 'pattern_set', key, field: 'ids', value: newIds });
+    }
+  });
+}
+
 function saveToServer() {
-  fetch('/api/save', {
+  invalidatePatternSets();
+  localVersion++;
+  persistLocal();
+  savesInFlight++;
+  const done = new Promise(resolve => syncWaiters.push({ version: localVersion, resolve }))
+    .finally(() => { savesInFlight--; });
+  pendingSave = done;
+  clearTimeout(syncTimer);
+  syncTimer = setTimeout(runSync, SYNC_DEBOUNCE_MS);
+  return done;
+}
+
+function settleWaiters(all) {
+  syncWaiters = syncWaiters.filter(w => {
+    if (!all && w.version > syncedVersion) return true;
+    w.resolve();
+    return false;
+  });
+}
+
+function runSync() {
+  clearTimeout(syncTimer);
+  syncTimer = null;
+  if (syncing) return;
+  if (!isDirty()) { settleWaiters(true); return; }
+  if (navigator.onLine === false) { settleWaiters(true); return; }
+  const version = localVersion;
+  const sent = cloneDoc(appData);
+  const ops = diffDocs(shadow, sent);
+  if (!ops.length) {
+    syncedVersion = version;
+    settleWaiters(false);
+    persistLocal();
+    return;
+  }
+  syncing = true;
+  postOps(shadow.revision || 0, ops).then(res => {
+    syncRetryMs = 1000;
+    if (res.ok) {
+      sent.revision = res.revision;
+      shadow = sent;
+      appData.revision = res.revision;
+      syncedVersion = version;
+      conflictRetries = 0;
+      if (res.rebased) needsPull = true;
+    } else if (res.conflict) {
+      return resolveConflict();
+    } else {
+      // サーバーが受け付けない変更（移動時間の制約など）があった。1件ずつ送り直し、その変更だけを取り消す
+      return syncOneByOne(ops, version, sent, res.error);
+    }
+  }).catch(() => {
+    settleWaiters(true);
+    syncTimer = setTimeout(runSync, syncRetryMs);
+    syncRetryMs = Math.min(syncRetryMs * 2, SYNC_RETRY_MAX_MS);
+  }).finally(() => {
+    syncing = false;
+    persistLocal();
+    settleWaiters(false);
+    if (isDirty()) {
+      if (!syncTimer && navigator.onLine !== false) syncTimer = setTimeout(runSync, SYNC_DEBOUNCE_MS);
+    } else if (needsPull) {
+      reloadData();
+    }
+  });
+}
+
+function postOps(base, ops) {
+  return fetch('/api/ops', {
     method: 'POST',
-    headers: {'Content-Type': 'application/json'},
-    body: JSON.stringify(appData)
+    headers: {'Content-Type': 'application/json', 'X-Client-Id': CLIENT_ID},
+    body: JSON.stringify({ base, ops })
+  }).then(r => r.json());
+}
+
+function syncOneByOne(ops, version, sent, firstError) {
+  // まとめた送信が拒否されたので、操作を1件ずつ送って受け付けられないものだけを捨てる
+  const base = cloneDoc(shadow);
+  const errors = [];
+  let index = 0, dropped = 0, shifted = false;
+  const reject = (op, error) => {
+    dropped++;
+    if (error && !errors.includes(error)) errors.push(error);
+    if (SHIFTING_OPS.includes(op.op)) shifted = true;
+  };
+  if (ops.length === 1) reject(ops[index++], firstError);
+  const next = () => {
+    if (index >= ops.length) return null;
+    const op = ops[index];
+    if (shifted && POSITION_OPS.includes(op.op)) {
+      index++;
+      reject(op, '');
+      return next();
+    }
+    return postOps(base.revision || 0, [op]).then(res => {
+      // 他の端末の保存が割り込んだら、残りは次の同期で送る（そこで重なりとして扱う）
+      if (res.conflict) return null;
+      index++;
+      if (res.ok) {
+        applyOps(cloneDoc([op]), base);
+        base.revision = res.revision;
+        shadow = cloneDoc(base);
+      } else {
+        reject(op, res.error);
+      }
+      return next();
+    });
+  };
+  return Promise.resolve(next()).finally(() => {
+    // 受け付けられた分を確認済みにし、端末の文書は未送信の操作と送信中に行った編集を載せ直して作り直す
+    const later = localVersion !== version ? diffDocs(sent, appData) : [];
+    const doc = cloneDoc(shadow);
+    cloneDoc(ops.slice(index).concat(later)).forEach(op => {
+      if (shifted && POSITION_OPS.includes(op.op)) return;
+      try { applyOps([op], doc); } catch (e) { /* 取り消した変更に依存する操作は捨てる */ }
+    });
+    appData = doc;
+    syncedVersion = localVersion;
+    if (!sameJson(doc, shadow)) localVersion++;
+    clearPatternStats();
+    renderAll();
+    if (dropped) alert('保存できなかった変更 ' + dropped + ' 件を取り消しました' + (errors.length ? ':\\n' + errors.join('\\n') : ''));
+  });
+}
+
+function resolveConflict() {
+  conflictRetries++;
+  if (conflictRetries > CONFLICT_RETRY_MAX) {
+    alert('他の端末での保存と何度も重なったため、サーバーの内容を読み込みます');
+  } else if (confirm('他の端末での変更と重なっています。この端末の内容で上書きしますか？\\n（キャンセルするとサーバーの内容を読み込みます）')) {
+    const version = localVersion;
+    const sent = cloneDoc(appData);
+    return fetch('/api/save', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json', 'X-Client-Id': CLIENT_ID},
+      body: JSON.stringify(sent)
+    }).then(r => r.json()).then(res => {
+      if (!res.ok) { alert('保存できませんでした: ' + res.error); return; }
+      sent.revision = res.revision;
+      shadow = sent;
+      appData.revision = res.revision;
+      syncedVersion = version;
+      conflictRetries = 0;
+    });
+  }
+  conflictRetries = 0;
+  syncedVersion = localVersion;
+  needsPull = true;
+}
+
+function restoreLocalState() {
+  // 前回の未送信の編集や、キャッシュされた画面より新しい文書があれば引き継ぐ
+  return idbRequest('readonly', st => st.get('doc')).then(saved => {
+    // 旧形式の家族のまま保存されていたら直す（未送信の編集なら、直した分も差分として送られる）
+    if (saved && saved.dirty && saved.shadow) {
+      appData = saved.local;
+      migrateFamily(appData);
+      shadow = saved.shadow;
+      localVersion = 1;
+    } else if (saved && saved.local && (saved.local.revision || 0) > (appData.revision || 0)) {
+      appData = saved.local;
+      migrateFamily(appData);
+      shadow = cloneDoc(saved.local);
+    } else {
+      persistLocal();
+      return;
+    }
+    clearPatternStats();
+    renderAll();
+    if (isDirty()) runSync();
+  }).catch(() => {});
+}
+
+window.addEventListener('online', () => runSync());
+
+// =========== Live Updates ===========
+// 他のタブ・端末での保存を SSE で受け取り、差分があれば適用、なければ全体を取り直す
+const CLIENT_ID = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+function renumberPatternIds(idMap, doc = appData) {
+  Object.values(doc.patterns).forEach(pat => {
+    pat.ids = pat.ids.map(id => idMap[id] || id);
+  });
+}
+
+function applyOps(ops, doc = appData) {
+  ops.forEach(op => {
+    switch (op.op) {
+      case 'set': doc[op.key] = op.value; break;
+      case 'unset': delete doc[op.key]; break;
+      case 'lesson_set': doc.lessons[op.index][op.field] = op.value; break;
+      case 'lesson_unset': delete doc.lessons[op.index][op.field]; break;
+      case 'lesson_insert': doc.lessons.splice(op.index, 0, ...op.lessons); break;
+      case 'lesson_delete': doc.lessons.splice(op.index, op.count); break;
+      case 'renumber':
+        op.ids.forEach(([index, newId]) => { doc.lessons[index].id = newId; });
+        renumberPatternIds(op.map, doc);
+        break;
+      case 'pattern_toggle': {
+        const pat = doc.patterns[op.key];
+        if (op.on) pat.ids.push(op.id);
+        else pat.ids = pat.ids.filter(id => id !== op.id);
+        break;
+      }
+      case 'pattern_set': doc.patterns[op.key][op.field] = op.value; break;
+      case 'pattern_put': doc.patterns[op.key] = op.value; break;
+      case 'pattern_delete': delete doc.patterns[op.key]; break;
+    }
+  });
+}
+
+function renderAll() {
+  invalidatePatternSets();
+  renderPersonFilter();
+  renderLessons();
+  renderFamily();
+  loadConditions();
+  renderTravel();
+  loadAvailability();
+  if (ageFilter) loadAgeFilter(ageFilter.date).then(renderLessons);
+  if (document.getElementById('panel-patterns').classList.contains('active')) renderPatterns();
+}
+
+function reloadData() {
+  // 未送信の編集があるときは、送信が終わってから取り直す
+  if (isDirty() || syncing) { needsPull = true; return; }
+  fetch('/api/data').then(r => r.json()).then(data => {
+    if (isDirty() || syncing) { needsPull = true; return; }
+    needsPull = false;
+    appData = data;
+    shadow = cloneDoc(data);
+    persistLocal();
+    clearPatternStats();
+    renderAll();
+  });
+}
+
+function connectLiveUpdates() {
+  if (!window.EventSource) return;
+  const source = new EventSource('/api/events?since=' + (shadow.revision || 0));
+  source.addEventListener('change', e => {
+    const ev = JSON.parse(e.data);
+    // resync は初期化・復元で revision が手元より小さくなったときにも届くので、違っていれば取り直す
+    if (ev.resync ? ev.revision === (shadow.revision || 0) : ev.revision <= (shadow.revision || 0)) return;
+    // 自分の保存は /api/ops の応答で反映する
+    if (ev.client === CLIENT_ID) return;
+    if (isDirty() || syncing) {
+      needsPull = true;
+    } else if (ev.ops && ev.base === shadow.revision) {
+      applyOps(ev.ops);
+      invalidateStatsForOps(ev.ops);
+      appData.revision = ev.revision;
+      shadow = cloneDoc(appData);
+      persistLocal();
+      renderAll();
+    } else {
+      reloadData();
+    }
+  });
+  source.addEventListener('error', () => {
+    // 通常の切断はブラウザが自動で繋ぎ直す。接続数の上限（503）で閉じられたときは、間をおいてこちらで繋ぎ直す
+    if (source.readyState !== EventSource.CLOSED) return;
+    setTimeout(connectLiveUpdates, (30 + Math.random() * 30) * 1000);
   });
 }
 
@@ -1887,24 +6077,7 @@ function saveToServer() {
 function migrateIds() {
   const hasOldFormat = appData.lessons.some(l => l.id && /^[A-Z]\d+$/.test(l.id));
   if (!hasOldFormat) return;
-  const idMap = {};
-  const counters = {};
-  appData.lessons.forEach(lesson => {
-    const oldId = lesson.id;
-    if (!oldId) return;
-    const person = lesson.who || '_';
-    const catLetter = getCategoryLetter(lesson.name);
-    const key = person + '-' + catLetter;
-    counters[key] = (counters[key] || 0) + 1;
-    const newId = person + '-' + catLetter + String(counters[key]).padStart(2, '0');
-    idMap[oldId] = newId;
-    lesson.id = newId;
-  });
-  ['A', 'B', 'C'].forEach(patKey => {
-    appData.patterns[patKey].ids = appData.patterns[patKey].ids.map(oldId => idMap[oldId] || oldId);
-  });
-  saveToServer();
-  console.log('ID migration complete:', idMap);
+  requestRenumber().then(ok => console.log('ID migration', ok ? 'complete' : 'deferred'));
 }
 
 // Init
@@ -1912,28 +6085,593 @@ renderPersonFilter();
 renderLessons();
 renderFamily();
 loadConditions();
+renderTravel();
+loadAvailability();
 setupTimeInput(document.getElementById('cond-pickup'), () => saveConditions());
+restoreLocalState().then(connectLiveUpdates);
+if ('serviceWorker' in navigator) navigator.serviceWorker.register('/sw.js').catch(() => {});
 </script>
 </body>
 </html>
 """
 
+@lru_cache(maxsize=1)
+def shell_version():
+    # 画面と service worker のどちらかが変わったらキャッシュを作り直す
+    return hashlib.sha1((HTML_TEMPLATE + SERVICE_WORKER_JS).encode('utf-8')).hexdigest()[:12]
+
+page_cache = RevisionCache(4)
+
+@lru_cache(maxsize=1)
+def index_template():
+    """画面のテンプレートを1回だけコンパイルする（render_template_string は呼ぶたびにコンパイルし直す）。"""
+    return app.jinja_env.from_string(HTML_TEMPLATE)
+
+def render_index(data):
+    with timed('json_encode'):
+        data_json = json.dumps(data, ensure_ascii=False)
+    with timed('render'):
+        return index_template().render(data_json=data_json)
+
+def warm_up():
+    """fork 前にテンプレートのコンパイルなど文書に依存しない準備をする（gunicorn.conf.py の when_ready から呼ぶ）。
+
+    文書は master では開かない。master が開くと終了時に古い文書を書き出したり、
+    再起動されたワーカーが起動時点の文書を引き継いだりするので、ワーカーごとに warm_worker で読み込む。
+    """
+    with startup_phase('template'):
+        index_template()
+        shell_version()
+    # import 済みのモジュール・テンプレートは終了まで残るので、GC の走査対象から外しておく
+    gc.freeze()
+
+def warm_worker():
+    """ワーカーの起動直後に文書・索引・画面を用意し、最初のリクエストで作らずに済むようにする（post_worker_init から呼ぶ）。"""
+    with startup_phase('store'):
+        data = store.read()
+    with startup_phase('indexes'):
+        for build in (lessons_by_id, person_index, pattern_sets, availability):
+            build(data)
+        lesson_search.ensure()
+        eligibility_index.ensure()
+    with startup_phase('page'):
+        page_cache.get('index', lambda: render_index(data), data)
+
 @app.route('/')
 def index():
     data = load_data()
-    sync_to_sheets(data)
-    return render_template_string(HTML_TEMPLATE, data_json=json.dumps(data, ensure_ascii=False))
+    enqueue_sync(data)
+    etag = '"%s-%d"' % (shell_version(), data.get('revision', 0))
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers={'ETag': etag})
+    html = page_cache.get('index', lambda: render_index(data), data)
+    return Response(html, mimetype='text/html', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+@app.route('/sw.js')
+def service_worker():
+    body = SERVICE_WORKER_JS.replace('__VERSION__', shell_version())
+    return Response(body, mimetype='text/javascript', headers={'Cache-Control': 'no-cache'})
+
+# =========== Request Validation ===========
+# 書き込み API の本文は、上限を超えたら読まずに 413、JSON として読めなければ 400 で返し、
+# 起動時に組み立てたスキーマで検査してから Store に渡す。違反した位置は "lessons[3].members" の形で返す。
+class RequestRejected(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+@app.errorhandler(RequestRejected)
+def request_rejected(e):
+    return jsonify({'ok': False, 'error': str(e)}), e.status
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    limit = request.max_content_length or MAX_BODY_BYTES
+    return jsonify({'ok': False, 'error': '送信内容が大きすぎます（上限 %d バイト）' % limit}), 413
+
+class SchemaError(ValueError):
+    def __init__(self, path, message):
+        super().__init__('%s: %s' % (path or '本文', message))
+        self.path = path
+
+class required:
+    """dict スキーマで必須のキーに付ける目印。"""
+    def __init__(self, spec):
+        self.spec = spec
+
+ANY = object
+SCALAR = (str, int, float, bool, type(None))
+TYPE_NAMES = {str: '文字列', int: '整数', float: '数値', bool: '真偽値', type(None): 'null', list: '配列', dict: 'オブジェクト'}
+
+def _key_path(path, key):
+    return '%s.%s' % (path, key) if path else key
+
+def compile_schema(spec):
+    """スキーマ（型・[要素]・{キー: スキーマ}・検査関数）を check(value, path) に変換する。"""
+    if isinstance(spec, (type, tuple)):
+        return _type_check(spec if isinstance(spec, tuple) else (spec,))
+    if isinstance(spec, list):
+        return _list_check(compile_schema(spec[0]))
+    if isinstance(spec, dict):
+        return _object_check(spec)
+    return spec
+
+def _type_check(types):
+    # JSON の true/false は int としても通ってしまうので、bool を許す型以外では弾く
+    allow_bool = bool in types or object in types
+    names = '・'.join(TYPE_NAMES.get(t, t.__name__) for t in types)
+    def check(value, path=''):
+        if not isinstance(value, types) or (isinstance(value, bool) and not allow_bool):
+            raise SchemaError(path, '%sを指定してください' % names)
+    return check
+
+def _list_check(item):
+    def check(value, path=''):
+        if not isinstance(value, list):
+            raise SchemaError(path, '配列を指定してください')
+        for i, v in enumerate(value):
+            item(v, '%s[%d]' % (path, i))
+    return check
+
+def _object_check(spec):
+    fields, need, other = {}, [], None
+    for key, sub in spec.items():
+        if key == '*':
+            other = compile_schema(sub)
+            continue
+        if isinstance(sub, required):
+            need.append(key)
+            sub = sub.spec
+        fields[key] = compile_schema(sub)
+    def check(value, path=''):
+        if not isinstance(value, dict):
+            raise SchemaError(path, 'オブジェクトを指定してください')
+        for key in need:
+            if key not in value:
+                raise SchemaError(_key_path(path, key), '必須の項目です')
+        for key, v in value.items():
+            sub = fields.get(key, other)
+            if sub is None:
+                raise SchemaError(_key_path(path, key), '使えない項目です')
+            sub(v, _key_path(path, key))
+    check.field = lambda key: fields.get(key, other)
+    return check
+
+def one_of(*values):
+    def check(value, path=''):
+        if not isinstance(value, str) or value not in values:
+            raise SchemaError(path, '%s のいずれかを指定してください' % '・'.join(values))
+    return check
+
+def natural(value, path=''):
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise SchemaError(path, '0 以上の整数を指定してください')
+
+def between(low, high):
+    def check(value, path=''):
+        if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+            raise SchemaError(path, '%d〜%d の整数を指定してください' % (low, high))
+    return check
+
+def pair(first, second):
+    first, second = compile_schema(first), compile_schema(second)
+    def check(value, path=''):
+        if not isinstance(value, list) or len(value) != 2:
+            raise SchemaError(path, '2要素の配列を指定してください')
+        first(value[0], '%s[0]' % path)
+        second(value[1], '%s[1]' % path)
+    return check
+
+LESSON_SCHEMA = compile_schema(dict({key: str for key, _ in LESSON_COLUMNS}, address=str, members=[int], **{'*': SCALAR}))
+PATTERN_SCHEMA = compile_schema({'name': str, 'ids': [str], 'memo': str, '*': SCALAR})
+DOCUMENT_SCHEMA = compile_schema({
+    'family': {'members': [{'id': required(int), 'name': str, 'role': one_of('parent', 'child'), 'icon': str,
+                            'birthday': str, 'info': str, '*': SCALAR}],
+               'next_id': int, '*': ANY},
+    'conditions': {'*': SCALAR},
+    'travel_times': [{'from': str, 'to': str, 'minutes': (int, str, type(None)), '*': SCALAR}],
+    'lessons': required([LESSON_SCHEMA]),
+    'patterns': required({'*': PATTERN_SCHEMA}),
+    'revision': int,
+    '*': ANY,
+})
+
+# 編集操作ごとのスキーマ（apply_ops が読むキー）。値は set・lesson_set・pattern_set の対象の項目に合わせて別に検査する
+OP_SCHEMAS = {kind: compile_schema(dict(spec, op=str)) for kind, spec in {
+    'set': {'key': required(str), 'value': required(ANY)},
+    'unset': {'key': required(str)},
+    'lesson_set': {'index': required(natural), 'field': required(str), 'value': required(ANY)},
+    'lesson_unset': {'index': required(natural), 'field': required(str)},
+    'lesson_insert': {'index': required(natural), 'lessons': required([LESSON_SCHEMA])},
+    'lesson_delete': {'index': required(natural), 'count': required(natural)},
+    'renumber': {'ids': required([pair(natural, str)]), 'map': required({'*': str})},
+    'pattern_toggle': {'key': required(str), 'id': required(str), 'on': required(bool)},
+    'pattern_set': {'key': required(str), 'field': required(str), 'value': required(ANY)},
+    'pattern_put': {'key': required(str), 'value': required(PATTERN_SCHEMA)},
+    'pattern_delete': {'key': required(str)},
+}.items()}
+OP_VALUE_SCHEMAS = {'set': DOCUMENT_SCHEMA, 'lesson_set': LESSON_SCHEMA, 'pattern_set': PATTERN_SCHEMA}
+
+def check_op(op, path=''):
+    kind = op.get('op') if isinstance(op, dict) else None
+    check = OP_SCHEMAS.get(kind) if isinstance(kind, str) else None
+    if check is None:
+        raise SchemaError(_key_path(path, 'op'), '未知の編集操作です')
+    check(op, path)
+    if kind in OP_VALUE_SCHEMAS:
+        target = OP_VALUE_SCHEMAS[kind].field(op['key' if kind == 'set' else 'field'])
+        if target is None:
+            raise SchemaError(_key_path(path, 'field'), '使えない項目です')
+        target(op['value'], _key_path(path, 'value'))
+
+OPS_PAYLOAD_SCHEMA = compile_schema({'base': required(natural), 'ops': required([check_op])})
+LESSON_IDS_SCHEMA = compile_schema({'who': str, 'name': str, 'count': between(1, 100)})
+
+def _reject_constant(name):
+    raise ValueError('%s は JSON の値として使えません' % name)
+
+strict_json = json.JSONDecoder(parse_constant=_reject_constant)
+
+def read_json_body(check):
+    """本文を上限つきで読み、NaN などを拒否して JSON として解釈し、スキーマで検査して返す。"""
+    if not request.is_json:
+        raise RequestRejected(415, 'Content-Type は application/json で送ってください')
+    with timed('json_decode'):
+        # get_data は Content-Length が上限を超えていれば読む前に、長さ不明なら上限に達した時点で 413 を送出する
+        raw = request.get_data(cache=False)
+        try:
+            payload = strict_json.decode(raw.decode('utf-8'))
+        except (ValueError, RecursionError) as e:
+            raise RequestRejected(400, 'JSON として読み取れません: %s' % e)
+    with timed('validate'):
+        try:
+            check(payload)
+        except SchemaError as e:
+            raise RequestRejected(400, '送信内容の形式が正しくありません（%s）' % e)
+    return payload
 
 @app.route('/api/save', methods=['POST'])
 def api_save():
-    data = request.get_json()
-    save_data(data)
-    sync_to_sheets(data)
-    return jsonify({'ok': True})
+    data = read_json_body(DOCUMENT_SCHEMA)
+    # 古い端末やバックアップからの旧形式の家族も、読み込み時と同じく人の番号の形に直してから保存する
+    migrate_family(data)
+    violations = strict_travel_violations(data, load_data())
+    if violations:
+        return jsonify({'ok': False, 'error': '移動が間に合わない組み合わせがあります', 'violations': violations}), 409
+    revision = save_data(data)
+    enqueue_sync(data)
+    return jsonify({'ok': True, 'revision': revision})
+
+class TravelViolation(Exception):
+    def __init__(self, violations):
+        super().__init__('移動が間に合わない組み合わせがあります')
+        self.violations = violations
+
+def _check_travel(data, current):
+    violations = strict_travel_violations(data, current)
+    if violations:
+        raise TravelViolation(violations)
+
+@app.route('/api/ops', methods=['POST'])
+def api_ops():
+    """端末が最後に受け取った revision (base) からの編集操作だけを受け取って保存する。"""
+    payload = read_json_body(OPS_PAYLOAD_SCHEMA)
+    ops, base = payload['ops'], payload['base']
+    try:
+        result = store.commit_ops(ops, base, _check_travel)
+    except TravelViolation as e:
+        return jsonify({'ok': False, 'error': str(e), 'violations': e.violations}), 409
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        return jsonify({'ok': False, 'error': '編集内容を適用できませんでした'}), 400
+    if result is None:
+        return jsonify({'ok': False, 'conflict': True, 'revision': store.revision,
+                        'error': '他の端末での変更と重なっています'}), 409
+    revision, rebased = result
+    enqueue_sync(load_data())
+    return jsonify({'ok': True, 'revision': revision, 'rebased': rebased})
+
+@app.route('/api/lessons/search')
+def api_lessons_search():
+    """name・school・address・memo の部分一致で習い事を探し、関連度の高い順に返す（空白区切りは AND）。"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'ok': False, 'error': 'q を指定してください'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), SEARCH_MAX_LIMIT)
+    with timed('search'):
+        data, total, hits = lesson_search.search(query, limit)
+    results = [{'index': position, 'score': score, 'fields': fields, 'lesson': data['lessons'][position]}
+               for position, score, fields in hits]
+    return jsonify({'ok': True, 'revision': data['revision'], 'total': total, 'results': results})
+
+@app.route('/api/lessons/ids', methods=['POST'])
+def api_lessons_ids():
+    """対象と習い事名から新しい ID を払い出す（count で複数まとめて）。"""
+    payload = read_json_body(LESSON_IDS_SCHEMA)
+    ids = lesson_ids.allocate(payload.get('who', ''), payload.get('name', ''), payload.get('count', 1))
+    return jsonify({'ok': True, 'id': ids[0], 'ids': ids})
+
+@app.route('/api/lessons/renumber', methods=['POST'])
+def api_lessons_renumber():
+    """全ての ID を振り直す。適用した 'renumber' 操作を返すので、端末は base が一致すればそのまま当てられる。"""
+    result = renumber_lessons()
+    if result is None:
+        return jsonify({'ok': False, 'conflict': True, 'error': '編集が続いているため振り直せませんでした'}), 409
+    base, revision, op = result
+    if op is not None:
+        enqueue_sync(load_data())
+    return jsonify({'ok': True, 'base': base, 'revision': revision, 'op': op})
 
 @app.route('/api/data')
 def api_data():
-    return jsonify(load_data())
+    data = load_data()
+    with timed('json_encode'):
+        return jsonify(data)
+
+@app.route('/api/lessons/import', methods=['POST'])
+def api_lessons_import():
+    """CSV（text/csv の本文、または multipart の file）から習い事を一括で追加・更新する。"""
+    request.max_content_length = IMPORT_MAX_BYTES
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        result = import_lessons(lines)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    enqueue_sync(load_data())
+    return jsonify(result)
+
+@app.route('/api/lessons/export')
+def api_lessons_export():
+    """習い事一覧を CSV / XLSX でストリーミング出力する（who・pattern で絞り込み、sort で並べ替え）。"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'xlsx'):
+        return jsonify({'ok': False, 'error': 'format は csv か xlsx を指定してください'}), 400
+    rows = iter_export_lessons(load_data(), who=request.args.get('who', ''), pattern=request.args.get('pattern', ''),
+                               sort=request.args.get('sort', ''), descending=request.args.get('order') == 'desc')
+    filename = '習い事候補_%s.%s' % (time.strftime('%Y-%m-%d'), fmt)
+    headers = {'Content-Disposition': "attachment; filename=\"lessons.%s\"; filename*=UTF-8''%s" % (fmt, quote(filename))}
+    if fmt == 'xlsx':
+        return Response(stream_xlsx(rows), headers=headers,
+                        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    return Response(stream_csv(rows), headers=headers, mimetype='text/csv; charset=utf-8')
+
+@app.route('/api/patterns/<key>.ics')
+def api_pattern_ics(key):
+    """パターンの習い事を毎週繰り返す予定として配信する（?who= で子ども別）。"""
+    return ics_response(key, request.args.get('who', ''))
+
+@app.route('/api/people/<who>.ics')
+def api_person_ics(who):
+    """子ども別のフィード。?pattern= 省略時は確定済みの習い事を配信する。"""
+    # 知らない人を空のカレンダーで返すと、購読側は何も同期されないまま気づけない
+    if person_index(load_data()).resolve(who) is None:
+        return jsonify({'ok': False, 'error': '家族に見つかりません'}), 404
+    pattern = request.args.get('pattern')
+    return ics_response(pattern or None, who)
+
+@app.route('/api/patterns/<key>/feasibility')
+def api_pattern_feasibility(key):
+    """パターン内の教室間移動が間に合うかを判定する。"""
+    data = load_data()
+    pat = data.get('patterns', {}).get(key)
+    if pat is None:
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    issues = travel_issues(data, pat.get('ids', []))
+    by_id, avail = lessons_by_id(data), availability(data)
+    outside = [i for i in pat.get('ids', []) if i in by_id and not avail.fits(by_id[i])]
+    return jsonify({'ok': True, 'revision': data.get('revision', 0),
+                    'limit': parse_minutes(data.get('conditions', {}).get('travel_limit')), 'issues': issues,
+                    'outside_availability': outside})
+
+@app.route('/api/eligibility')
+def api_eligibility():
+    """対象年齢の索引。date（既定: 今日）を指定すると、その日に通える習い事を子どもごとに返す。"""
+    try:
+        on = date.fromisoformat(request.args['date']) if request.args.get('date') else date.today()
+    except ValueError:
+        return jsonify({'ok': False, 'error': '日付の形式が正しくありません'}), 400
+    data, result = eligibility_index.report(on, request.args.get('child', ''))
+    result.update({'ok': True, 'revision': data.get('revision', 0), 'date': on.isoformat()})
+    return jsonify(result)
+
+@app.route('/api/patterns/<key>/stats')
+def api_pattern_stats(key):
+    """パターンの集計（月謝合計・曜日別・人物別の件数と時間が重なる組）を返す。"""
+    data = load_data()
+    if key not in data.get('patterns', {}):
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    result = dict(pattern_stats.get(data, key), ok=True, revision=data.get('revision', 0))
+    return jsonify(result)
+
+@app.route('/api/patterns/<key>/occurrences')
+def api_pattern_occurrences(key):
+    """パターンの 1 か月分（month=YYYY-MM、既定: 今月）を日付つきの予定に展開する。休業日の分は lessons の skipped に入る。"""
+    data = load_data()
+    if key not in data.get('patterns', {}):
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    try:
+        year, month = parse_month(request.args.get('month') or date.today().strftime('%Y-%m'))
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    return jsonify(dict(pattern_month(data, key, year, month), ok=True, revision=data.get('revision', 0)))
+
+@app.route('/api/lessons/<path:lesson_id>/occurrences')
+def api_lesson_occurrences(lesson_id):
+    """習い事の開催日を from（既定: 今日）から順に返す。to がなければ limit 件（既定 20、最大 500）で打ち切る。"""
+    data = load_data()
+    lesson = lessons_by_id(data).get(lesson_id)
+    if lesson is None:
+        return jsonify({'ok': False, 'error': '習い事が見つかりません'}), 404
+    try:
+        first = date.fromisoformat(request.args.get('from') or date.today().isoformat())
+        last = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({'ok': False, 'error': '日付は YYYY-MM-DD で指定してください'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 500)
+    closed = occurrence_calendar(data).closed_dates(lesson)
+    dates = (d for d in lesson_dates(lesson, first, last) if d not in closed)
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'id': lesson_id, 'rule': lesson_rule(lesson).label(),
+                    'dates': [d.isoformat() for d in islice(dates, limit)]})
+
+@app.route('/api/recurrence')
+def api_recurrence():
+    """繰り返しの書き方（repeat）と曜日（day）を確かめ、読み取った内容と直近の開催日を返す。"""
+    try:
+        rule = parse_recurrence(request.args.get('repeat', ''), request.args.get('day', ''))
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    upcoming = islice(rule.iter_dates(date.today()), 5)
+    return jsonify({'ok': True, 'label': rule.label(), 'next': [d.isoformat() for d in upcoming]})
+
+@app.route('/api/patterns/<key>/months')
+def api_pattern_months(key):
+    """from（YYYY-MM、既定: ICS_START_DATE と同じく今年度の4月）から months か月（既定 12）の、月ごとの回数と費用。"""
+    data = load_data()
+    if key not in data.get('patterns', {}):
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    start = feed_start_date()
+    try:
+        year, month = parse_month(request.args.get('from') or start.strftime('%Y-%m'))
+    except ValueError as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    count = min(max(request.args.get('months', 12, type=int), 1), MAX_OCCURRENCE_MONTHS)
+    months = []
+    with timed('occurrences'):
+        for n in range(count):
+            summary = pattern_month(data, key, *add_month(year, month, n))
+            months.append({k: summary[k] for k in ('month', 'count', 'cost', 'skipped')}
+                          | {'lessons': {lid: {'count': v['count'], 'cost': v['cost']} for lid, v in summary['lessons'].items()}})
+    calendar = occurrence_calendar(data)
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'from': months[0]['month'], 'months': months,
+                    'count': sum(m['count'] for m in months), 'cost': sum(m['cost'] for m in months),
+                    'fee_basis': 'per_lesson' if calendar.per_lesson else 'monthly', 'errors': calendar.errors})
+
+@app.route('/api/workload')
+def api_workload():
+    """パターンごと・人ごとの 15 分枠の件数（ヒートマップ）と曜日別の拘束時間。patterns（例: A,B、既定: 全て）と who で絞り込む。"""
+    data = load_data()
+    patterns = data.get('patterns', {})
+    keys = [k for k in request.args.get('patterns', '').split(',') if k] or list(patterns)
+    missing = [k for k in keys if k not in patterns]
+    if missing:
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません: %s' % ', '.join(missing)}), 404
+    who = person_index(data).display_name(request.args.get('who', ''))
+    result = {}
+    with timed('workload'):
+        for key in keys:
+            people = pattern_workload(data, key, who)
+            result[key] = {'people': people,
+                           'busy_total': sum(p['busy_total'] for p in people.values()),
+                           'peak': max((p['peak'] for p in people.values()), default=0)}
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'slot_minutes': WORKLOAD_SLOT_MINUTES,
+                    'days': DAYS, 'patterns': result})
+
+@app.route('/api/patterns/<key>/calendar')
+def api_pattern_calendar(key):
+    """パターンのカレンダー部分の HTML。days（例: 月水金、既定: 全曜日）と who で絞り込む。"""
+    data = load_data()
+    if key not in data.get('patterns', {}):
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    days = [d for d in DAYS if d in request.args.get('days', '')] or DAYS
+    who = request.args.get('who', '')
+    etag = '"cal-%d-%s"' % (data.get('revision', 0), hashlib.sha1(('%s|%s|%s' % (key, ''.join(days), who)).encode('utf-8')).hexdigest()[:16])
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers={'ETag': etag})
+    body = calendar_cache.get((key, ''.join(days), who), lambda: render_calendar(data, key, days, who), data)
+    return Response(body, mimetype='text/html', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+@app.route('/api/patterns/compare')
+def api_patterns_compare():
+    """base パターンに対して全パターンの差分（追加・削除・共通件数・月謝差）を返す。"""
+    data = load_data()
+    sets = pattern_sets(data)
+    base = request.args.get('base') or next(iter(sets.masks), '')
+    if base not in sets.masks:
+        return jsonify({'ok': False, 'error': 'パターンが見つかりません'}), 404
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'base': base, 'patterns': sets.compare(base)})
+
+@app.route('/api/constraints')
+def api_constraints():
+    """conditions から変換した曜日ごとの空き時間帯を返す。"""
+    data = load_data()
+    avail, calendar = availability(data), occurrence_calendar(data)
+    closures = [{'start': first.isoformat(), 'end': last.isoformat(), 'label': label, 'scope': scope}
+                for first, last, label, scope in calendar.closures]
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'days': avail.windows(), 'errors': avail.errors,
+                    'closures': closures, 'closure_errors': calendar.errors})
+
+@app.route('/api/lessons/available')
+def api_lessons_available():
+    """空き時間帯に収まる習い事を返す（who・pattern で絞り込み）。"""
+    data = load_data()
+    avail = availability(data)
+    who, pattern = request.args.get('who', ''), request.args.get('pattern', '')
+    ids = set(data.get('patterns', {}).get(pattern, {}).get('ids', [])) if pattern else None
+    lessons = data.get('lessons', [])
+    positions = sorted(person_index(data).positions(who)) if who else range(len(lessons))
+    lessons = [lessons[i] for i in positions if (ids is None or lessons[i].get('id') in ids) and avail.fits(lessons[i])]
+    return jsonify({'ok': True, 'revision': data.get('revision', 0), 'lessons': lessons})
+
+@app.route('/api/travel-times/import', methods=['POST'])
+def api_travel_times_import():
+    """移動時間を CSV（出発,到着,分）から取り込む。同じ組み合わせは上書きする。"""
+    request.max_content_length = IMPORT_MAX_BYTES
+    upload = request.files.get('file')
+    lines = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8-sig', newline='')
+    entries, errors = {}, []
+    try:
+        reader = csv.reader(lines)
+        next(reader, None)
+        for row in reader:
+            if not any(cell.strip() for cell in row):
+                continue
+            if len(row) < 3 or not row[0].strip() or not row[1].strip() or parse_minutes(row[2]) is None:
+                errors.append({'row': reader.line_num, 'errors': ['出発・到着・分を入力してください']})
+                continue
+            entries[(row[0].strip(), row[1].strip())] = parse_minutes(row[2])
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    with store.transaction() as data:
+        merged = {(e.get('from'), e.get('to')): e for e in data.get('travel_times', [])}
+        for (a, b), minutes in entries.items():
+            merged[(a, b)] = {'from': a, 'to': b, 'minutes': minutes}
+        data['travel_times'] = list(merged.values())
+    return jsonify({'ok': True, 'revision': data['revision'], 'imported': len(entries), 'errors': errors})
+
+@app.route('/api/events')
+def api_events():
+    """変更イベントを Server-Sent Events で配信する。"""
+    last = request.headers.get('Last-Event-ID') or request.args.get('since')
+    after = int(last) if last and last.isdigit() else store.revision
+
+    def stream(after):
+        yield 'retry: 3000\n\n'
+        # 切断中に保存があったときだけでなく、初期化・復元・再デプロイで revision が手元より小さくなったときも取り直してもらう
+        if after != store.revision:
+            yield 'id: %d\nevent: change\ndata: %s\n\n' % (store.revision, json.dumps({'revision': store.revision, 'resync': True}))
+            after = store.revision
+        deadline = time.monotonic() + SSE_MAX_AGE
+        while time.monotonic() < deadline:
+            events = hub.wait(after, SSE_HEARTBEAT)
+            if not events:
+                yield ': ping\n\n'
+                continue
+            for event in events:
+                yield 'id: %d\nevent: change\ndata: %s\n\n' % (event['revision'], json.dumps(event, ensure_ascii=False))
+            after = events[-1]['revision']
+
+    # 待機中のストリームがスレッドを使い切ると通常のリクエストが止まるので、上限を超えたら断って後で繋ぎ直してもらう
+    if not hub.open_stream():
+        return (jsonify({'ok': False, 'error': '接続が混み合っています', 'retry': SSE_BUSY_RETRY}), 503,
+                {'Retry-After': str(SSE_BUSY_RETRY)})
+    response = Response(stream(after), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # 切断やストリームの終了で WSGI サーバーが close を呼んだら枠を返す
+    response.call_on_close(hub.close_stream)
+    return response
+
+log_startup('import', (time.perf_counter() - _IMPORT_STARTED) * 1000)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5001))
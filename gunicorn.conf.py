@@ -0,0 +1,37 @@
+# gunicorn の本番設定（Procfile / render.yaml から -c で読み込む）。
+# app を master で読み込み、テンプレートのコンパイルなど文書に依存しない準備を済ませてからワーカーを fork する。
+# 文書（Store）は master では開かず、各ワーカーが起動直後に読み込む。master が開くと、終了時に起動時点の古い文書で
+# スナップショットを上書きしたり、再起動されたワーカーが古い文書を引き継いで revision を巻き戻したりするため。
+import os
+import time
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '10000')
+# 文書と変更通知のハブはプロセス内に1つだけ持つので、ワーカーは1つにしてスレッドで並行処理する
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 100))
+preload_app = True
+# SSE のストリームは1本がスレッドを1つ占有する。app 側で SSE_MAX_STREAMS（既定 threads の半分）を超えた接続は
+# 503 で断るので、待機中のタブが増えても通常のリクエスト用のスレッドは残る
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+_started = time.perf_counter()
+
+
+def _elapsed():
+    return (time.perf_counter() - _started) * 1000
+
+
+def when_ready(server):
+    # preload_app では app の import が済んだ後、fork の前に呼ばれる
+    import app
+    with app.startup_phase('warm_up'):
+        app.warm_up()
+    app.log_startup('master_ready', _elapsed())
+
+
+def post_worker_init(worker):
+    import app
+    with app.startup_phase('warm_worker'):
+        app.warm_worker()
+    app.log_startup('worker_ready', _elapsed(), worker=worker.pid)
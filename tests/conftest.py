@@ -0,0 +1,28 @@
+import atexit
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """空の一時ディレクトリで app を読み込み直す（Store・キャッシュ・スレッドをテストごとに新しくする）。"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('JOURNAL_FSYNC_INTERVAL', '0')
+    monkeypatch.setenv('COMPACT_INTERVAL', '3600')
+    monkeypatch.setenv('BACKUP_INTERVAL', '0')
+    monkeypatch.delenv('GOOGLE_SHEETS_ID', raising=False)
+    sys.modules.pop('app', None)
+    module = importlib.import_module('app')
+    yield module
+    # 終了時の compact が別のディレクトリに書き出さないように外す
+    atexit.unregister(module.store.close)
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
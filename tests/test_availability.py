@@ -0,0 +1,34 @@
+import pytest
+
+
+def days_of(app_module, text, default_days=(0, 1, 2, 3, 4, 5, 6)):
+    windows, errors = app_module.parse_windows(text, list(default_days))
+    assert errors == []
+    return sorted(windows)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('平日 16:00-18:00', [0, 1, 2, 3, 4]),
+    ('毎日 16:00-18:00', [0, 1, 2, 3, 4, 5, 6]),
+    ('土日 9:00-12:00', [5, 6]),
+    ('月〜金 16:00-18:00', [0, 1, 2, 3, 4]),
+    ('金-月 16:00-18:00', [0, 4, 5, 6]),
+    ('月水 16時〜18時', [0, 2]),
+    ('日曜日 10:00-12:00', [6]),
+    ('水曜 16:00-17:00', [2]),
+    ('平日と日曜 16:00-18:00', [0, 1, 2, 3, 4, 6]),
+])
+def test_day_prefixes(app_module, text, expected):
+    assert days_of(app_module, text) == expected
+
+
+def test_keywords_do_not_add_sunday(app_module):
+    # 「平日」「毎日」「曜日」の「日」は日曜ではない
+    assert 6 not in days_of(app_module, '平日 16:00-18:00')
+    assert 6 not in days_of(app_module, '曜日 16:00-18:00', default_days=range(5))
+
+
+def test_no_prefix_uses_default_days(app_module):
+    windows, errors = app_module.parse_windows('16:00〜19:00', [5, 6])
+    assert errors == [] and sorted(windows) == [5, 6]
+    assert windows[5] == app_module.range_mask(16 * 60, 19 * 60)
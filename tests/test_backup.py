@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import json
+import os
+
+
+def commit_fee(store, fee):
+    store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': fee}], store.revision)
+
+
+def test_backup_is_gzip_json_with_sha256_sidecar(app_module):
+    app_module.store.read()
+    commit_fee(app_module.store, '1000')
+    name = app_module.write_backup(app_module.store.read())
+    path = os.path.join(app_module.BACKUP_DIR, name)
+    assert name.endswith('-r1.json.gz')
+
+    with open(path, 'rb') as f:
+        packed = f.read()
+    assert json.loads(gzip.decompress(packed))['lessons'][0]['fee'] == '1000'
+    with open(path + '.sha256', encoding='ascii') as f:
+        # sha256sum -c でそのまま確かめられる形式
+        assert f.read() == '%s  %s\n' % (hashlib.sha256(packed).hexdigest(), name)
+    assert app_module.read_backup(name) == app_module.store.read()
+
+
+def test_old_backups_are_pruned(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'BACKUP_KEEP', 2)
+    for revision in range(1, 5):
+        app_module.write_backup(dict(app_module.default_data(), revision=revision))
+    names = app_module.list_backups()
+    assert [n.rsplit('-r', 1)[1] for n in names] == ['3.json.gz', '4.json.gz']
+    assert sorted(os.listdir(app_module.BACKUP_DIR)) == sorted(names + [n + '.sha256' for n in names])
+
+
+def test_restore_commits_backup_as_new_revision(app_module):
+    store = app_module.store
+    commit_fee(store, '1000')
+    name = app_module.write_backup(store.read())
+    commit_fee(store, '2000')
+
+    result = app_module.app.test_cli_runner().invoke(args=['restore', name])
+    assert result.exit_code == 0, result.output
+    assert store.revision == 3
+    assert store.read()['lessons'][0]['fee'] == '1000'
+    # 戻す前の内容（revision 2）も退避されている
+    assert any(n.endswith('-r2.json.gz') for n in app_module.list_backups())
+
+
+def test_restore_rejects_tampered_backup(app_module):
+    store = app_module.store
+    commit_fee(store, '1000')
+    name = app_module.write_backup(store.read())
+    path = os.path.join(app_module.BACKUP_DIR, name)
+    data = dict(store.read(), lessons=[])
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(json.dumps(data).encode('utf-8')))
+
+    result = app_module.app.test_cli_runner().invoke(args=['restore', name])
+    assert result.exit_code != 0
+    assert 'チェックサムが一致しません' in result.output
+    assert store.revision == 1
+    assert len(store.read()['lessons']) == 5
+
+
+def test_restore_requires_the_checksum_file(app_module):
+    name = app_module.write_backup(app_module.store.read())
+    os.remove(os.path.join(app_module.BACKUP_DIR, name + '.sha256'))
+    result = app_module.app.test_cli_runner().invoke(args=['restore', name])
+    assert result.exit_code != 0
+    assert 'チェックサムがありません' in result.output
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+
+def test_round_trip_keeps_values_key_order_and_missing_fields(app_module):
+    data = app_module.default_data()
+    data['lessons'][1]['fee'] = 5000
+    data['lessons'][2]['extra'] = None
+    del data['lessons'][3]['memo']
+    data['lessons'].append({})
+    data['patterns']['A']['ids'] = ['A1', 'C1', 'A1']
+    data['patterns']['B'] = {'ids': ['B1'], 'name': 'ids が先頭'}
+    data['patterns']['odd'] = ['not', 'a', 'dict']
+    data['revision'] = 7
+
+    raw = app_module.encode_compact(data)
+    assert raw.startswith(app_module.COMPACT_MAGIC)
+    decoded = app_module.decode_compact(raw)
+    assert decoded == data
+    assert json.dumps(decoded, ensure_ascii=False) == json.dumps(data, ensure_ascii=False)
+
+
+def test_no_lessons_round_trip(app_module):
+    data = dict(app_module.default_data(), lessons=[])
+    assert app_module.decode_compact(app_module.encode_compact(data)) == data
+
+
+def test_rejects_other_files(app_module):
+    with pytest.raises(ValueError):
+        app_module.decode_compact(b'{"lessons": []}')
+
+
+def test_compaction_and_replay_in_compact_format(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'DATA_FORMAT', 'compact')
+    store = app_module.Store(app_module.JOURNAL_FILE)
+    store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '1000'}], 0)
+    store.compact()
+    assert os.path.exists(app_module.COMPACT_DATA_FILE)
+    assert not os.path.exists(app_module.DATA_FILE)
+    store.commit_ops([{'op': 'lesson_delete', 'index': 4, 'count': 1}], 1)
+
+    restored = app_module.Store(app_module.JOURNAL_FILE).read()
+    assert restored['revision'] == 2
+    assert restored['lessons'][0]['fee'] == '1000'
+    assert [l['id'] for l in restored['lessons']] == ['A1', 'A2', 'B1', 'B2']
+
+
+def test_json_snapshot_is_migrated_to_compact(app_module, monkeypatch):
+    store = app_module.Store(app_module.JOURNAL_FILE)
+    store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '1000'}], 0)
+    store.compact()
+    assert os.path.exists(app_module.DATA_FILE)
+
+    # 形式を切り替えても、compact のファイルができるまでは JSON から読み込む
+    monkeypatch.setattr(app_module, 'DATA_FORMAT', 'compact')
+    store = app_module.Store(app_module.JOURNAL_FILE)
+    assert store.read()['lessons'][0]['fee'] == '1000'
+    store.commit_ops([{'op': 'lesson_set', 'index': 1, 'field': 'fee', 'value': '2000'}], 1)
+    store.compact()
+    with open(app_module.COMPACT_DATA_FILE, 'rb') as f:
+        data = app_module.decode_compact(f.read())
+    assert data['revision'] == 2
+    assert [l['fee'] for l in data['lessons'][:2]] == ['1000', '2000']
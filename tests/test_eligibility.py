@@ -0,0 +1,125 @@
+from datetime import date, timedelta
+
+import pytest
+
+BIRTHDAY = date(2020, 5, 15)
+
+
+def period(app_module, memo, birthday=BIRTHDAY):
+    return app_module.eligible_period(birthday, app_module.parse_age_range(memo))
+
+
+def eligible(span, day):
+    start, end = span
+    return (start is None or start <= day) and (end is None or day < end)
+
+
+@pytest.mark.parametrize('memo, last_day', [
+    ('0歳〜3歳', date(2024, 5, 14)),  # 4歳の誕生日の前日まで
+    ('1歳〜3才まで', date(2024, 5, 14)),
+    ('1歳〜2歳6ヶ月', date(2022, 12, 14)),  # 2歳7か月になる前日まで
+    ('年少〜年長', date(2027, 3, 31)),  # 学年の上限は年度末まで
+    ('年少〜小学1年生', date(2028, 3, 31)),
+])
+def test_upper_bound_boundary(app_module, memo, last_day):
+    span = period(app_module, memo)
+    assert eligible(span, last_day)
+    assert not eligible(span, last_day + timedelta(days=1))
+
+
+@pytest.mark.parametrize('memo, first_day', [
+    ('3歳〜', date(2023, 5, 15)),  # 3歳の誕生日から
+    ('2才6ケ月～小学１年生', date(2022, 11, 15)),
+    ('年少〜', date(2024, 4, 1)),
+])
+def test_lower_bound_boundary(app_module, memo, first_day):
+    span = period(app_module, memo)
+    assert not eligible(span, first_day - timedelta(days=1))
+    assert eligible(span, first_day)
+
+
+def test_year_and_month_bounds_agree(app_module):
+    # 「3歳まで」と「3歳11か月まで」は同じ日に終わる
+    assert period(app_module, '1歳〜3歳')[1] == period(app_module, '1歳〜3歳11ヶ月')[1]
+
+
+def test_labels(app_module):
+    lower, upper = app_module.parse_age_range('3歳〜2歳6ヶ月')
+    assert app_module.age_bound_label(lower) == '3歳'
+    assert app_module.age_bound_label(upper) == '2歳6か月'
+
+
+def fresh(app_module, data):
+    index = app_module.EligibilityIndex()
+    index._build(data)
+    return index
+
+
+def snapshot(index):
+    return index.ranges, {n: periods for n, (periods, _) in index.children.items()}
+
+
+def test_index_is_updated_per_op_without_rebuilding(app_module, monkeypatch):
+    store, index = app_module.store, app_module.eligibility_index
+    index.ensure()
+    builds = []
+    real_build = index._build
+    monkeypatch.setattr(index, '_build', lambda data: builds.append(data) or real_build(data))
+
+    def commit(*ops):
+        store.commit_ops(list(ops), store.revision)
+        assert snapshot(index) == snapshot(fresh(app_module, store.read()))
+
+    assert set(index.ranges) == {'B2', 'C1'}
+    commit({'op': 'lesson_set', 'index': 0, 'field': 'memo', 'value': '2才6ケ月～小学１年生'})
+    commit({'op': 'lesson_set', 'index': 4, 'field': 'memo', 'value': ''})
+    commit({'op': 'lesson_set', 'index': 0, 'field': 'id', 'value': '第一子-A01'})
+    commit({'op': 'lesson_insert', 'index': 1, 'lessons': [{'id': 'N1', 'memo': '年少〜年長'}, {'id': 'N2', 'memo': '3歳〜'}]})
+    commit({'op': 'lesson_delete', 'index': 2, 'count': 2})
+    family = dict(store.read()['family'])
+    family['members'] = [dict(m, birthday='2021-01-31') if m['id'] == 4 else m for m in family['members']]
+    commit({'op': 'set', 'key': 'family', 'value': family})
+    assert builds == []
+    assert index._revision == store.revision
+    periods = index.children[4][0]
+    assert sorted(p[2] for p in periods) == ['B2', 'N1', '第一子-A01']
+
+    # 重複した ID は位置から決められないので作り直す
+    commit({'op': 'lesson_insert', 'index': 0, 'lessons': [{'id': 'B2', 'memo': '1歳〜'}]})
+    assert len(builds) == 1
+
+
+def test_random_edits_match_a_fresh_index(app_module):
+    import random
+    store, index = app_module.store, app_module.eligibility_index
+    index.ensure()
+    rng = random.Random(36)
+    memos = ['', '3歳〜', '1歳〜2歳6ヶ月', '年少〜年長', '未就園児', '小学1年生〜', '0歳〜3歳が目安']
+    for step in range(150):
+        n = len(store.read()['lessons'])
+        kind = rng.choice(['memo', 'memo', 'id', 'insert', 'delete', 'birthday'] if n else ['insert'])
+        if kind == 'memo':
+            op = {'op': 'lesson_set', 'index': rng.randrange(n), 'field': 'memo', 'value': rng.choice(memos)}
+        elif kind == 'id':
+            op = {'op': 'lesson_set', 'index': rng.randrange(n), 'field': 'id', 'value': 'R%d' % step}
+        elif kind == 'insert':
+            op = {'op': 'lesson_insert', 'index': rng.randrange(n + 1),
+                  'lessons': [{'id': 'I%d' % step, 'memo': rng.choice(memos)}]}
+        elif kind == 'delete':
+            op = {'op': 'lesson_delete', 'index': rng.randrange(n), 'count': 1}
+        else:
+            family = dict(store.read()['family'])
+            day = date(2019, 1, 1) + timedelta(days=rng.randrange(2500))
+            family['members'] = [dict(m, birthday=day.isoformat()) if m['id'] == rng.choice([3, 4]) else m
+                                 for m in family['members']]
+            op = {'op': 'set', 'key': 'family', 'value': family}
+        store.commit_ops([op], store.revision)
+        assert snapshot(index) == snapshot(fresh(app_module, store.read())), (step, op)
+
+
+def test_eligibility_endpoint(client):
+    res = client.get('/api/eligibility?date=2026-10-01&child=第一子').get_json()
+    assert set(res['lookup']) == {'3'}
+    assert res['lookup']['3']['eligible'] == ['B2', 'C1']
+    assert res['lessons']['C1']['label'] == '3歳〜'
+    assert client.get('/api/eligibility?date=10/01').status_code == 400
@@ -0,0 +1,51 @@
+def test_streams_beyond_cap_get_503_with_retry(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, 'SSE_MAX_STREAMS', 2)
+    first = client.get('/api/events', buffered=False)
+    second = client.get('/api/events', buffered=False)
+    assert first.status_code == second.status_code == 200
+
+    busy = client.get('/api/events')
+    assert busy.status_code == 503
+    assert busy.headers['Retry-After'] == str(app_module.SSE_BUSY_RETRY)
+    assert busy.get_json()['retry'] == app_module.SSE_BUSY_RETRY
+
+    # 閉じたストリームの枠は次の接続に使える
+    first.close()
+    third = client.get('/api/events', buffered=False)
+    assert third.status_code == 200
+    second.close()
+    third.close()
+    assert app_module.hub._streams == 0
+
+
+def test_stream_delivers_change_events(app_module, client):
+    response = client.get('/api/events', buffered=False)
+    chunks = iter(response.response)
+    assert next(chunks).startswith(b'retry:')
+    app_module.store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '1'}], 0)
+    assert b'event: change' in next(chunks)
+    response.close()
+
+
+def first_event(client, last_event_id):
+    response = client.get('/api/events', headers={'Last-Event-ID': str(last_event_id)}, buffered=False)
+    chunks = iter(response.response)
+    next(chunks)
+    event = next(chunks)
+    response.close()
+    return event
+
+
+def test_client_ahead_of_store_is_told_to_resync(app_module, client):
+    # 初期化や再デプロイで revision が戻った後に、古い revision を覚えたページが繋ぎ直した
+    app_module.store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '1'}], 0)
+    event = first_event(client, 40)
+    assert event.startswith(b'id: 1\nevent: change\n')
+    assert b'"resync": true' in event
+
+
+def test_client_behind_store_is_told_to_resync(app_module, client):
+    store = app_module.store
+    for value in ('1', '2', '3'):
+        store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': value}], store.revision)
+    assert b'"resync": true' in first_event(client, 1)
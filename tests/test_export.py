@@ -0,0 +1,83 @@
+import csv
+import io
+import zipfile
+from xml.etree import ElementTree
+
+MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+
+def many_lessons(app_module, n):
+    data = app_module.default_data()
+    data['lessons'] = [{'id': '第一子-C%d' % i, 'name': 'ピアノ, "発表会"つき', 'who': '第一子', 'members': [3],
+                        'fee': str(1000 + i), 'day': app_module.DAYS[i % 7], 'memo': '1行目\n2行目'} for i in range(n)]
+    return data
+
+
+def test_csv_is_bom_prefixed_quoted_and_chunked(app_module):
+    data = many_lessons(app_module, 1201)
+    chunks = list(app_module.stream_csv(app_module.iter_export_lessons(data)))
+    # 500 行ごとに 1 チャンク（最後の残りも 1 チャンク）
+    assert len(chunks) == 3
+    text = b''.join(chunks).decode('utf-8')
+    assert text.startswith('\ufeffID,')
+    rows = list(csv.reader(io.StringIO(text.lstrip('\ufeff'))))
+    assert rows[0] == [header for _, header in app_module.LESSON_COLUMNS]
+    assert len(rows) == 1202
+    assert rows[1][1] == 'ピアノ, "発表会"つき'
+    assert rows[1][-1] == '1行目\n2行目'
+
+
+def test_csv_export_can_be_imported_again(app_module):
+    data = app_module.default_data()
+    data['lessons'][0].update(day='月', start='16:00', end='17:00', fee='5000')
+    text = b''.join(app_module.stream_csv(app_module.iter_export_lessons(data))).decode('utf-8')
+    parsed = list(app_module.parse_lesson_csv(io.StringIO(text)))
+    assert [errors for _, _, errors in parsed] == [[]] * 5
+    assert parsed[0][1]['fee'] == '5000'
+    assert parsed[0][1]['start'] == '16:00'
+
+
+def test_filters_and_sorting(app_module):
+    data = many_lessons(app_module, 12)
+    data['lessons'][3]['members'], data['lessons'][3]['who'] = [4], '第二子'
+    data['patterns']['A']['ids'] = ['第一子-C10', '第一子-C2']
+    ids = lambda **kw: [row[0] for row in app_module.iter_export_lessons(data, **kw)]
+    assert ids(who='第二子') == ['第一子-C3']
+    assert ids(pattern='A') == ['第一子-C2', '第一子-C10']
+    # ID は数字を数として並べる
+    assert ids(sort='id', descending=True)[:3] == ['第一子-C11', '第一子-C10', '第一子-C9']
+    assert ids(sort='fee')[:2] == ['第一子-C0', '第一子-C1']
+    assert ids(sort='day')[:2] == ['第一子-C0', '第一子-C7']
+
+
+def test_xlsx_is_a_readable_workbook(app_module):
+    data = many_lessons(app_module, 600)
+    data['lessons'][0]['memo'] = 'ベル\x07<&>'
+    chunks = list(app_module.stream_xlsx(app_module.iter_export_lessons(data)))
+    assert len(chunks) >= 3
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zf:
+        assert zf.testzip() is None
+        assert {'[Content_Types].xml', 'xl/workbook.xml', 'xl/worksheets/sheet1.xml'} <= set(zf.namelist())
+        sheet = ElementTree.fromstring(zf.read('xl/worksheets/sheet1.xml'))
+    rows = sheet.find(MAIN + 'sheetData').findall(MAIN + 'row')
+    assert len(rows) == 601
+
+    def values(row):
+        return [c.findtext(MAIN + 'v') if c.get('t') is None else c.findtext('%sis/%st' % (MAIN, MAIN)) for c in row]
+
+    assert values(rows[0])[:2] == ['ID', '習い事']
+    first = values(rows[1])
+    # 月謝は数値のセル、制御文字は取り除いてエスケープする
+    fee_cell = rows[1][[f for f, _ in app_module.LESSON_COLUMNS].index('fee')]
+    assert fee_cell.get('t') is None and fee_cell.findtext(MAIN + 'v') == '1000'
+    assert first[-1] == 'ベル<&>'
+
+
+def test_export_endpoint(client):
+    response = client.get('/api/lessons/export?format=xlsx&who=第二子')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    assert "filename*=UTF-8''" in response.headers['Content-Disposition']
+    csv_text = client.get('/api/lessons/export?who=第二子').get_data().decode('utf-8')
+    assert [row[0] for row in csv.reader(io.StringIO(csv_text.lstrip('\ufeff')))] == ['ID', 'A2', 'B2']
+    assert client.get('/api/lessons/export?format=pdf').status_code == 400
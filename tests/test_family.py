@@ -0,0 +1,52 @@
+def legacy_document(app_module):
+    data = app_module.default_data()
+    data['family'] = {
+        'papa': {'name': 'パパ', 'info': '会社員'},
+        'mama': {'name': 'ママ', 'info': '平日勤務'},
+        'sister': {'name': '第一子', 'birthday': '2023-04-10', 'info': '保育園'},
+        'brother': {'name': '第二子', 'birthday': '2025-06-15', 'info': ''},
+    }
+    for lesson in data['lessons']:
+        del lesson['members']
+    return data
+
+
+def test_migrate_family_numbers_members_and_lessons(app_module):
+    data = legacy_document(app_module)
+    data['lessons'][0]['who'] = 'お姉ちゃん'
+    data['lessons'][1]['who'] = '第一子+第二子'
+    data['lessons'][2]['who'] = '近所の子'
+    assert app_module.migrate_family(data) is True
+
+    members = data['family']['members']
+    assert [(m['id'], m['name'], m['role']) for m in members] == [
+        (1, 'パパ', 'parent'), (2, 'ママ', 'parent'), (3, '第一子', 'child'), (4, '第二子', 'child')]
+    assert members[2]['birthday'] == '2023-04-10'
+    assert data['family']['next_id'] == 5
+    # 旧既定の呼び名は字で姉・弟に割り当て、who は家族の呼び名に揃える
+    assert (data['lessons'][0]['members'], data['lessons'][0]['who']) == ([3], '第一子')
+    assert (data['lessons'][1]['members'], data['lessons'][1]['who']) == ([3, 4], '第一子＋第二子')
+    assert (data['lessons'][2]['members'], data['lessons'][2]['who']) == ([], '近所の子')
+
+
+def test_migrate_family_leaves_new_format_alone(app_module):
+    data = app_module.default_data()
+    assert app_module.migrate_family(data) is False
+    assert data == app_module.default_data()
+
+
+def test_missing_legacy_members_are_skipped(app_module):
+    data = legacy_document(app_module)
+    del data['family']['mama']
+    app_module.migrate_family(data)
+    assert [m['id'] for m in data['family']['members']] == [1, 3, 4]
+    assert data['family']['next_id'] == 5
+
+
+def test_save_migrates_a_legacy_document(app_module, client):
+    response = client.post('/api/save', json=legacy_document(app_module))
+    assert response.status_code == 200
+    stored = app_module.store.read()
+    assert 'papa' not in stored['family']
+    assert [m['name'] for m in stored['family']['members']] == ['パパ', 'ママ', '第一子', '第二子']
+    assert [l['members'] for l in stored['lessons']] == [[3], [4], [3], [4], [3]]
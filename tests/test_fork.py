@@ -0,0 +1,82 @@
+import gc
+import json
+import os
+
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason='fork が使えない環境')
+
+
+def in_child(fn):
+    """fork した子で fn を実行し、戻り値（JSON）を返す。gunicorn のワーカーの代わり。"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = {'ok': fn()}
+        except BaseException as e:
+            result = {'error': repr(e)}
+        os.write(write_fd, json.dumps(result).encode('utf-8'))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+    assert 'error' not in result, result['error']
+    return result['ok']
+
+
+def set_fee(store, fee):
+    ops = [{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': fee}]
+    return store.commit_ops(ops, store.revision)[0]
+
+
+def journal_revs(app_module):
+    with open(app_module.JOURNAL_FILE, encoding='utf-8') as f:
+        return [json.loads(line)['rev'] for line in f]
+
+
+def test_warm_up_does_not_open_the_store(app_module):
+    app_module.warm_up()
+    gc.unfreeze()
+    assert app_module.store._data is None
+
+
+def test_respawned_worker_reloads_instead_of_inheriting(app_module):
+    store = app_module.store
+    store.read()  # fork 元が文書を開いていても
+
+    def first_worker():
+        return [set_fee(store, fee) for fee in ('1', '2', '3')]
+
+    def respawned_worker():
+        return store.revision, set_fee(store, '4')
+
+    assert in_child(first_worker) == [1, 2, 3]
+    assert in_child(respawned_worker) == [3, 4]
+    assert journal_revs(app_module) == [1, 2, 3, 4]
+    assert app_module.Store(app_module.JOURNAL_FILE).read()['lessons'][0]['fee'] == '4'
+
+
+def test_inherited_store_does_not_compact_at_exit(app_module):
+    store = app_module.store
+    store.read()
+    set_fee(store, '1')
+
+    def worker():
+        # 親から引き継いだ文書のまま終了処理が走っても、スナップショットは書かない
+        store.close()
+        return os.path.exists(app_module.DATA_FILE)
+
+    assert in_child(worker) is False
+    assert not os.path.exists(app_module.DATA_FILE)
+
+    def worker_that_saved():
+        set_fee(store, '2')
+        store.close()
+        return os.path.exists(app_module.DATA_FILE)
+
+    assert in_child(worker_that_saved) is True
+    with open(app_module.DATA_FILE, encoding='utf-8') as f:
+        assert json.load(f)['revision'] == 2
@@ -0,0 +1,53 @@
+from datetime import date
+
+import pytest
+
+
+def test_person_feed_for_family_member(client):
+    response = client.get('/api/people/第一子.ics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/calendar'
+    assert client.get('/api/people/3.ics').status_code == 200
+
+
+def test_person_feed_for_unknown_person_is_404(client):
+    response = client.get('/api/people/知らない人.ics')
+    assert response.status_code == 404
+    assert response.get_json()['ok'] is False
+    assert client.get('/api/people/99.ics').status_code == 404
+
+
+def test_pattern_feed_for_unknown_pattern_is_404(client):
+    assert client.get('/api/patterns/A.ics').status_code == 200
+    assert client.get('/api/patterns/nope.ics').status_code == 404
+
+
+def test_if_none_match_compares_whole_tags(client):
+    etag = client.get('/api/patterns/A.ics').headers['ETag']
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': '"x", %s' % etag}).status_code == 304
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': 'W/' + etag}).status_code == 304
+    # 一部だけ一致するタグや、タグを含む別の文字列では 304 にしない
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': etag[:-3] + '"'}).status_code == 200
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': '"%s-old"' % etag.strip('"')}).status_code == 200
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': 'x' + etag}).status_code == 200
+    assert client.get('/api/patterns/A.ics', headers={'If-None-Match': '"%s"' % etag}).status_code == 200
+
+
+@pytest.fixture
+def bad_start_date(monkeypatch):
+    monkeypatch.setenv('ICS_START_DATE', '2026/04/01')
+
+
+def test_invalid_start_date_falls_back_to_school_year(bad_start_date, app_module, client):
+    assert app_module.ICS_START is None
+    start = app_module.feed_start_date()
+    assert (start.month, start.day) == (4, 1)
+    assert client.get('/api/patterns/A.ics').status_code == 200
+    assert client.get('/api/patterns/A/months').status_code == 200
+
+
+def test_start_date_from_environment(monkeypatch, app_module):
+    assert app_module._ics_start_date(' 2026-09-01 ') == date(2026, 9, 1)
+    monkeypatch.setattr(app_module, 'ICS_START', date(2026, 9, 1))
+    assert app_module.feed_start_date() == date(2026, 9, 1)
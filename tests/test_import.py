@@ -0,0 +1,23 @@
+def post_csv(client, text):
+    return client.post('/api/lessons/import', data=text.encode('utf-8'), content_type='text/csv')
+
+
+def test_rows_without_id_get_distinct_new_ids(app_module, client):
+    before = len(app_module.store.read()['lessons'])
+    body = post_csv(client, 'ID,習い事,対象,曜日\n,ピアノ,第一子,月\n,ピアノ,第一子,火\n').get_json()
+    assert body['ok'] and body['inserted'] == 2 and body['updated'] == 0
+
+    lessons = app_module.store.read()['lessons']
+    assert len(lessons) == before + 2
+    added = lessons[-2:]
+    assert [l['day'] for l in added] == ['月', '火']
+    assert all(l['id'] for l in added)
+    assert added[0]['id'] != added[1]['id']
+    assert len({l['id'] for l in lessons}) == len(lessons)
+
+
+def test_rows_with_id_update_existing_lesson(app_module, client):
+    lesson = app_module.store.read()['lessons'][0]
+    body = post_csv(client, 'ID,月謝\n%s,5000\n' % lesson['id']).get_json()
+    assert body['inserted'] == 0 and body['updated'] == 1
+    assert app_module.store.read()['lessons'][0]['fee'] == '5000'
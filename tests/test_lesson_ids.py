@@ -0,0 +1,54 @@
+import threading
+
+
+def insert(store, lesson_id):
+    lessons = [{'id': lesson_id, 'name': 'ピアノ', 'who': '第一子', 'members': [3]}]
+    while store.commit_ops([{'op': 'lesson_insert', 'index': 0, 'lessons': lessons}], store.revision) is None:
+        pass
+
+
+def test_allocation_continues_after_existing_ids(app_module):
+    store, lesson_ids = app_module.store, app_module.lesson_ids
+    insert(store, '第一子-C07')
+    assert lesson_ids.allocate('第一子', 'ピアノ', 2) == ['第一子-C08', '第一子-C09']
+    # 払い出し後に手入力で保存された ID の連番も取り込む
+    insert(store, '第一子-C20')
+    assert lesson_ids.allocate('第一子', 'ピアノ') == ['第一子-C21']
+
+
+def test_commit_between_read_and_seed_is_not_missed(app_module, monkeypatch):
+    store, lesson_ids = app_module.store, app_module.lesson_ids
+    store.read()
+    real_read = store.read
+    calls = []
+
+    def read():
+        # allocate の最初の読み込み（ロックの外）の直後に、別の端末の保存が入る
+        data = real_read()
+        calls.append(data['revision'])
+        if len(calls) == 1:
+            insert(store, '第一子-C05')
+        return data
+
+    monkeypatch.setattr(store, 'read', read)
+    assert lesson_ids.allocate('第一子', 'ピアノ') == ['第一子-C06']
+
+
+def test_concurrent_first_allocations_are_unique(app_module):
+    store, lesson_ids = app_module.store, app_module.lesson_ids
+    store.read()
+    barrier = threading.Barrier(8)
+    allocated = []
+
+    def worker():
+        barrier.wait()
+        allocated.extend(lesson_ids.allocate('第一子', 'ピアノ', 3))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    existing = {l['id'] for l in store.read()['lessons']}
+    assert len(set(allocated)) == len(allocated) == 24
+    assert not set(allocated) & existing
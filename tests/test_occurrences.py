@@ -0,0 +1,56 @@
+from datetime import date
+
+
+def setup(app_module, closures, fee_basis=''):
+    store = app_module.store
+    conditions = dict(store.read()['conditions'], closures=closures, fee_basis=fee_basis)
+    store.commit_ops([{'op': 'set', 'key': 'conditions', 'value': conditions},
+                      {'op': 'lesson_set', 'index': 2, 'field': 'day', 'value': '月'},
+                      {'op': 'lesson_set', 'index': 2, 'field': 'start', 'value': '16:00'},
+                      {'op': 'lesson_set', 'index': 2, 'field': 'fee', 'value': '8000'},
+                      {'op': 'lesson_set', 'index': 4, 'field': 'day', 'value': '月'},
+                      {'op': 'lesson_set', 'index': 4, 'field': 'start', 'value': '10:00'},
+                      {'op': 'lesson_set', 'index': 4, 'field': 'fee', 'value': '6000'},
+                      {'op': 'pattern_toggle', 'key': 'A', 'id': 'B1', 'on': True},
+                      {'op': 'pattern_toggle', 'key': 'A', 'id': 'C1', 'on': True}], store.revision)
+    return store.read()
+
+
+def test_parse_closures(app_module):
+    closures, errors = app_module.parse_closures('2026/8/10〜2026/8/16 お盆休み @スイミング\n\n'
+                                                 '２０２６年１２月２９日 年末\n2026-02-30 休み\n2026-05-05〜2026-05-01\n休み')
+    assert closures == [(date(2026, 8, 10), date(2026, 8, 16), 'お盆休み', 'スイミング'),
+                        (date(2026, 12, 29), date(2026, 12, 29), '年末', '')]
+    assert len(errors) == 3
+
+
+def test_closure_across_month_boundary_skips_only_dates_in_month(app_module):
+    # 2026-08 の月曜は 3・10・17・24・31 日
+    data = setup(app_module, '2026-07-27〜2026-08-11 夏休み')
+    result = app_module.pattern_month(data, 'A', 2026, 8)
+    assert result['lessons']['B1']['count'] == 3
+    assert result['lessons']['B1']['skipped'] == [['2026-08-03', '夏休み'], ['2026-08-10', '夏休み']]
+    assert result['skipped'] == 4
+    assert result['count'] == 6
+    # 日付・時刻の順に並ぶ
+    assert [(o['date'], o['id']) for o in result['occurrences'][:2]] == [('2026-08-17', 'C1'), ('2026-08-17', 'B1')]
+    # 月額の月謝は 1 回でもあればそのまま
+    assert result['cost'] == 14000
+    july = app_module.pattern_month(data, 'A', 2026, 7)
+    assert july['lessons']['B1']['count'] == 3
+    assert july['lessons']['B1']['skipped'] == [['2026-07-27', '夏休み']]
+
+
+def test_scoped_closure_and_per_lesson_cost(app_module):
+    data = setup(app_module, '2026-08-01〜2026-08-31 プール点検 @スイミング', fee_basis='per_lesson')
+    result = app_module.pattern_month(data, 'A', 2026, 8)
+    assert result['lessons']['B1'] == {'count': 0, 'cost': 0, 'skipped': [['2026-08-%02d' % d, 'プール点検'] for d in (3, 10, 17, 24, 31)]}
+    # per_lesson は月 4 回分として回数で按分する
+    assert result['lessons']['C1'] == {'count': 5, 'cost': 7500, 'skipped': []}
+
+
+def test_lesson_occurrences_skip_closures(app_module, client):
+    setup(app_module, '2026-08-10 お盆')
+    res = client.get('/api/lessons/B1/occurrences?from=2026-08-01&limit=3').get_json()
+    assert res['dates'] == ['2026-08-03', '2026-08-17', '2026-08-24']
+    assert client.get('/api/patterns/A/occurrences?month=2026-13').status_code == 400
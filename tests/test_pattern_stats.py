@@ -0,0 +1,43 @@
+import copy
+
+
+def commit(store, ops):
+    return store.commit_ops(ops, store.revision)
+
+
+def test_renaming_a_member_refreshes_cached_stats(app_module):
+    store, stats = app_module.store, app_module.pattern_stats
+    commit(store, [{'op': 'pattern_toggle', 'key': 'A', 'id': 'A1', 'on': True},
+                   {'op': 'pattern_toggle', 'key': 'A', 'id': 'B1', 'on': True}])
+    assert stats.get(store.read(), 'A')['people'] == {'第一子': 2}
+
+    family = copy.deepcopy(store.read()['family'])
+    family['members'][2]['name'] = '長女'
+    commit(store, [{'op': 'set', 'key': 'family', 'value': family}])
+    current = store.read()
+    assert stats.get(current, 'A')['people'] == {'長女': 2}
+    assert stats.get(current, 'A') == app_module.compute_pattern_stats(current, 'A')
+
+
+def test_removing_a_member_refreshes_cached_stats(app_module):
+    store, stats = app_module.store, app_module.pattern_stats
+    commit(store, [{'op': 'pattern_toggle', 'key': 'A', 'id': 'A2', 'on': True}])
+    assert stats.get(store.read(), 'A')['people'] == {'第二子': 1}
+
+    family = copy.deepcopy(store.read()['family'])
+    family['members'] = [m for m in family['members'] if m['id'] != 4]
+    commit(store, [{'op': 'set', 'key': 'family', 'value': family}])
+    current = store.read()
+    assert stats.get(current, 'A') == app_module.compute_pattern_stats(current, 'A')
+
+
+def test_lesson_edit_only_drops_patterns_using_it(app_module):
+    store, stats = app_module.store, app_module.pattern_stats
+    commit(store, [{'op': 'pattern_toggle', 'key': 'A', 'id': 'A1', 'on': True},
+                   {'op': 'pattern_toggle', 'key': 'B', 'id': 'B1', 'on': True}])
+    before_b = stats.get(store.read(), 'B')
+    stats.get(store.read(), 'A')
+    commit(store, [{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '8000'}])
+    current = store.read()
+    assert stats.get(current, 'A')['fee'] == 8000
+    assert stats.get(current, 'B') is before_b
@@ -0,0 +1,74 @@
+import random
+from datetime import date, timedelta
+
+
+def rule(app_module, text, day='月'):
+    return app_module.parse_recurrence(text, day)
+
+
+def overlap(app_module, a, b, day_a='月', day_b='月'):
+    result = app_module.rules_overlap(rule(app_module, a, day_a), rule(app_module, b, day_b))
+    assert app_module.rules_overlap(rule(app_module, b, day_b), rule(app_module, a, day_a)) == result
+    return result
+
+
+def test_weekly_rules_meet_only_on_the_same_weekday(app_module):
+    assert overlap(app_module, '', '毎週')
+    assert not overlap(app_module, '', '', '月', '火')
+    assert not overlap(app_module, '', '', '', '')
+
+
+def test_alternating_biweekly_has_no_common_week(app_module):
+    # 2026-04-06 と 04-13 は続きの月曜。隔週どうしで起点が1週ずれると解がない
+    assert overlap(app_module, '隔週 2026-04-06から', '隔週 2026-04-20から')
+    assert not overlap(app_module, '隔週 2026-04-06から', '隔週 2026-04-13から')
+    assert overlap(app_module, '隔週 2026-04-13から', '毎週')
+
+
+def test_intervals_solved_by_congruence(app_module):
+    # gcd(2, 3) = 1 なのでどの起点でも必ず重なる
+    assert overlap(app_module, '2週ごと 2026-04-06から', '3週ごと 2026-04-13から')
+    # gcd(4, 6) = 2。起点の差が偶数週なら解があり、奇数週なら解がない
+    assert overlap(app_module, '4週ごと 2026-04-06から', '6週ごと 2026-04-20から')
+    assert not overlap(app_module, '4週ごと 2026-04-06から', '6週ごと 2026-04-13から')
+
+
+def test_date_ranges_bound_the_solution(app_module):
+    assert not overlap(app_module, '2026-04-01〜2026-04-30', '2026-05-01から')
+    # 最初の共通の開催日は 05-04。片方がその前日に終わると重ならない
+    assert not overlap(app_module, '2週ごと 2026-04-06から', '3週ごと 2026-04-13〜2026-05-03')
+    assert overlap(app_module, '2週ごと 2026-04-06から', '3週ごと 2026-04-13〜2026-05-04')
+
+
+def test_one_off_and_nth_rules(app_module):
+    assert overlap(app_module, '体験 2026-04-20', '隔週 2026-04-06から')
+    assert overlap(app_module, '体験 2026-04-20', '単発 2026-04-20')
+    assert not overlap(app_module, '体験 2026-04-20', '単発 2026-04-27')
+    assert not overlap(app_module, '体験 2026-04-13', '隔週 2026-04-06から')
+    assert not overlap(app_module, '第1・3', '第2・4')
+    assert overlap(app_module, '第1', '毎週')
+    # 月曜が5回ある月（2026-06 など）は第5と最終が同じ日
+    assert overlap(app_module, '最終 2026-01-01〜2026-12-31', '第5')
+    assert not overlap(app_module, '第1 2026-04-01〜2026-04-30', '隔週 2026-04-13から')
+
+
+def test_matches_brute_force_on_bounded_rules(app_module):
+    rng = random.Random(46)
+    base = date(2026, 4, 6)
+    for _ in range(300):
+        texts = []
+        for _ in range(2):
+            start = base + timedelta(weeks=rng.randrange(12))
+            end = start + timedelta(weeks=rng.randrange(1, 30))
+            kind = rng.choice(['weekly', 'interval', 'nth'])
+            if kind == 'interval':
+                prefix = '%d週ごと ' % rng.randrange(2, 9)
+            elif kind == 'nth':
+                prefix = '第%d ' % rng.randrange(1, 6)
+            else:
+                prefix = ''
+            texts.append('%s%s〜%s' % (prefix, start.isoformat(), end.isoformat()))
+        a, b = (rule(app_module, t) for t in texts)
+        dates_a = set(a.iter_dates(base, base + timedelta(weeks=60)))
+        expected = any(b.contains(d) for d in dates_a)
+        assert app_module.rules_overlap(a, b) == expected, texts
@@ -0,0 +1,76 @@
+import random
+
+
+def commit(store, *ops):
+    return store.commit_ops(list(ops), store.revision)
+
+
+def found(app_module, query, limit=1000):
+    data, total, hits = app_module.lesson_search.search(query, limit)
+    return sorted(position for position, _, _ in hits)
+
+
+def brute_force(app_module, data, query):
+    terms = app_module.normalize_search_text(query).split()
+    texts = [[app_module.normalize_search_text(l.get(f)) for f in app_module.SEARCH_FIELD_NAMES] for l in data['lessons']]
+    return [i for i, fields in enumerate(texts) if terms and all(any(t in text for text in fields) for t in terms)]
+
+
+def test_search_ranks_name_prefix_first(app_module):
+    store = app_module.store
+    commit(store, {'op': 'lesson_set', 'index': 0, 'field': 'memo', 'value': 'スイミングの後'})
+    data, total, hits = app_module.lesson_search.search('すいみんぐ', 10)
+    # カタカナとひらがなは同じに扱い、名前の先頭で一致したものを上にする
+    assert total == 3
+    assert [position for position, _, _ in hits] == [2, 3, 0]
+    assert hits[2][2] == ['memo']
+
+
+def test_edits_update_the_index_in_place(app_module):
+    store, index = app_module.store, app_module.lesson_search
+    assert found(app_module, 'ピアノ') == [4]
+    built = index._docs
+
+    commit(store, {'op': 'lesson_set', 'index': 4, 'field': 'name', 'value': 'バイオリン'})
+    assert found(app_module, 'ピアノ') == []
+    assert found(app_module, 'バイオリン') == [4]
+
+    commit(store, {'op': 'lesson_insert', 'index': 0, 'lessons': [{'id': 'X1', 'name': 'ピアノ', 'school': '駅前'}]})
+    assert found(app_module, 'ピアノ') == [0]
+    assert found(app_module, 'バイオリン') == [5]
+
+    commit(store, {'op': 'lesson_delete', 'index': 1, 'count': 2})
+    assert found(app_module, '幼児') == []
+    assert found(app_module, 'バイオリン') == [3]
+    assert found(app_module, '駅 ピ') == [0]
+    # 作り直さずに更新している
+    assert index._docs is built
+
+
+def test_replacing_lessons_rebuilds(app_module):
+    store = app_module.store
+    found(app_module, 'ピアノ')
+    commit(store, {'op': 'set', 'key': 'lessons', 'value': [{'id': 'Z1', 'name': '英会話', 'school': ''}]})
+    assert found(app_module, 'ピアノ') == []
+    assert found(app_module, '英会話') == [0]
+
+
+def test_random_edits_match_brute_force(app_module):
+    store, rng = app_module.store, random.Random(43)
+    words = ['ピアノ', 'ぴあの教室', 'スイミング', '英会話', '駅前', '体操', 'そろばん', '']
+    found(app_module, 'ピアノ')
+    for step in range(200):
+        n = len(store.read()['lessons'])
+        kind = rng.choice(['set', 'set', 'insert', 'delete'] if n else ['insert'])
+        if kind == 'set':
+            field = rng.choice(app_module.SEARCH_FIELD_NAMES + ('fee',))
+            op = {'op': 'lesson_set', 'index': rng.randrange(n), 'field': field, 'value': rng.choice(words)}
+        elif kind == 'insert':
+            lessons = [{'id': 'R%d' % step, 'name': rng.choice(words), 'memo': rng.choice(words)}]
+            op = {'op': 'lesson_insert', 'index': rng.randrange(n + 1), 'lessons': lessons}
+        else:
+            op = {'op': 'lesson_delete', 'index': rng.randrange(n), 'count': 1}
+        commit(store, op)
+        data = store.read()
+        for query in ('ピアノ', 'ぴあ', '駅', '前 体', 'の'):
+            assert found(app_module, query) == brute_force(app_module, data, query), (step, query)
@@ -0,0 +1,65 @@
+def sample(app_module):
+    data = app_module.default_data()
+    data['lessons'][0].update(day='月', start='16:00', end='17:00', fee='5000')
+    data['lessons'][2].update(day='月', start='16:30', end='17:30', fee='8000')
+    data['patterns']['A']['ids'] = ['A1', 'B1', 'A1', 'gone']
+    data['revision'] = 1
+    return data
+
+
+def test_tables(app_module):
+    tables = app_module.sheets_tables(sample(app_module))
+    assert [title for title, _ in tables] == ['習い事候補', 'パターン比較', 'パターン_A', 'パターン_B', 'パターン_C']
+    lessons = tables[0][1]
+    assert lessons[0] == [title for _, title in app_module.LESSON_COLUMNS]
+    assert len(lessons) == 6
+    summary = tables[1][1]
+    assert summary[1] == ['A', 'パターンA', 2, 13000, 2, 0, 0, 0, 0, 0, 0, 1]
+    # 重複・存在しない ID は載せない
+    pattern_a = tables[2][1]
+    assert [row[0] for row in pattern_a[9:]] == ['A1', 'B1']
+
+
+def test_batch_for_new_spreadsheet_adds_every_sheet(app_module):
+    tables = app_module.sheets_tables(sample(app_module))
+    requests = app_module.sheets_batch_requests(tables, {'Sheet1': 0})
+    assert [next(iter(r)) for r in requests] == ['addSheet', 'updateCells'] * len(tables)
+    added = [r['addSheet']['properties'] for r in requests if 'addSheet' in r]
+    assert [p['sheetId'] for p in added] == [1, 2, 3, 4, 5]
+    assert added[1]['gridProperties'] == {'rowCount': 4, 'columnCount': 12}
+    # 追加したシートへの書き込みは、同じ requests の中でこちらが決めた sheetId を使う
+    write = requests[3]['updateCells']
+    assert write['start'] == {'sheetId': 2, 'rowIndex': 0, 'columnIndex': 0}
+    assert write['rows'][1]['values'][2] == {'userEnteredValue': {'numberValue': 2}}
+    assert write['rows'][1]['values'][1] == {'userEnteredValue': {'stringValue': 'パターンA'}}
+
+
+def test_batch_for_existing_sheets_resizes_clears_and_drops_stale_patterns(app_module):
+    tables = app_module.sheets_tables(sample(app_module))
+    existing = {'習い事候補': 10, 'パターン比較': 11, 'パターン_A': 12, 'パターン_B': 13, 'パターン_C': 14,
+                'パターン_old': 15, 'メモ': 16}
+    requests = app_module.sheets_batch_requests(tables, existing)
+    assert [next(iter(r)) for r in requests] == ['updateSheetProperties', 'updateCells', 'updateCells'] * 5 + ['deleteSheet']
+    assert requests[0]['updateSheetProperties']['fields'] == 'gridProperties(rowCount,columnCount)'
+    assert requests[1]['updateCells'] == {'range': {'sheetId': 10}, 'fields': 'userEnteredValue'}
+    # 利用者が作った別のシートは消さない
+    assert requests[-1] == {'deleteSheet': {'sheetId': 15}}
+
+
+def test_sync_is_one_metadata_read_and_one_batch_update(app_module, monkeypatch):
+    calls = []
+
+    class Spreadsheet:
+        def fetch_sheet_metadata(self, params):
+            calls.append('metadata')
+            return {'sheets': [{'properties': {'title': '習い事候補', 'sheetId': 0}}]}
+
+        def batch_update(self, body):
+            calls.append(body)
+
+    monkeypatch.setattr(app_module, 'GOOGLE_SHEETS_ID', 'sheet')
+    monkeypatch.setattr(app_module, 'sheets_spreadsheet', Spreadsheet)
+    app_module.sync_to_sheets(sample(app_module))
+    assert calls[0] == 'metadata'
+    assert len(calls) == 2
+    assert [next(iter(r)) for r in calls[1]['requests'][:3]] == ['updateSheetProperties', 'updateCells', 'updateCells']
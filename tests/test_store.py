@@ -0,0 +1,127 @@
+import json
+import threading
+
+
+def reopen(app_module):
+    return app_module.Store(app_module.JOURNAL_FILE)
+
+
+def set_fee(store, fee, index=0):
+    ops = [{'op': 'lesson_set', 'index': index, 'field': 'fee', 'value': fee}]
+    return store.commit_ops(ops, store.revision)[0]
+
+
+def journal_revs(app_module):
+    with open(app_module.JOURNAL_FILE, encoding='utf-8') as f:
+        return [json.loads(line)['rev'] for line in f]
+
+
+def test_journal_replay_restores_commits(app_module):
+    store = reopen(app_module)
+    assert set_fee(store, '1000') == 1
+    assert set_fee(store, '2000', index=1) == 2
+    assert journal_revs(app_module) == [1, 2]
+
+    restored = reopen(app_module).read()
+    assert restored['revision'] == 2
+    assert [l['fee'] for l in restored['lessons'][:2]] == ['1000', '2000']
+
+
+def test_torn_last_line_is_dropped(app_module):
+    store = reopen(app_module)
+    set_fee(store, '1000')
+    with open(app_module.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write('{"rev": 2, "ops": [{"op": "lesson_set", "ind')
+
+    restored = reopen(app_module)
+    assert restored.revision == 1
+    assert restored.read()['lessons'][0]['fee'] == '1000'
+    # 壊れた行は取り除かれ、続きの commit は正しい行として追記される
+    assert journal_revs(app_module) == [1]
+    assert set_fee(restored, '3000') == 2
+    assert reopen(app_module).read()['lessons'][0]['fee'] == '3000'
+
+
+def test_entries_covered_by_snapshot_are_skipped(app_module):
+    store = reopen(app_module)
+    set_fee(store, '1000')
+    set_fee(store, '2000')
+    store.compact()
+    # スナップショット（rev 2）以前の行が残っていても再生しない
+    stale = {'rev': 2, 'ops': [{'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': 'stale'}]}
+    newer = {'rev': 3, 'ops': [{'op': 'lesson_set', 'index': 1, 'field': 'fee', 'value': '3000'}]}
+    with open(app_module.JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(stale) + '\n' + json.dumps(newer) + '\n')
+
+    restored = reopen(app_module).read()
+    assert restored['revision'] == 3
+    assert restored['lessons'][0]['fee'] == '2000'
+    assert restored['lessons'][1]['fee'] == '3000'
+
+
+def test_compact_writes_snapshot_and_truncates_journal(app_module):
+    store = reopen(app_module)
+    for fee in ('1000', '2000', '3000'):
+        set_fee(store, fee)
+    store.compact()
+    assert journal_revs(app_module) == []
+    with open(app_module.DATA_FILE, encoding='utf-8') as f:
+        assert json.load(f)['revision'] == 3
+
+    set_fee(store, '4000')
+    assert journal_revs(app_module) == [4]
+    restored = reopen(app_module).read()
+    assert restored['revision'] == 4
+    assert restored['lessons'][0]['fee'] == '4000'
+
+
+def test_concurrent_compaction_loses_nothing(app_module):
+    store = reopen(app_module)
+    stop = threading.Event()
+
+    def compact_loop():
+        while not stop.is_set():
+            store.compact()
+
+    threads = [threading.Thread(target=compact_loop) for _ in range(3)]
+    for t in threads:
+        t.start()
+    try:
+        for i in range(60):
+            set_fee(store, str(i))
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    restored = reopen(app_module).read()
+    assert restored['revision'] == 60
+    assert restored['lessons'][0]['fee'] == '59'
+
+
+def test_stale_compaction_does_not_overwrite_newer_snapshot(app_module, monkeypatch):
+    store = reopen(app_module)
+    set_fee(store, '1000')
+    written = []
+    real_write = app_module.write_snapshot
+
+    def write_snapshot(data):
+        written.append(data['revision'])
+        # 1回目の書き出し中に別の compact が来ても、終わるまで待ってから新しい revision だけを書く
+        if len(written) == 1:
+            set_fee(store, '2000')
+            other = threading.Thread(target=store.compact)
+            other.start()
+            other.join(0.2)
+            assert other.is_alive()
+            write_snapshot.other = other
+        real_write(data)
+
+    monkeypatch.setattr(app_module, 'write_snapshot', write_snapshot)
+    store.compact()
+    write_snapshot.other.join()
+    store.compact()
+    assert written == [1, 2]
+    restored = reopen(app_module).read()
+    assert restored['revision'] == 2
+    assert restored['lessons'][0]['fee'] == '2000'
@@ -0,0 +1,51 @@
+def lesson(lesson_id, day, start, end, school, repeat=''):
+    return {'id': lesson_id, 'day': day, 'start': start, 'end': end, 'school': school, 'repeat': repeat}
+
+
+def doc(lessons, travel, limit=''):
+    return {'lessons': lessons, 'patterns': {}, 'conditions': {'travel_limit': limit},
+            'travel_times': [{'from': a, 'to': b, 'minutes': m} for a, b, m in travel]}
+
+
+def pairs(issues):
+    return [(i['from'], i['to'], i['kind']) for i in issues]
+
+
+def test_adjacent_lessons_on_the_same_day(app_module):
+    data = doc([lesson('c', '月', '17:00', '18:00', 'C'), lesson('a', '月', '15:00', '16:00', 'A'),
+                lesson('b', '月', '16:10', '16:50', 'B'), lesson('d', '火', '16:10', '17:00', 'C')],
+               [('A', 'B', 20), ('B', 'C', 5)])
+    # 順番はパターンの並びに関係なく開始時刻順。曜日をまたぐ組は比べない
+    assert pairs(app_module.travel_issues(data, ['c', 'd', 'b', 'a'])) == [('a', 'b', 'impossible')]
+    assert pairs(app_module.travel_issues(data, ['a', 'c'])) == [('a', 'c', 'unknown')]
+
+
+def test_limit_and_lessons_outside_pattern(app_module):
+    data = doc([lesson('a', '水', '15:00', '16:00', 'A'), lesson('x', '水', '16:05', '16:30', 'X'),
+                lesson('b', '水', '17:00', '18:00', 'B')], [('A', 'B', 45)], limit='30')
+    assert pairs(app_module.travel_issues(data, ['a', 'b'])) == [('a', 'b', 'over_limit')]
+
+
+def test_alternating_biweekly_lessons_look_past_the_other_week(app_module):
+    data = doc([lesson('odd1', '土', '09:00', '10:00', 'A', '隔週 2026-04-04から'),
+                lesson('even', '土', '10:00', '10:30', 'B', '隔週 2026-04-11から'),
+                lesson('odd2', '土', '10:40', '11:30', 'C', '隔週 2026-04-04から')],
+               [('A', 'B', 5), ('A', 'C', 60), ('B', 'C', 5)])
+    # even はどちらとも同じ日に開かれないので、odd2 の直前は odd1
+    assert pairs(app_module.travel_issues(data, ['odd1', 'even', 'odd2'])) == [('odd1', 'odd2', 'impossible')]
+
+
+def test_unreadable_times_are_skipped(app_module, client):
+    store = app_module.store
+    data = store.read()
+    data = dict(data, lessons=data['lessons'] + [dict(data['lessons'][0], id='X1', start='朝:半', end='10時')],
+                conditions=dict(data['conditions'], travel_strict=True))
+    data['patterns'] = dict(data['patterns'], A=dict(data['patterns']['A'], ids=['A1', 'X1']))
+    assert client.post('/api/save', json=data).status_code == 200
+
+    assert app_module.time_to_min('朝:半') == -1
+    assert 'X1' not in app_module.day_timeline(store.read()).rank
+    for url in ('/api/patterns/A/feasibility', '/api/patterns/A/stats', '/api/patterns/A/calendar',
+                '/api/workload', '/api/lessons/available', '/api/patterns/A.ics'):
+        assert client.get(url).status_code == 200, url
+    assert 'T朝' not in client.get('/api/patterns/A.ics').get_data(as_text=True)
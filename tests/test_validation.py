@@ -0,0 +1,74 @@
+import pytest
+
+
+def rejects(check, value):
+    with pytest.raises(ValueError) as info:
+        check(value)
+    return info.value.path
+
+
+def test_document_schema_accepts_default_data(app_module):
+    app_module.DOCUMENT_SCHEMA(app_module.default_data())
+
+
+def test_document_schema_reports_nested_lesson_paths(app_module):
+    data = app_module.default_data()
+    data['lessons'][3]['members'] = [3, '4']
+    assert rejects(app_module.DOCUMENT_SCHEMA, data) == 'lessons[3].members[1]'
+
+    data = app_module.default_data()
+    data['lessons'][1]['fee'] = 5000
+    assert rejects(app_module.DOCUMENT_SCHEMA, data) == 'lessons[1].fee'
+
+    data = app_module.default_data()
+    data['lessons'][0]['extra'] = {'nested': True}
+    assert rejects(app_module.DOCUMENT_SCHEMA, data) == 'lessons[0].extra'
+
+    data = app_module.default_data()
+    del data['patterns']
+    assert rejects(app_module.DOCUMENT_SCHEMA, data) == 'patterns'
+
+
+def test_booleans_are_not_integers(app_module):
+    data = app_module.default_data()
+    data['family']['members'][0]['id'] = True
+    assert rejects(app_module.DOCUMENT_SCHEMA, data) == 'family.members[0].id'
+    assert rejects(app_module.OPS_PAYLOAD_SCHEMA, {'base': False, 'ops': []}) == 'base'
+
+
+def test_ops_payload(app_module):
+    check = app_module.OPS_PAYLOAD_SCHEMA
+    lesson = {'id': 'X1', 'name': 'ピアノ', 'members': [3]}
+    check({'base': 3, 'ops': [{'op': 'lesson_insert', 'index': 0, 'lessons': [lesson]},
+                              {'op': 'lesson_set', 'index': 0, 'field': 'fee', 'value': '5000'},
+                              {'op': 'pattern_toggle', 'key': 'A', 'id': 'X1', 'on': True},
+                              {'op': 'renumber', 'ids': [[0, 'X2']], 'map': {'X1': 'X2'}}]})
+
+    assert rejects(check, {'base': -1, 'ops': []}) == 'base'
+    assert rejects(check, {'base': 0, 'ops': [{'op': 'drop_table'}]}) == 'ops[0].op'
+    assert rejects(check, {'base': 0, 'ops': [{'op': 'lesson_delete', 'index': 0}]}) == 'ops[0].count'
+    bad_lesson = dict(lesson, members=['3'])
+    assert rejects(check, {'base': 0, 'ops': [{'op': 'lesson_insert', 'index': 0, 'lessons': [lesson, bad_lesson]}]}) \
+        == 'ops[0].lessons[1].members[0]'
+    # 値は書き換える項目のスキーマで検査する
+    assert rejects(check, {'base': 0, 'ops': [{'op': 'lesson_set', 'index': 0, 'field': 'members', 'value': 3}]}) \
+        == 'ops[0].value'
+    assert rejects(check, {'base': 0, 'ops': [{'op': 'set', 'key': 'lessons', 'value': [{'id': 1}]}]}) \
+        == 'ops[0].value[0].id'
+
+
+def test_save_rejects_invalid_bodies(app_module, client):
+    assert client.post('/api/save', data='{}', content_type='text/plain').status_code == 415
+    assert client.post('/api/save', data='{"lessons": NaN}', content_type='application/json').status_code == 400
+    response = client.post('/api/save', json={'lessons': [{'members': 'x'}], 'patterns': {}})
+    assert response.status_code == 400
+    assert 'lessons[0].members' in response.get_json()['error']
+
+
+def test_lesson_ids_body_is_validated(app_module, client):
+    response = client.post('/api/lessons/ids', json={'who': '第一子', 'name': 'ピアノ', 'count': 2})
+    assert response.get_json()['ids'] == ['第一子-C01', '第一子-C02']
+    for body in ({'count': 0}, {'count': 101}, {'count': True}, {'who': 3}, {'name': 'ピアノ', 'extra': 1}):
+        assert client.post('/api/lessons/ids', json=body).status_code == 400, body
+    assert client.post('/api/lessons/ids', json=[1]).status_code == 400
+    assert client.post('/api/lessons/ids', data='who=x').status_code == 415
@@ -0,0 +1,79 @@
+import random
+
+
+def doc(app_module, lessons):
+    data = app_module.default_data()
+    data['lessons'] = lessons
+    data['revision'] = 1
+    return data
+
+
+def lesson(lesson_id, day, start, end, members, who='第一子'):
+    return {'id': lesson_id, 'day': day, 'start': start, 'end': end, 'members': members, 'who': who}
+
+
+def test_slot_counts_and_busy_minutes(app_module):
+    data = doc(app_module, [lesson('a', '月', '16:00', '17:00', [3]), lesson('b', '月', '16:40', '17:10', [3]),
+                            lesson('c', '土', '09:05', '09:20', [3, 4], '第一子＋第二子'),
+                            lesson('untimed', '火', '', '', [3])])
+    people = app_module.LessonIntervals(data).workload(['a', 'b', 'c', 'untimed', 'a'])
+    first = people['第一子']
+    monday = first['slots']['月']
+    slot = lambda hh, mm: (hh * 60 + mm) // app_module.WORKLOAD_SLOT_MINUTES
+    assert monday[slot(15, 45)] == 0
+    assert monday[slot(16, 0)] == 1
+    # 16:30〜16:45 の枠は a と b の両方にかかる
+    assert monday[slot(16, 30)] == 2
+    assert monday[slot(17, 0)] == 1
+    assert monday[slot(17, 15)] == 0
+    # 拘束時間は重なりを二重に数えない
+    assert first['busy']['月'] == 70
+    assert first['peak'] == 2
+    assert first['overlap_slots'] == 2
+    # 枠の途中から始まる・終わる習い事も、かかった枠を1件と数える
+    assert first['slots']['土'][slot(9, 0):slot(9, 30)] == [1, 1]
+    assert first['busy']['土'] == 15
+    assert people['第二子']['busy_total'] == 15
+    assert set(people) == {'第一子', '第二子'}
+
+
+def test_who_filter(app_module):
+    data = doc(app_module, [lesson('a', '月', '16:00', '17:00', [3]),
+                            lesson('c', '土', '09:00', '10:00', [3, 4], '第一子＋第二子')])
+    people = app_module.LessonIntervals(data).workload(['a', 'c'], who='第二子')
+    assert set(people) == {'第二子'}
+    assert people['第二子']['busy'] == dict.fromkeys(app_module.DAYS, 0) | {'土': 60}
+
+
+def test_counts_match_brute_force(app_module):
+    rng = random.Random(44)
+    lessons = []
+    for i in range(40):
+        start = rng.randrange(8 * 60, 20 * 60)
+        end = start + rng.randrange(5, 180)
+        lessons.append(lesson('L%d' % i, rng.choice(app_module.DAYS), '%02d:%02d' % divmod(start, 60),
+                              '%02d:%02d' % divmod(end, 60), [3]))
+    data = doc(app_module, lessons)
+    slots = app_module.LessonIntervals(data).workload([l['id'] for l in lessons])['第一子']['slots']
+    size = app_module.WORKLOAD_SLOT_MINUTES
+    for day in app_module.DAYS:
+        expected = [0] * app_module.SLOTS_PER_DAY
+        for l in lessons:
+            if l['day'] == day:
+                start, end = app_module.time_to_min(l['start']), app_module.time_to_min(l['end'])
+                for s in range(start // size, (end - 1) // size + 1):
+                    expected[s] += 1
+        assert slots[day] == expected, day
+
+
+def test_workload_endpoint(app_module, client):
+    store = app_module.store
+    store.commit_ops([{'op': 'lesson_set', 'index': 0, 'field': 'day', 'value': '水'},
+                      {'op': 'lesson_set', 'index': 0, 'field': 'start', 'value': '10:00'},
+                      {'op': 'lesson_set', 'index': 0, 'field': 'end', 'value': '10:30'},
+                      {'op': 'pattern_toggle', 'key': 'B', 'id': 'A1', 'on': True}], 0)
+    res = client.get('/api/workload?patterns=A,B').get_json()
+    assert res['patterns']['A'] == {'people': {}, 'busy_total': 0, 'peak': 0}
+    assert res['patterns']['B']['busy_total'] == 30
+    assert res['patterns']['B']['people']['第一子']['slots']['水'][40:42] == [1, 1]
+    assert client.get('/api/workload?patterns=Z').status_code == 404